@@ -0,0 +1,483 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Bandwidth limiting.
+
+TokenBucket is a classic token bucket. Shaper applies a global limit, per set
+limits and per client limits to WSGI responses, sharing each limit fairly
+between the responses it applies to. Throttle limits the rate at which a
+receiver reads content, optionally adapting the rate to how quickly the
+content can be written.
+"""
+
+__all__ = ['parse_rate', 'TokenBucket', 'Shaper', 'Throttle']
+
+import re
+import threading
+import time
+
+from l_mirror import eventserver, journals
+
+# The largest piece of a response sent at once.
+SLICE_SIZE = 65536
+# The smallest burst a limit permits, so that slow limits don't send tiny
+# pieces.
+MIN_BURST = 16384
+# The lowest rate an adaptive Throttle backs off to, in bytes per second.
+MIN_ADAPTIVE_RATE = 65536
+# How often an adaptive Throttle reconsiders its rate, in seconds.
+ADAPT_INTERVAL = 1.0
+# An adaptive Throttle backs off when write latency is this many times the
+# best it has seen.
+LATENCY_FACTOR = 4.0
+
+_rate_re = re.compile(r'^(\d+(?:\.\d+)?)([kmg]?)$', re.IGNORECASE)
+_multipliers = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(rate_string):
+    """Parse a rate in bytes per second, such as '512K' or '10M'.
+
+    :return: The rate as an int.
+    :raises ValueError: If rate_string is not a rate.
+    """
+    match = _rate_re.match(rate_string.strip())
+    if match is None:
+        raise ValueError('invalid rate %r' % rate_string)
+    rate = int(float(match.group(1)) * _multipliers[match.group(2).lower()])
+    if rate <= 0:
+        raise ValueError('invalid rate %r' % rate_string)
+    return rate
+
+
+class TokenBucket(object):
+    """A token bucket.
+
+    Tokens (bytes) accrue at rate per second up to burst, and are removed by
+    take().
+
+    :ivar rate: The rate tokens accrue at, per second.
+    :ivar burst: The most tokens the bucket holds.
+    :ivar tokens: The tokens in the bucket as of the last refill.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        """Create a full TokenBucket.
+
+        :param rate: Tokens per second.
+        :param burst: The size of the bucket, defaulting to a tenth of a
+            second of tokens (but at least MIN_BURST).
+        :param clock: A callable returning the time in seconds.
+        """
+        self.rate = rate
+        if burst is None:
+            burst = max(rate // 10, MIN_BURST)
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self._last = clock()
+
+    def refill(self):
+        """Add the tokens accrued since the last refill."""
+        now = self.clock()
+        elapsed = max(0, now - self._last)
+        self._last = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def take(self, count):
+        """Take up to count tokens.
+
+        :return: The number of tokens taken, which may be 0.
+        """
+        self.refill()
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def wait_time(self, count):
+        """How long until count tokens will be available, in seconds."""
+        self.refill()
+        missing = min(count, self.burst) - self.tokens
+        if missing < 1:
+            # Less than a byte short is close enough, and avoids waiting
+            # for ever on rounding errors.
+            return 0
+        return missing / float(self.rate)
+
+
+class _Limit(object):
+    """A TokenBucket shared by some number of active responses."""
+
+    def __init__(self, rate, clock):
+        self.bucket = TokenBucket(rate, clock=clock)
+        self.active = 0
+
+    def share(self):
+        """The most one response may take at once: a fair share of a burst."""
+        return max(1, self.bucket.burst // max(1, self.active))
+
+
+class Shaper(object):
+    """Limit the bandwidth used by WSGI responses.
+
+    Each response is limited by the global limit, the limit for its mirror set
+    and the limit for its client, where those are set. Each time a response
+    sends, it takes at most a fair share (the burst divided by the number of
+    active responses) of each limit, so concurrent responses progress at
+    similar rates, while tokens not wanted by idle responses remain available
+    to the others.
+
+    :ivar rate: The global limit, or None.
+    :ivar set_rates: A dict of set name -> limit.
+    :ivar client_rate: The limit for each client address, or None.
+    """
+
+    def __init__(self, rate=None, set_rates=None, client_rate=None,
+        clock=time.time, sleep=time.sleep):
+        """Create a Shaper.
+
+        :param rate: The global limit in bytes per second, or None.
+        :param set_rates: A dict of set name -> limit in bytes per second.
+        :param client_rate: The limit in bytes per second for each client
+            address, or None.
+        :param clock: A callable returning the time in seconds.
+        :param sleep: A callable to sleep for some seconds.
+        """
+        self.rate = rate
+        self.set_rates = dict(set_rates or {})
+        self.client_rate = client_rate
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._global = None
+        if rate is not None:
+            self._global = _Limit(rate, clock)
+        self._sets = {}
+        for name, set_rate in self.set_rates.items():
+            self._sets[name] = _Limit(set_rate, clock)
+        # Client limits only exist while the client has active responses.
+        self._clients = {}
+
+    def shape(self, response, set_name, client, cooperative=False):
+        """Limit a WSGI response.
+
+        :param response: The WSGI response iterable.
+        :param set_name: The name of the mirror set being sent.
+        :param client: The address of the client being sent to.
+        :param cooperative: If True, yield eventserver.NOT_READY when the
+            response must wait rather than sleeping.
+        :return: A WSGI response iterable.
+        """
+        return _ShapedResponse(self, response, set_name, client, cooperative)
+
+    def _acquire(self, set_name, client):
+        """Register a response and return the limits that apply to it."""
+        limits = []
+        self._lock.acquire()
+        try:
+            if self._global is not None:
+                limits.append(self._global)
+            if set_name in self._sets:
+                limits.append(self._sets[set_name])
+            if self.client_rate is not None:
+                limit = self._clients.get(client)
+                if limit is None:
+                    limit = _Limit(self.client_rate, self.clock)
+                    self._clients[client] = limit
+                limits.append(limit)
+            for limit in limits:
+                limit.active += 1
+        finally:
+            self._lock.release()
+        return limits
+
+    def _release(self, limits, client):
+        self._lock.acquire()
+        try:
+            for limit in limits:
+                limit.active -= 1
+            limit = self._clients.get(client)
+            if limit is not None and not limit.active:
+                del self._clients[client]
+        finally:
+            self._lock.release()
+
+    def _take(self, limits, count):
+        """Take up to count bytes from all of limits.
+
+        At most a fair share of each limit is taken, and nothing is taken
+        until all of that is available, so that waiting responses don't send
+        in tiny pieces.
+
+        :return: A tuple (taken, wait): the bytes that may be sent, and if
+            that is 0, the seconds to wait before trying again.
+        """
+        self._lock.acquire()
+        try:
+            for limit in limits:
+                count = min(count, limit.share())
+            wait = 0
+            for limit in limits:
+                wait = max(wait, limit.bucket.wait_time(count))
+            if wait:
+                return 0, wait
+            for limit in limits:
+                limit.bucket.tokens -= count
+            return count, 0
+        finally:
+            self._lock.release()
+
+
+class _ShapedResponse(object):
+    """A WSGI response limited by a Shaper."""
+
+    def __init__(self, shaper, response, set_name, client, cooperative):
+        self.shaper = shaper
+        self.response = response
+        self.client = client
+        self.cooperative = cooperative
+        self.limits = shaper._acquire(set_name, client)
+        self._iterator = self._shape()
+
+    def __iter__(self):
+        return self._iterator
+
+    def _shape(self):
+        for chunk in self.response:
+            if isinstance(chunk, journals.FileSegment):
+                offset = chunk.offset
+                remaining = chunk.length
+                while remaining:
+                    size = self._allow(remaining)
+                    if not size:
+                        yield eventserver.NOT_READY
+                        continue
+                    yield journals.FileSegment(chunk.file, offset, size)
+                    offset += size
+                    remaining -= size
+            elif chunk is eventserver.NOT_READY or not chunk:
+                # Pass on 'not ready' markers and empty chunks.
+                yield chunk
+            else:
+                pos = 0
+                while pos < len(chunk):
+                    size = self._allow(len(chunk) - pos)
+                    if not size:
+                        yield eventserver.NOT_READY
+                        continue
+                    yield chunk[pos:pos + size]
+                    pos += size
+        self._release()
+
+    def _allow(self, wanted):
+        """Wait until some of wanted bytes may be sent.
+
+        :return: The number of bytes that may be sent. In cooperative mode
+            this is 0 when the caller needs to wait.
+        """
+        wanted = min(wanted, SLICE_SIZE)
+        while True:
+            taken, wait = self.shaper._take(self.limits, wanted)
+            if taken or self.cooperative:
+                return taken
+            self.shaper.sleep(wait)
+
+    def _release(self):
+        limits = self.limits
+        self.limits = []
+        if limits:
+            self.shaper._release(limits, self.client)
+
+    def close(self):
+        self._release()
+        close = getattr(self.response, 'close', None)
+        if close is not None:
+            close()
+
+
+class Throttle(object):
+    """Limit the rate at which a receiver reads content.
+
+    A Throttle is given to journals.TransportReplay, which wraps the files it
+    reads content from with reader(), and the files it writes content to with
+    writer().
+
+    In adaptive mode the time taken by writes is tracked. When the latency of
+    writes rises well above the best seen - the disk cannot keep up - the rate
+    is cut to half of the recent throughput, and otherwise it creeps back up
+    towards the configured rate (or to unlimited). This stops disk bound
+    receivers from reading faster than they can write, and so building up
+    data in buffers.
+
+    :ivar max_rate: The configured limit in bytes per second, or None.
+    :ivar rate: The current limit in bytes per second, or None for unlimited.
+    :ivar adaptive: Whether the rate adapts to write latency.
+    """
+
+    def __init__(self, rate=None, adaptive=False, clock=time.time,
+        sleep=time.sleep):
+        """Create a Throttle.
+
+        :param rate: The limit in bytes per second, or None.
+        :param adaptive: If True, adapt the rate to write latency.
+        :param clock: A callable returning the time in seconds.
+        :param sleep: A callable to sleep for some seconds.
+        """
+        self.max_rate = rate
+        self.adaptive = adaptive
+        self.clock = clock
+        self.sleep = sleep
+        self.rate = None
+        self._bucket = None
+        self._set_rate(rate)
+        # Smoothed and best write latency, in seconds per 64KB.
+        self._latency = None
+        self._best_latency = None
+        self._period_start = clock()
+        self._period_bytes = 0
+        # The throughput when the rate was last cut.
+        self._backoff_throughput = None
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        if rate is None:
+            self._bucket = None
+        elif self._bucket is None:
+            self._bucket = TokenBucket(rate, clock=self.clock)
+        else:
+            self._bucket.refill()
+            self._bucket.rate = rate
+            self._bucket.burst = max(rate // 10, MIN_BURST)
+            self._bucket.tokens = min(self._bucket.tokens, self._bucket.burst)
+
+    def reader(self, a_file):
+        """Wrap a_file so that reads from it are limited."""
+        return ThrottledFile(a_file, self)
+
+    def writer(self, a_file):
+        """Wrap a_file so that the latency of writes to it is measured."""
+        if not self.adaptive:
+            return a_file
+        return _TimedFile(a_file, self)
+
+    def allow(self, count):
+        """Wait until some of count bytes may be read.
+
+        :return: The number of bytes that may be read.
+        """
+        if self._bucket is None:
+            self._period_bytes += count
+            return count
+        count = min(count, self._bucket.burst)
+        # Wait for all of count rather than taking what is there, so that
+        # reads are not broken into tiny pieces.
+        while True:
+            wait = self._bucket.wait_time(count)
+            if not wait:
+                taken = self._bucket.take(count)
+                if taken:
+                    self._period_bytes += taken
+                    return taken
+                # Less than a byte short.
+                wait = 1.0 / self._bucket.rate
+            self.sleep(wait)
+
+    def refund(self, count):
+        """Return count bytes allowed by allow() but not read."""
+        self._period_bytes -= count
+        if self._bucket is not None:
+            self._bucket.tokens = min(self._bucket.burst,
+                self._bucket.tokens + count)
+
+    def note_write(self, count, seconds):
+        """Record that writing count bytes took seconds."""
+        if not self.adaptive:
+            return
+        # Small writes are dominated by fixed costs, so count them as 64KB.
+        latency = seconds * 65536 / max(count, 65536)
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * latency
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+        now = self.clock()
+        elapsed = now - self._period_start
+        if elapsed < ADAPT_INTERVAL:
+            return
+        throughput = self._period_bytes / elapsed
+        self._period_start = now
+        self._period_bytes = 0
+        if self._latency > self._best_latency * LATENCY_FACTOR:
+            self._backoff_throughput = throughput
+            self._set_rate(max(MIN_ADAPTIVE_RATE, int(throughput / 2)))
+        elif self.rate is not None:
+            rate = int(self.rate * 1.1) + MIN_ADAPTIVE_RATE
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            elif rate > self._backoff_throughput * 2:
+                # Well clear of the rate that swamped the disk: stop limiting.
+                rate = None
+            self._set_rate(rate)
+
+
+class ThrottledFile(object):
+    """A file-like object whose reads are limited by a Throttle.
+
+    Reads may return fewer bytes than asked for.
+    """
+
+    def __init__(self, a_file, throttle):
+        self.a_file = a_file
+        self.throttle = throttle
+
+    def read(self, amount=None):
+        if amount is None or amount < 0:
+            pieces = []
+            piece = self.read(SLICE_SIZE)
+            while piece:
+                pieces.append(piece)
+                piece = self.read(SLICE_SIZE)
+            return ''.join(pieces)
+        if not amount:
+            return ''
+        allowed = self.throttle.allow(amount)
+        content = self.a_file.read(allowed)
+        if len(content) < allowed:
+            self.throttle.refund(allowed - len(content))
+        return content
+
+    def close(self):
+        self.a_file.close()
+
+
+class _TimedFile(object):
+    """A file-like object reporting the time its writes take to a Throttle."""
+
+    def __init__(self, a_file, throttle):
+        self.a_file = a_file
+        self.throttle = throttle
+
+    def write(self, content):
+        start = self.throttle.clock()
+        self.a_file.write(content)
+        self.throttle.note_write(len(content), self.throttle.clock() - start)
+
+    def close(self):
+        self.a_file.close()
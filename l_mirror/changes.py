@@ -0,0 +1,356 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Known changes to a content root, for scanning without walking the disk.
+
+A Changes lists the changed paths under a content root grouped by their
+directory, and the directories whose whole subtrees need scanning because
+their changes are not known. A directory with very many changes is cheaper to
+scan than to list, so aggregate() replaces them with a scan of the directory.
+
+Changes are serialised as a header ('l-mirror-changes-1\\n') followed by '\\0'
+terminated tokens: 'scan', RELPATH for each directory to scan, and 'dir',
+RELPATH, COUNT, then COUNT names for each directory with changes. Each
+directory is named once, so the size of the serialised form and the work to
+parse it grow with the number of changed directories and names rather than
+with the lengths of the changed paths.
+
+A ChangeLog is the append only log of changes kept for one set by a watcher
+running alongside it, such as 'lmirror watch', so that finish-change can use
+the watcher's changes without a server: see read_log.
+"""
+
+__all__ = ['Changes', 'parse', 'ChangeLog', 'read_log']
+
+import errno
+import fcntl
+import os
+
+HEADER = 'l-mirror-changes-1\n'
+LOG_HEADER = 'l-mirror-changelog-1\n'
+# The name of the change log in the metadata directory of a set.
+CHANGE_LOG = 'changes.log'
+# Directories with more changes than this are scanned instead.
+AGGREGATE_THRESHOLD = 1000
+
+
+def _utf8(path):
+    if isinstance(path, unicode):
+        return path.encode('utf8')
+    return path
+
+
+class Changes(object):
+    """Changed paths under a content root.
+
+    All paths are utf8 bytestrings relative to the content root, with '' for
+    the root itself.
+
+    :ivar dirs: A dict of directory relpath -> set of changed names in it.
+    :ivar scan: A set of the directories whose subtrees need scanning.
+    """
+
+    def __init__(self):
+        """Create an empty Changes."""
+        self.dirs = {}
+        self.scan = set()
+
+    @classmethod
+    def from_abspaths(cls, root, paths, scan=()):
+        """Create a Changes from absolute paths.
+
+        :param root: The absolute path of the content root.
+        :param paths: Absolute paths of changes within root.
+        :param scan: Absolute paths of directories to scan within root.
+        """
+        result = cls()
+        prefix = len(_utf8(root)) + 1
+        for path in paths:
+            result.add(_utf8(path)[prefix:])
+        for path in scan:
+            result.scan.add(_utf8(path)[prefix:])
+        return result
+
+    def add(self, relpath):
+        """Add a changed path."""
+        if not relpath:
+            return
+        dirname, _, name = relpath.rpartition('/')
+        names = self.dirs.get(dirname)
+        if names is None:
+            names = self.dirs[dirname] = set()
+        names.add(name)
+
+    def in_scan(self, relpath):
+        """Return True if relpath is within a directory to scan."""
+        if not self.scan:
+            return False
+        if '' in self.scan or relpath in self.scan:
+            return True
+        pos = relpath.find('/')
+        while pos != -1:
+            if relpath[:pos] in self.scan:
+                return True
+            pos = relpath.find('/', pos + 1)
+        return False
+
+    def aggregate(self, threshold=AGGREGATE_THRESHOLD):
+        """Scan directories with more than threshold changes.
+
+        The changes within directories to scan are dropped, as the scan will
+        find them.
+        """
+        for dirname, names in self.dirs.items():
+            if len(names) > threshold:
+                self.scan.add(dirname)
+        scan = self.scan
+        self.scan = set()
+        # Shallowest first, so nested directories are dropped.
+        for dirname in sorted(scan, key=lambda relpath: relpath.count('/')):
+            if not self.in_scan(dirname):
+                self.scan.add(dirname)
+        for dirname in list(self.dirs):
+            if self.in_scan(dirname):
+                del self.dirs[dirname]
+
+    def iter_bytes(self):
+        """Serialise the changes.
+
+        :return: A generator of bytestrings, one per directory.
+        """
+        yield HEADER
+        for dirname in sorted(self.scan):
+            yield 'scan\x00%s\x00' % dirname
+        for dirname, names in sorted(self.dirs.iteritems()):
+            yield 'dir\x00%s\x00%d\x00%s\x00' % (dirname, len(names),
+                '\x00'.join(sorted(names)))
+
+    def as_tree(self):
+        """Get the changes as a tree of the changed paths.
+
+        Directories to scan are included, so that a walk of the tree reaches
+        them.
+
+        :return: A dict name -> (relpath, children) for the root, where
+            children is a dict of the same form.
+        """
+        root = {}
+        nodes = {'': root}
+        def node(relpath):
+            result = nodes.get(relpath)
+            if result is None:
+                dirname, _, name = relpath.rpartition('/')
+                result = node(dirname).setdefault(name, (relpath, {}))[1]
+                nodes[relpath] = result
+            return result
+        for dirname in self.scan:
+            if dirname:
+                node(dirname)
+        for dirname, names in self.dirs.iteritems():
+            children = node(dirname)
+            prefix = dirname and dirname + '/'
+            for name in names:
+                if name not in children:
+                    children[name] = (prefix + name, {})
+        return root
+
+
+def parse(a_bytestring):
+    """Parse serialised changes.
+
+    :return: A Changes.
+    :raises ValueError: If a_bytestring is not serialised changes.
+    """
+    if not a_bytestring.startswith(HEADER):
+        raise ValueError('Not serialised changes: %r' %
+            a_bytestring[:len(HEADER)])
+    tokens = a_bytestring[len(HEADER):].split('\x00')
+    if tokens.pop() != '':
+        raise ValueError('Truncated changes')
+    result = Changes()
+    pos = 0
+    try:
+        while pos < len(tokens):
+            kind = tokens[pos]
+            if kind == 'scan':
+                result.scan.add(tokens[pos + 1])
+                pos += 2
+            elif kind == 'dir':
+                count = int(tokens[pos + 2])
+                names = tokens[pos + 3:pos + 3 + count]
+                if len(names) != count:
+                    raise ValueError('Truncated changes')
+                result.dirs.setdefault(tokens[pos + 1], set()).update(names)
+                pos += 3 + count
+            else:
+                raise ValueError('Unknown changes token %r' % kind)
+    except IndexError:
+        raise ValueError('Truncated changes')
+    return result
+
+
+class ChangeLog(object):
+    """The log of changes under a content root, written by a watcher.
+
+    The log is a header followed by '\\0' terminated records: 'change', the
+    time, and the path relative to the content root for each change noted;
+    'walked' and the time once every directory is watched; and 'overflow'
+    and the time when the watcher discarded changes. A log is only written
+    by a watcher holding the lock on path + '.lock', and is started afresh
+    each time it is opened, so a reader knows that the log covers every
+    change since the watcher started only while that lock is held.
+
+    :ivar path: The path of the log.
+    :ivar records: The number of records in the log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._lock = None
+        self._file = None
+
+    def open(self):
+        """Lock and start the log.
+
+        :raises ValueError: If another watcher has the log open.
+        """
+        lock = open(self.path + '.lock', 'wb')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise ValueError('%s is already being written' % self.path)
+        self._lock = lock
+        self._file = self._start(self.path)
+
+    def _start(self, path):
+        log_file = open(path, 'wb', 0)
+        log_file.write(LOG_HEADER)
+        self.records = 0
+        return log_file
+
+    def note(self, relpath, timestamp):
+        """Record that relpath changed at timestamp."""
+        self._file.write('change\x00%r\x00%s\x00' % (timestamp, relpath))
+        self.records += 1
+
+    def walked(self, timestamp):
+        """Record that every directory is watched."""
+        self._file.write('walked\x00%r\x00' % timestamp)
+        self.records += 1
+
+    def overflowed(self, timestamp):
+        """Record that changes noted before timestamp were discarded."""
+        self._file.write('overflow\x00%r\x00' % timestamp)
+        self.records += 1
+
+    def rewrite(self, changes, walked=None, overflowed=None):
+        """Replace the log with just some changes.
+
+        :param changes: An iterable of (timestamp, relpath) tuples.
+        :param walked: None, or the time every directory was watched.
+        :param overflowed: None, or the time changes were last discarded.
+        """
+        temp_path = self.path + '.tmp'
+        log_file = self._start(temp_path)
+        old_file, self._file = self._file, log_file
+        if overflowed is not None:
+            self.overflowed(overflowed)
+        for timestamp, relpath in changes:
+            self.note(relpath, timestamp)
+        if walked is not None:
+            self.walked(walked)
+        os.rename(temp_path, self.path)
+        old_file.close()
+
+    def close(self):
+        """Remove the log and release the lock."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.unlink(self.path)
+        self._lock.close()
+        self._lock = None
+
+
+def read_log(path, last):
+    """Read the changes from a change log.
+
+    :param path: The path of the log, written by ChangeLog.
+    :param last: The time of the last scan: changes more than 3 seconds
+        older (allowing for the rounding of scan timestamps) are ignored.
+    :return: None if the changes since last are not all known - because no
+        watcher is writing the log, it has not finished watching every
+        directory, or it discarded changes since last - or a Changes.
+    """
+    try:
+        lock = open(path + '.lock', 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            # No watcher holds the lock.
+            return None
+        try:
+            log_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            content = log_file.read()
+        finally:
+            log_file.close()
+    finally:
+        lock.close()
+    if not content.startswith(LOG_HEADER):
+        return None
+    # A record may be partly written: ignore it.
+    tokens = content[len(LOG_HEADER):].split('\x00')[:-1]
+    since = last - 3
+    result = Changes()
+    walked = False
+    pos = 0
+    while pos < len(tokens):
+        kind = tokens[pos]
+        if kind == 'change':
+            if pos + 2 >= len(tokens):
+                break
+            if float(tokens[pos + 1]) >= since:
+                result.add(tokens[pos + 2])
+            pos += 3
+        elif kind == 'walked':
+            walked = pos + 1 < len(tokens)
+            pos += 2
+        elif kind == 'overflow':
+            if pos + 1 < len(tokens) and float(tokens[pos + 1]) >= last:
+                return None
+            pos += 2
+        else:
+            raise ValueError('Unknown change log record %r' % kind)
+    if not walked:
+        return None
+    return result
@@ -0,0 +1,206 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Trusted checksums for content, from the tools that wrote it.
+
+Archive tools such as APT repository generators already know the sha1 of the
+files they publish. A ChecksumSource gives DiskUpdater those sha1s, so that
+files which have not changed since the tool recorded them are journalled
+without reading them again. A recorded sha1 is only used when the size of the
+file matches, and when its mtime shows it has not changed since the sha1 was
+recorded.
+
+Sources are configured with 'checksums KIND PATH' lines in a set's
+content.conf, where KIND is a key of SOURCES. New kinds can be added to
+SOURCES: each is called with the transport of the content root and PATH,
+and returns a ChecksumSource.
+"""
+
+__all__ = ['ChecksumSource', 'SidecarChecksums', 'DebianIndexChecksums',
+    'CombinedChecksums', 'SOURCES', 'get_source']
+
+import gzip
+from StringIO import StringIO
+
+from bzrlib import errors
+
+
+class ChecksumSource(object):
+    """A source of trusted sha1s for files."""
+
+    def get_sha1(self, path, statinfo):
+        """Get the sha1 of path.
+
+        :param path: The path relative to the content root.
+        :param statinfo: The stat result for path.
+        :return: The hex sha1 of path, or None if it is not known.
+        """
+        raise NotImplementedError(self.get_sha1)
+
+
+class _IndexChecksums(ChecksumSource):
+    """A source which reads an index file from the content when first used.
+
+    :ivar transport: The transport the index is read from.
+    :ivar relpath: The path of the index.
+    """
+
+    def __init__(self, transport, relpath):
+        self.transport = transport
+        self.relpath = relpath
+        self._index = None
+        self._mtime = None
+
+    def _get_index(self):
+        if self._index is None:
+            try:
+                self._mtime = getattr(self.transport.stat(self.relpath),
+                    'st_mtime', 0)
+                content = self.transport.get_bytes(self.relpath)
+            except errors.NoSuchFile:
+                content = ''
+            if self.relpath.endswith('.gz') and content:
+                content = gzip.GzipFile(fileobj=StringIO(content)).read()
+            self._index = self._parse(content)
+        return self._index
+
+    def _parse(self, content):
+        """Parse the index.
+
+        :return: A dict of path -> (sha1, size, mtime), where mtime is None
+            if the recorded sha1 is good for any file older than the index.
+        """
+        raise NotImplementedError(self._parse)
+
+    def get_sha1(self, path, statinfo):
+        entry = self._get_index().get(path)
+        if entry is None:
+            return None
+        sha1, size, mtime = entry
+        if size != statinfo.st_size:
+            return None
+        file_mtime = getattr(statinfo, 'st_mtime', 0)
+        if mtime is None:
+            if file_mtime > self._mtime:
+                # Written after the index was.
+                return None
+        elif '%f' % mtime != '%f' % file_mtime:
+            return None
+        return sha1
+
+
+class SidecarChecksums(_IndexChecksums):
+    """Checksums from a sidecar file.
+
+    Each line of the file is 'SHA1 SIZE MTIME PATH', where PATH is relative to
+    the content root and MTIME is the mtime of the file when its sha1 was
+    recorded, in seconds since the epoch.
+    """
+
+    def _parse(self, content):
+        index = {}
+        for line in content.splitlines():
+            if not line:
+                continue
+            try:
+                sha1, size, mtime, path = line.split(' ', 3)
+                index[path] = (sha1, int(size), float(mtime))
+            except ValueError:
+                raise ValueError('Invalid checksums line in %s: %r' % (
+                    self.relpath, line))
+        return index
+
+
+class DebianIndexChecksums(_IndexChecksums):
+    """Checksums from a Debian Packages or Sources file (optionally gzipped).
+
+    Paths are taken to be relative to the content root, so the content root
+    should be the root of the archive. The sha1s are used for files no newer
+    than the index.
+    """
+
+    def _parse(self, content):
+        index = {}
+        for stanza in content.split('\n\n'):
+            fields = {}
+            field = None
+            for line in stanza.splitlines():
+                if line[:1] in (' ', '\t'):
+                    if field is not None:
+                        fields[field].append(line.strip())
+                    continue
+                field, _, value = line.partition(':')
+                fields[field] = [value.strip()]
+            if 'Filename' in fields:
+                # A Packages stanza.
+                try:
+                    index[fields['Filename'][0]] = (fields['SHA1'][0],
+                        int(fields['Size'][0]), None)
+                except (KeyError, ValueError):
+                    continue
+            elif 'Directory' in fields and 'Checksums-Sha1' in fields:
+                # A Sources stanza.
+                directory = fields['Directory'][0]
+                for entry in fields['Checksums-Sha1']:
+                    try:
+                        sha1, size, name = entry.split()
+                        index[directory + '/' + name] = (sha1, int(size), None)
+                    except ValueError:
+                        continue
+        return index
+
+
+class CombinedChecksums(ChecksumSource):
+    """Checksums from the first of several sources which knows them."""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def get_sha1(self, path, statinfo):
+        for source in self.sources:
+            sha1 = source.get_sha1(path, statinfo)
+            if sha1 is not None:
+                return sha1
+        return None
+
+
+SOURCES = {
+    'sidecar': SidecarChecksums,
+    'debian': DebianIndexChecksums,
+    }
+
+
+def get_source(transport, specs):
+    """Create the checksum source for some configured sources.
+
+    :param transport: The transport of the content root.
+    :param specs: A list of (kind, path) tuples.
+    :return: None if specs is empty, or a ChecksumSource.
+    :raises ValueError: If a kind is not in SOURCES.
+    """
+    sources = []
+    for kind, path in specs:
+        if kind not in SOURCES:
+            raise ValueError('Unknown checksums kind %r' % kind)
+        sources.append(SOURCES[kind](transport, path))
+    if not sources:
+        return None
+    if len(sources) == 1:
+        return sources[0]
+    return CombinedChecksums(sources)
@@ -25,7 +25,7 @@ from bzrlib import urlutils
 
 from l_mirror.arguments import path
 from l_mirror.commands import Command
-from l_mirror import mirrorset
+from l_mirror import journals, mirrorset
 
 class finish_change(Command):
     """Finish an open change in a mirror set.
@@ -37,7 +37,16 @@ class finish_change(Command):
     options = [Option("--dry-run", "-n", dest="dryrun",
         help="Do not record changes. Useful for seeing if all the changes"
         " expected will be picked up / looking for unexpected changes.",
-        action="store_true", default=False)
+        action="store_true", default=False),
+        Option("--prerender", dest="prerender", help="Pre-render the streams "
+        "a smart server sends to receivers that are up to this many journals "
+        "behind, so that the server can send them straight from disk.",
+        type="int", default=0),
+        Option("--from-manifest", dest="manifest", help="Journal just the "
+        "paths listed in this file rather than scanning for changes. Each "
+        "path, relative to the content root, is followed by '', 'del', a "
+        "hex sha1, or SHA1:LENGTH, all terminated by NUL characters: see "
+        "the manual.", default=None),
         ]
 
     def run(self):
@@ -45,5 +54,13 @@ class finish_change(Command):
         base = transport.clone('..')
         name = base.relpath(transport.base)
         mirror = mirrorset.MirrorSet(base, name, self.ui)
-        mirror.finish_change(dryrun=self.ui.options.dryrun)
+        manifest = None
+        if self.ui.options.manifest:
+            manifest_file = open(self.ui.options.manifest, 'rb')
+            try:
+                manifest = journals.parse_manifest(manifest_file.read())
+            finally:
+                manifest_file.close()
+        mirror.finish_change(dryrun=self.ui.options.dryrun,
+            prerender=self.ui.options.prerender, manifest=manifest)
         return 0
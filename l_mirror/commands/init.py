@@ -50,7 +50,15 @@ class init(Command):
     options = [Option("--empty", dest="empty", help="Create the new mirror set"
         " as empty. This is useful when you intend to customise and tuen the"
         " filters for it and don't want to wait for an initial scan to take"
-        " place.", action="store_true", default=False)
+        " place.", action="store_true", default=False),
+        Option("--hash", dest="hash", help="The hash to record file content"
+        " with: sha1 (the default), sha256, or blake2b where available."
+        " blake2b is fastest, but only use it for sets that are not signed.",
+        default=None),
+        Option("--detect-moves", dest="detect_moves", help="Journal renamed"
+        " and moved content as moves, so receivers rename it rather than"
+        " fetching it again. Receivers need an lmirror that supports moves.",
+        action="store_true", default=False),
         ]
 
     def run(self):
@@ -61,7 +69,9 @@ class init(Command):
             content_root = base
         else:
             content_root = self.ui.arguments['content_root'][0]
-        mirror = mirrorset.initialise(base, name, content_root, self.ui)
+        mirror = mirrorset.initialise(base, name, content_root, self.ui,
+            hash_name=self.ui.options.hash,
+            detect_moves=self.ui.options.detect_moves)
         if not self.ui.options.empty:
             mirror.finish_change()
         return 0
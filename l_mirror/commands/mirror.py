@@ -19,11 +19,21 @@
 
 """Mirror an existing mirror set."""
 
-from bzrlib import urlutils
+from optparse import Option
+import socket
+import sys
+import time
+
+from bzrlib import errors, urlutils
 
 from l_mirror.arguments import path, url
 from l_mirror.commands import Command
-from l_mirror import mirrorset
+from l_mirror import bandwidth, mirrorset
+
+# The errors a watching mirror retries after: the source being unreachable, or
+# a receive cut short. Anything else - such as content failing verification -
+# stops it.
+_RETRY_ERRORS = (errors.ConnectionError, socket.error, errors.NoSuchFile)
 
 class mirror(Command):
     """Mirror a mirror set.
@@ -41,10 +51,40 @@ class mirror(Command):
     Mirroring will not generally copy content already present, but the first
     mirror run can still take considerable time. Subsequent runs should be
     extremely fast.
+
+    With --watch the mirror keeps running, and receives each new journal as
+    soon as it is published: smart servers signal new journals, and other
+    sources are checked every --interval seconds. Failed receives are logged
+    and retried after --interval seconds.
     """
 
     args = [url.URLArgument('source_mirror', min=1, max=1),
         path.PathArgument('target_mirror', min=1, max=1)]
+    options = [
+        Option("--bwlimit", dest="bwlimit", help="Limit the rate content is "
+            "received at to this many bytes per second. K, M and G suffixes "
+            "are accepted, e.g. 10M.", default=None),
+        Option("--adaptive", dest="adaptive", help="Slow down receiving when "
+            "writing to disk slows down, so that a receiver limited by its "
+            "disk does not buffer data it cannot yet write.",
+            action="store_true", default=False),
+        Option("--delta", dest="delta", help="Ask smart servers to send "
+            "large changed files as deltas against the local copies, so that "
+            "only the changed parts are transferred.", action="store_true",
+            default=False),
+        Option("--hardlink", dest="hardlink", help="Hardlink files whose "
+            "content is already present locally (for instance renamed or "
+            "duplicate files) rather than receiving them again. Files are "
+            "copied locally when they cannot be hardlinked.",
+            action="store_true", default=False),
+        Option("--watch", dest="watch", help="Keep running, receiving new "
+            "journals as they are published, rather than exiting after one "
+            "receive.", action="store_true", default=False),
+        Option("--interval", dest="interval", help="With --watch, how many "
+            "seconds to wait between checks for new journals on sources "
+            "that cannot signal them (local paths and dumb servers), and "
+            "before retrying a failed receive. Defaults to 60.", type="float", default=60),
+        ]
 
     def run(self):
         source_transport = self.ui.arguments['source_mirror'][0]
@@ -59,5 +99,36 @@ class mirror(Command):
             target = mirrorset.initialise(target_base, name,
                 target_base.clone(source.content_root_path()), self.ui)
             target.cancel_change()
-        target.receive(source)
-        return 0
+        throttle = None
+        if self.ui.options.bwlimit or self.ui.options.adaptive:
+            rate = None
+            if self.ui.options.bwlimit:
+                rate = bandwidth.parse_rate(self.ui.options.bwlimit)
+            throttle = bandwidth.Throttle(rate,
+                adaptive=self.ui.options.adaptive)
+        def receive():
+            target.receive(source, throttle=throttle,
+                delta=self.ui.options.delta,
+                hardlink=self.ui.options.hardlink)
+        if not self.ui.options.watch:
+            receive()
+            return 0
+        interval = self.ui.options.interval
+        while True:
+            try:
+                receive()
+                # The sets, their tree model and connections are reused, so
+                # a receive after waiting costs little more than the new
+                # journals.
+                latest = target.get_latest()[0]
+                while source.get_latest(after=latest, timeout=interval,
+                    interval=interval)[0] <= latest:
+                    pass
+            except _RETRY_ERRORS:
+                # A source that is briefly unreachable, or a receive cut
+                # short, should not stop a watching mirror: the next receive
+                # carries on from the journals already received.
+                self.ui.output_log(8, __name__,
+                    'Receiving %s failed, retrying in %s seconds: %s' %
+                    (source_transport.base, interval, sys.exc_info()[1]))
+                time.sleep(interval)
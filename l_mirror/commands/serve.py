@@ -30,8 +30,9 @@ except ImportError:
 
 from l_mirror.arguments import path, url
 from l_mirror.commands import Command
-from l_mirror import mirrorset
-from l_mirror.server import Server, SetWatcher
+from l_mirror import bandwidth, mirrorset
+from l_mirror.server import (CHANGES_LIMIT, ENGINES, EVENT_JITTER, Server,
+    SetWatcher)
 
 class serve(Command):
     """Serve one or more sets over HTTP.
@@ -53,13 +54,71 @@ class serve(Command):
             "obtaining the URL of the server. This URL is then used by "
             "lmirror finish-change to request a list of candidate changes "
             "to review.", action="store_true", default=False),
+        Option("--inotify-limit", dest="inotify_limit", help="The most "
+            "changed paths to remember for each content root. Past this "
+            "the changes are forgotten, and lmirror finish-change does a full "
+            "scan. Defaults to 1000000.", type="int", default=CHANGES_LIMIT),
+        Option("--inotify-fast-start", dest="inotify_fast_start", help="Save "
+            "the directories found when watching the content tree when the "
+            "server stops, and on the next start skip listing and stating "
+            "the contents of directories that have not changed since. Files "
+            "rewritten in place while the server was stopped are not "
+            "noticed until the next full scan.", action="store_true",
+            default=False),
         Option("--port", "-p", dest="port", help="Control what port the server "
             "runs on. Use 0 to auto-allocate a port. Defaults to 8080.",
             action="store_true", default=8080),
+        Option("--journal-cache", dest="journal_cache", help="The number of "
+            "megabytes of combined journals to keep in memory for serving "
+            "streams. Defaults to 64.", type="int", default=64),
+        Option("--engine", dest="engine", help="The HTTP server engine to use. "
+            "'paste' uses a pool of threads, one per active request. 'event' "
+            "serves every connection from a single event loop, and can serve "
+            "thousands of concurrent streams. Defaults to paste.",
+            type="choice", choices=ENGINES, default='paste'),
+        Option("--bwlimit", dest="bwlimit", help="Limit the total bandwidth "
+            "used to send content to this many bytes per second. K, M and G "
+            "suffixes are accepted, e.g. 10M.", default=None),
+        Option("--set-bwlimit", dest="set_bwlimit", help="Limit the bandwidth "
+            "used to send the content of one set, given as NAME=RATE. May be "
+            "given more than once.", action="append", default=None),
+        Option("--client-bwlimit", dest="client_bwlimit", help="Limit the "
+            "bandwidth used to send content to each client address.",
+            default=None),
+        Option("--event-jitter", dest="event_jitter", help="The most seconds "
+            "to delay telling each client waiting on /events/ about a new "
+            "journal, so that they do not all fetch it at once. Defaults to "
+            "10.", type="float", default=EVENT_JITTER),
         ]
 
+    def _get_shaper(self):
+        """Create a bandwidth.Shaper for the limit options, if any."""
+        options = self.ui.options
+        if not (options.bwlimit or options.set_bwlimit or
+            options.client_bwlimit):
+            return None
+        rate = None
+        if options.bwlimit:
+            rate = bandwidth.parse_rate(options.bwlimit)
+        set_rates = {}
+        for set_limit in options.set_bwlimit or ():
+            name, sep, set_rate = set_limit.partition('=')
+            if not sep:
+                raise ValueError('invalid set limit %r: expected NAME=RATE' %
+                    set_limit)
+            set_rates[name] = bandwidth.parse_rate(set_rate)
+        client_rate = None
+        if options.client_bwlimit:
+            client_rate = bandwidth.parse_rate(options.client_bwlimit)
+        return bandwidth.Shaper(rate, set_rates, client_rate)
+
     def run(self):
-        server = Server(self.ui)
+        shaper = self._get_shaper()
+        server = Server(self.ui,
+            journal_cache_size=self.ui.options.journal_cache * 1024 * 1024,
+            engine=self.ui.options.engine)
+        server.shaper = shaper
+        server.event_jitter = self.ui.options.event_jitter
         server.start(self.ui.options.port)
         try:
             try:
@@ -80,14 +139,19 @@ class serve(Command):
                         self.ui.output_log(9, __name__, "inotify requested, "
                             "but pyinotify could not be imported.")
                     else:
-                        watcher = SetWatcher()
+                        watcher = SetWatcher(self.ui.options.inotify_limit,
+                            self.ui.options.inotify_fast_start)
                         server.set_watcher = watcher
                         try:
                             for mirror in server.mirrorsets.values():
                                 mirror.set_server(server.addresses[0])
                                 watcher.add(mirror)
+                            # Changes can be asked for while the content is
+                            # walked in the background.
+                            watcher.start()
                             watcher.notifier.loop()
                         finally:
+                            watcher.save_index()
                             for mirror in server.mirrorsets.values():
                                 mirror.set_server(None)
                 if pyinotify is None or not self.ui.options.inotify:
@@ -0,0 +1,99 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+# 
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+# 
+"""Watch one or more sets for changes."""
+
+from optparse import Option
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from l_mirror.arguments import url
+from l_mirror.commands import Command
+from l_mirror import mirrorset
+from l_mirror.server import CHANGES_LIMIT, SetWatcher
+
+class watch(Command):
+    """Watch one or more sets for changes using inotify.
+
+    While running, the changes made within the content of each set are
+    written to a change log in its .lmirror/metadata/<set>/ directory, and
+    lmirror finish-change reads that log rather than scanning the whole tree.
+    Unlike serve --inotify no server is needed. The log is removed when the
+    watcher stops.
+
+    The special set name 'all' can be used to tell lmirror to find all the sets
+    defined at a location.
+    """
+
+    args = [url.URLArgument('sets', min=1, max=None),
+        ]
+    options = [
+        Option("--limit", dest="limit", help="The most changes to remember "
+            "for each content root. Past this the changes are forgotten, and "
+            "lmirror finish-change does a full scan. Defaults to 1000000.",
+            type="int", default=CHANGES_LIMIT),
+        Option("--fast-start", dest="fast_start", help="Save the directories "
+            "found when watching the content tree when the watcher stops, "
+            "and on the next start skip listing and stating the contents of "
+            "directories that have not changed since. Files rewritten in "
+            "place while the watcher was stopped are not noticed until the "
+            "next full scan.", action="store_true", default=False),
+        Option("--refresh", dest="refresh", help="How often, in seconds, to "
+            "check for updated sets and discard the changes they have been "
+            "updated past. Defaults to 60.", type="float", default=60),
+        ]
+
+    def run(self):
+        if pyinotify is None:
+            raise ValueError('watching needs pyinotify, which could not be '
+                'imported.')
+        watcher = SetWatcher(self.ui.options.limit, self.ui.options.fast_start,
+            logs=True)
+        try:
+            try:
+                for transport in self.ui.arguments['sets']:
+                    base = transport.clone('..')
+                    name = base.relpath(transport.base)
+                    if name == 'all':
+                        names = base.list_dir('.lmirror/sets')
+                    else:
+                        names = [name]
+                    for name in names:
+                        watcher.add(mirrorset.MirrorSet(base, name, self.ui))
+                watcher.start()
+                notifier = watcher.notifier
+                interval = self.ui.options.refresh
+                next_refresh = time.time() + interval
+                while True:
+                    timeout = max(0, next_refresh - time.time())
+                    if notifier.check_events(int(timeout * 1000)):
+                        notifier.read_events()
+                        notifier.process_events()
+                    if time.time() >= next_refresh:
+                        watcher.refresh()
+                        next_refresh = time.time() + interval
+            except KeyboardInterrupt:
+                return 0
+        finally:
+            watcher.save_index()
+            watcher.close()
+        return 0
@@ -0,0 +1,262 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Delta transfer of replaced files.
+
+Files are split into chunks at content defined boundaries (see iter_chunks),
+so that an edit to a file changes only the chunks around the edit. The
+signature of a file lists the length and sha1 of each of its chunks. A
+receiver with an old version of a file and the signature of the new version
+copies the chunks it already has from the old version and fetches only the
+rest from the new version - much like zsync, the receiver does the work and
+the sender just answers range requests.
+
+Chunk boundaries fall at the ends of lines, so this works best for line
+oriented text such as Packages and Contents files; content without newlines is
+split into fixed size chunks.
+"""
+
+__all__ = ['iter_chunks', 'signature', 'parse_signature', 'DeltaSource',
+    'DeltaFile']
+
+from hashlib import sha1 as sha
+import struct
+import zlib
+
+from bzrlib import errors
+
+# No chunk ends less than MIN_CHUNK bytes in, every chunk ends by MAX_CHUNK
+# bytes, and in between a chunk ends after a line whose crc32 has none of the
+# BOUNDARY_MASK bits set - on average one line in sixteen.
+MIN_CHUNK = 4096
+MAX_CHUNK = 65536
+BOUNDARY_MASK = 0xf
+# Smaller files are sent whole.
+MIN_DELTA_SIZE = 65536
+# The most new content fetched in one request.
+MAX_FETCH = 1048576
+
+_ENTRY = struct.Struct('>I20s')
+
+
+def _boundary(data):
+    """Find the end of the first chunk in data.
+
+    :return: The offset the chunk ends at, or None if there is no boundary in
+        the first MAX_CHUNK bytes of data.
+    """
+    end = data.find('\n', MIN_CHUNK - 1)
+    while end != -1 and end < MAX_CHUNK:
+        start = data.rfind('\n', 0, end) + 1
+        if not zlib.crc32(data[start:end + 1]) & BOUNDARY_MASK:
+            return end + 1
+        end = data.find('\n', end + 1)
+    return None
+
+
+def iter_chunks(a_file):
+    """Split the content of a_file into chunks.
+
+    :return: A generator of bytestrings.
+    """
+    data = ''
+    eof = False
+    while True:
+        while not eof and len(data) < MAX_CHUNK:
+            read_content = a_file.read(MAX_CHUNK)
+            if not read_content:
+                eof = True
+            data += read_content
+        if not data:
+            return
+        end = _boundary(data)
+        if end is None:
+            end = MAX_CHUNK
+        yield data[:end]
+        data = data[end:]
+
+
+def signature(a_file):
+    """Calculate the signature of the content of a_file.
+
+    :return: A bytestring with a 4 byte length and the 20 byte sha1 digest of
+        each chunk of the content.
+    """
+    return ''.join(_ENTRY.pack(len(chunk), sha(chunk).digest())
+        for chunk in iter_chunks(a_file))
+
+
+def parse_signature(signature_bytes):
+    """Parse a signature.
+
+    :return: A list of (offset, length, digest) tuples, one per chunk.
+    """
+    if len(signature_bytes) % _ENTRY.size:
+        raise ValueError('bad signature length %d' % len(signature_bytes))
+    chunks = []
+    offset = 0
+    for pos in range(0, len(signature_bytes), _ENTRY.size):
+        length, digest = _ENTRY.unpack_from(signature_bytes, pos)
+        chunks.append((offset, length, digest))
+        offset += length
+    return chunks
+
+
+class DeltaSource(object):
+    """Where a receiver gets the content of files sent as deltas.
+
+    It is also where a receiver fetches whole files that a stream does not
+    carry, such as the content of a moved file whose source is missing.
+
+    :ivar basis: None, or the transport with the receiver's existing content.
+    :ivar content: The transport to fetch ranges of new content from.
+    :ivar blobs: None, or a transport to fetch ranges of new content from by
+        sha1 rather than by path. As content fetched by sha1 never changes,
+        HTTP caches can share it between paths and mirror sets.
+    """
+
+    def __init__(self, basis, content, blobs=None):
+        self.basis = basis
+        self.content = content
+        self.blobs = blobs
+
+    def get_file(self, path, signature_bytes, length, sha1=None):
+        """Get a file-like object for the new content of path.
+
+        :param signature_bytes: The signature of the new content.
+        :param length: The length of the new content.
+        :param sha1: The sha1 of the new content, used to fetch it from blobs.
+        """
+        return DeltaFile(path, parse_signature(signature_bytes), length,
+            self.basis, self.content, self.blobs, sha1)
+
+    def get_whole_file(self, path, sha1=None):
+        """Get a file-like object for the whole new content of path.
+
+        :param sha1: The sha1 of the new content, used to fetch it from blobs.
+        """
+        if self.blobs is not None and sha1 is not None:
+            try:
+                return self.blobs.get(sha1)
+            except errors.NoSuchFile:
+                # Not a server that serves blobs.
+                pass
+        return self.content.get(path)
+
+
+class DeltaFile(object):
+    """A file-like object which reconstructs a file from its signature.
+
+    Chunks already in the basis are copied from it, and the rest are fetched
+    from the blobs transport by sha1 if there is one, and otherwise from the
+    content transport by path, with readv. Nothing is read until the first
+    read, so an unwanted DeltaFile can just be closed.
+    """
+
+    def __init__(self, path, chunks, length, basis, content, blobs=None,
+        sha1=None):
+        total = sum(chunk[1] for chunk in chunks)
+        if total != length:
+            raise ValueError('signature for %r covers %d bytes, not %d' % (
+                path, total, length))
+        self.path = path
+        self.chunks = chunks
+        self.basis = basis
+        self.content = content
+        if sha1 is None:
+            blobs = None
+        self.blobs = blobs
+        self.sha1 = sha1
+        self._basis_file = None
+        self._pieces = None
+        self._buffered = ''
+
+    def read(self, count=None):
+        if self._pieces is None:
+            self._pieces = self._iter_pieces()
+        if count is None or count < 0:
+            result = [self._buffered]
+            result.extend(self._pieces)
+            self._buffered = ''
+            return ''.join(result)
+        while not self._buffered:
+            try:
+                self._buffered = self._pieces.next()
+            except StopIteration:
+                return ''
+        result = self._buffered[:count]
+        self._buffered = self._buffered[count:]
+        return result
+
+    def close(self):
+        if self._basis_file is not None:
+            self._basis_file.close()
+            self._basis_file = None
+
+    def _index_basis(self):
+        """Index the chunks of the basis file by digest."""
+        try:
+            self._basis_file = self.basis.get(self.path)
+        except errors.PathError:
+            return {}
+        index = {}
+        offset = 0
+        for chunk in iter_chunks(self._basis_file):
+            index.setdefault(sha(chunk).digest(), (offset, len(chunk)))
+            offset += len(chunk)
+        return index
+
+    def _iter_pieces(self):
+        index = self._index_basis()
+        fetch_start = None
+        fetch_length = 0
+        for offset, length, digest in self.chunks:
+            if digest not in index:
+                if fetch_start is None:
+                    fetch_start = offset
+                fetch_length += length
+                if fetch_length >= MAX_FETCH:
+                    for content in self._fetch(fetch_start, fetch_length):
+                        yield content
+                    fetch_start, fetch_length = None, 0
+                continue
+            if fetch_start is not None:
+                for content in self._fetch(fetch_start, fetch_length):
+                    yield content
+                fetch_start, fetch_length = None, 0
+            basis_offset, basis_length = index[digest]
+            self._basis_file.seek(basis_offset)
+            yield self._basis_file.read(basis_length)
+        if fetch_start is not None:
+            for content in self._fetch(fetch_start, fetch_length):
+                yield content
+
+    def _fetch(self, offset, length):
+        if self.blobs is not None:
+            try:
+                ranges = list(self.blobs.readv(self.sha1, [(offset, length)]))
+            except errors.NoSuchFile:
+                # Not a server that serves blobs.
+                self.blobs = None
+            else:
+                for _, content in ranges:
+                    yield content
+                return
+        for _, content in self.content.readv(self.path, [(offset, length)]):
+            yield content
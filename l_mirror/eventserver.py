@@ -0,0 +1,668 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""An event loop WSGI server for serving many concurrent streams.
+
+paste's httpserver uses a thread per active request, so long lived stream
+responses to slow receivers quickly exhaust its thread pool. EventServer
+instead multiplexes every connection onto a single thread with epoll (or poll
+where epoll is not available), and only pulls more data from a response when
+the connection has drained what it already had. This bounds the memory used
+per connection to roughly one chunk of its response.
+
+Producing a response can take a while - combining journals that are not
+cached, calculating a delta signature or compressing file content - so the
+application is called, and each chunk of its response got, by one of
+WORKER_THREADS worker threads. Meanwhile the connection is not polled and the
+event loop carries on with the others; it only sends what the workers have
+produced.
+
+Response iterables are driven cooperatively. As well as bytestrings they may
+yield:
+
+* journals.FileSegment objects, which are sent with sendfile when the sendfile
+  module is available. 'lmirror.file_segments' is set in the environ.
+
+* NOT_READY, which means that the response has nothing to send yet and
+  should be polled again after POLL_INTERVAL. Responses must not block instead
+  as that would stall every other connection; 'lmirror.cooperative' is set in
+  the environ to tell applications that this convention is in use. Empty
+  strings are sent (as nothing) like any other bytestring, so responses such
+  as paste's [''] for HEAD requests finish at once.
+
+Only what lmirror needs of HTTP/1.1 is implemented: persistent connections
+(when the response has a Content-Length), and requests with small bodies.
+"""
+
+__all__ = ['EventServer', 'NOT_READY']
+
+from collections import deque
+from email.utils import formatdate
+import errno
+import logging
+import os
+import select
+import socket
+from Queue import Queue
+from StringIO import StringIO
+import sys
+import threading
+import time
+import urllib
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+from l_mirror import journals
+
+# How much of a FileSegment to read at once when sendfile is not available.
+SEGMENT_READ_SIZE = 65536
+# The largest request line and headers accepted.
+MAX_REQUEST_HEAD = 65536
+# The largest request body accepted.
+MAX_REQUEST_BODY = 1024 * 1024
+# How long to wait before polling a response which was not ready, in seconds.
+POLL_INTERVAL = 0.05
+# Yielded by a response which has nothing to send yet.
+NOT_READY = object()
+# How many threads call the application and iterate over its responses.
+WORKER_THREADS = 4
+# The chunk of a connection which is not waiting to be sent.
+_NO_CHUNK = object()
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+ERRORS = select.POLLERR | select.POLLHUP
+
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+_logger = logging.getLogger('l_mirror.eventserver')
+
+
+class EventServer(object):
+    """A single threaded, event driven WSGI server.
+
+    This has the subset of the interface of paste's httpserver that
+    l_mirror.server.Server uses: serve_forever, server_close and server_port.
+
+    :ivar application: The WSGI application being served.
+    :ivar server_port: The port being listened on.
+    :ivar connections: A dict of socket fd -> connection.
+    """
+
+    def __init__(self, application, host, port, backlog=1024):
+        """Create an EventServer listening on host:port.
+
+        :param application: The WSGI application to serve.
+        :param backlog: The listen backlog for the server socket.
+        """
+        self.application = application
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        self.socket.setblocking(0)
+        self.server_name, self.server_port = self.socket.getsockname()[:2]
+        self.connections = {}
+        # Connections whose response was not ready -> when to poll them.
+        self._waiting = {}
+        # Connections waiting for a worker to get their next chunk, and
+        # those with a chunk waiting for the event loop to send it.
+        self._fetches = Queue()
+        self._fetched = deque()
+        self._workers = []
+        self._running = True
+        # Guards _running and _closed against server_close racing the event
+        # loop closing the wakeup pipe.
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wake_read, self._wake_write = os.pipe()
+        self._poller = _Poller()
+        self._poller.register(self.socket.fileno(), READ)
+        self._poller.register(self._wake_read, READ)
+
+    def serve_forever(self):
+        """Serve requests until server_close is called."""
+        for _ in range(WORKER_THREADS):
+            worker = threading.Thread(target=self._run_fetches)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        try:
+            while self._running:
+                self.handle_events()
+        finally:
+            self._cleanup()
+
+    def server_close(self):
+        """Stop serving.
+
+        Unlike paste's server, active requests are not completed: their
+        connections are closed when the event loop exits.
+        """
+        self._lock.acquire()
+        try:
+            self._running = False
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def _wake(self):
+        """Wake the event loop up."""
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                os.write(self._wake_write, 'x')
+        finally:
+            self._lock.release()
+
+    def handle_events(self):
+        """Wait for and handle one round of events."""
+        timeout = None
+        if self._waiting:
+            timeout = max(0, min(self._waiting.values()) - time.time())
+        for fd, event in self._poller.poll(timeout):
+            if fd == self._wake_read:
+                os.read(self._wake_read, 4096)
+                while self._fetched:
+                    self._fetched.popleft().fetch_done()
+            elif fd == self.socket.fileno():
+                self._accept()
+            else:
+                connection = self.connections.get(fd)
+                if connection is not None:
+                    connection.handle_event(event)
+        if self._waiting:
+            now = time.time()
+            for connection, when in self._waiting.items():
+                if when <= now:
+                    del self._waiting[connection]
+                    connection.resume()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in _RETRY_ERRORS:
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                    errno.ENOMEM, errno.ECONNABORTED):
+                    # Leave the connection in the backlog for now.
+                    _logger.warning('Could not accept connection: %s', e)
+                    return
+                raise
+            sock.setblocking(0)
+            connection = _Connection(self, sock, address)
+            self.connections[connection.fd] = connection
+            self._poller.register(connection.fd, READ)
+
+    def _run_fetches(self):
+        while True:
+            connection = self._fetches.get()
+            if connection is None:
+                return
+            connection.fetch()
+            self._fetched.append(connection)
+            self._wake()
+
+    def _fetch(self, connection):
+        """Get the next chunk for connection in a worker thread.
+
+        The connection is not polled until the chunk has been got.
+        """
+        self._poller.unregister(connection.fd)
+        self._fetches.put(connection)
+
+    def _cleanup(self):
+        for connection in self.connections.values():
+            connection.close()
+        for _ in self._workers:
+            self._fetches.put(None)
+        for worker in self._workers:
+            worker.join()
+        # Close the responses of connections closed while being fetched.
+        while self._fetched:
+            self._fetched.popleft().fetch_done()
+        self._poller.close()
+        self.socket.close()
+        self._lock.acquire()
+        try:
+            self._closed = True
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+        finally:
+            self._lock.release()
+
+    def _modify(self, connection, mask):
+        self._poller.modify(connection.fd, mask)
+
+    def _park(self, connection):
+        self._waiting[connection] = time.time() + POLL_INTERVAL
+
+    def _remove(self, connection):
+        self._waiting.pop(connection, None)
+        if (self.connections.pop(connection.fd, None) is not None and
+            not connection.fetching):
+            self._poller.unregister(connection.fd)
+
+
+class _Connection(object):
+    """A connection to a client of an EventServer.
+
+    A connection is either reading a request, or sending the response to
+    one. While a worker thread is calling the application or getting the
+    next chunk of the response (fetching), only it touches the connection.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.mask = READ
+        self.inbuf = ''
+        self.closed = False
+        self.fetching = False
+        self._reset()
+
+    def _reset(self):
+        self.outbuf = ''
+        self.response = None
+        self.iterator = None
+        # A FileSegment being sent, and the offset and length still to send.
+        self.segment = None
+        self.segment_offset = 0
+        self.segment_remaining = 0
+        self.version = 'HTTP/1.0'
+        self.status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.keep_alive = False
+        # The request to call the application for, the chunk got by a
+        # worker, and the error to log if getting it failed.
+        self._environ = None
+        self._chunk = _NO_CHUNK
+        self._fetch_error = None
+
+    def handle_event(self, event):
+        if self.iterator is None:
+            if event & (READ | ERRORS):
+                self.read()
+        elif event & ERRORS:
+            self.close()
+        elif event & WRITE:
+            self.write()
+
+    def read(self):
+        """Read from the socket and start any complete request."""
+        try:
+            data = self.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] not in _RETRY_ERRORS:
+                self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.inbuf += data
+        self._process_request()
+
+    def _process_request(self):
+        end = self.inbuf.find('\r\n\r\n')
+        if end == -1:
+            if len(self.inbuf) > MAX_REQUEST_HEAD:
+                self._reply_error('400 Bad Request')
+            return
+        lines = self.inbuf[:end].split('\r\n')
+        request_line = lines[0].split()
+        if len(request_line) != 3:
+            self._reply_error('400 Bad Request')
+            return
+        method, uri, version = request_line
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().upper().replace('-', '_')] = value.strip()
+        try:
+            content_length = int(headers.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._reply_error('400 Bad Request')
+            return
+        if content_length > MAX_REQUEST_BODY:
+            self._reply_error('413 Request Entity Too Large')
+            return
+        body_start = end + 4
+        if len(self.inbuf) - body_start < content_length:
+            # Wait for the rest of the body.
+            return
+        body = self.inbuf[body_start:body_start + content_length]
+        self.inbuf = self.inbuf[body_start + content_length:]
+        if uri.startswith('http://'):
+            # An absolute URI: drop the scheme and host.
+            uri = '/' + uri[7:].partition('/')[2]
+        path, _, query = uri.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': self.address[0],
+            'REMOTE_PORT': str(self.address[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'lmirror.file_segments': True,
+            'lmirror.cooperative': True,
+            }
+        for name, value in headers.items():
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                environ['HTTP_' + name] = value
+        self.version = version
+        self.keep_alive = (version == 'HTTP/1.1' and
+            headers.get('CONNECTION', '').lower() != 'close')
+        self._environ = environ
+        self._fetch()
+
+    def _fetch(self):
+        """Have a worker thread get the next chunk of the response."""
+        self.fetching = True
+        self.mask = 0
+        self.server._fetch(self)
+
+    def fetch(self):
+        """Get the next chunk of the response, calling the application first
+        if it has not been called.
+
+        This is run by a worker thread, and must not touch the socket or the
+        server.
+        """
+        if self._environ is not None:
+            environ = self._environ
+            self._environ = None
+            try:
+                self.response = self.server.application(environ,
+                    self._start_response)
+                self.iterator = iter(self.response)
+            except Exception:
+                self._fetch_error = ('Error calling WSGI application for %s',
+                    environ['PATH_INFO'], sys.exc_info())
+                return
+        try:
+            self._chunk = self.iterator.next()
+        except StopIteration:
+            self._chunk = None
+        except Exception:
+            self._fetch_error = ('Error in WSGI response', None,
+                sys.exc_info())
+
+    def fetch_done(self):
+        """Carry on with a connection once a worker has got its chunk."""
+        self.fetching = False
+        if self.closed:
+            self._close_response()
+            return
+        self.server._poller.register(self.fd, WRITE)
+        self.mask = WRITE
+        if self._fetch_error is not None:
+            message, arg, exc_info = self._fetch_error
+            self._fetch_error = None
+            args = (message,)
+            if arg is not None:
+                args += (arg,)
+            _logger.error(*args, exc_info=exc_info)
+            self._fail()
+        self.write()
+
+    def _start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('start_response called a second time')
+        self.status = status
+        self.response_headers = headers
+        return self._write_bytes
+
+    def _write_bytes(self, content):
+        """The write callable returned by start_response."""
+        self._send_headers()
+        self.outbuf += content
+
+    def _send_headers(self):
+        if self.headers_sent:
+            return
+        if self.status is None:
+            raise RuntimeError('Content returned before start_response called')
+        self.headers_sent = True
+        lines = ['%s %s' % (self.version, self.status)]
+        has_length = False
+        has_date = False
+        for name, value in self.response_headers:
+            lower_name = name.lower()
+            if lower_name == 'content-length':
+                has_length = True
+            elif lower_name == 'date':
+                has_date = True
+            elif lower_name == 'connection' and value.lower() == 'close':
+                self.keep_alive = False
+            lines.append('%s: %s' % (name, value))
+        if not has_date:
+            lines.append('Date: %s' % formatdate(usegmt=True))
+        if not has_length:
+            # The end of the response is signalled by closing.
+            self.keep_alive = False
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        lines.append('\r\n')
+        self.outbuf += '\r\n'.join(lines)
+
+    def _reply_error(self, status):
+        """Reply to a request that could not be parsed, and close."""
+        self.inbuf = ''
+        self._fail(status)
+        self._want(WRITE)
+        self.write()
+
+    def _fail(self, status='500 Internal Server Error'):
+        if self.headers_sent:
+            self.close()
+            return
+        self._close_response()
+        message = status + '\n'
+        self.status = status
+        self.response_headers = [('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(message)))]
+        self.keep_alive = False
+        self.outbuf = ''
+        self.segment = None
+        self._chunk = _NO_CHUNK
+        self.iterator = iter([message])
+
+    def write(self):
+        """Send as much of the response as the socket will take."""
+        while not self.closed:
+            if self.outbuf:
+                try:
+                    sent = self.socket.send(self.outbuf)
+                except socket.error, e:
+                    if e.args[0] not in _RETRY_ERRORS:
+                        self.close()
+                    return
+                self.outbuf = self.outbuf[sent:]
+                if self.outbuf:
+                    # Wait until the socket is writable.
+                    return
+            elif self.segment is not None:
+                if not self._send_segment():
+                    return
+            elif self.iterator is None:
+                return
+            elif self._chunk is _NO_CHUNK:
+                self._fetch()
+                return
+            else:
+                chunk = self._chunk
+                self._chunk = _NO_CHUNK
+                if chunk is NOT_READY:
+                    # Poll again later.
+                    self._want(0)
+                    self.server._park(self)
+                    return
+                try:
+                    self._send_headers()
+                except RuntimeError:
+                    _logger.exception('Error in WSGI response')
+                    self._fail()
+                    continue
+                if chunk is None:
+                    if not self.outbuf:
+                        self._finish()
+                        return
+                    # Finish once the buffer is sent.
+                    self._chunk = None
+                elif isinstance(chunk, journals.FileSegment):
+                    self.segment = chunk
+                    self.segment_offset = chunk.offset
+                    self.segment_remaining = chunk.length
+                else:
+                    self.outbuf += chunk
+
+    def resume(self):
+        """Resume a response that was not ready."""
+        self._want(WRITE)
+        self.write()
+
+    def _send_segment(self):
+        """Send some of the current segment.
+
+        :return: True if the caller should carry on writing.
+        """
+        segment = self.segment
+        if sendfile is None:
+            segment.file.seek(self.segment_offset)
+            content = segment.file.read(min(self.segment_remaining,
+                SEGMENT_READ_SIZE))
+            sent = len(content)
+            self.outbuf += content
+        else:
+            try:
+                sent = sendfile(self.fd, segment.file.fileno(),
+                    self.segment_offset, self.segment_remaining)
+            except OSError, e:
+                if e.args[0] in _RETRY_ERRORS:
+                    return False
+                self.close()
+                return False
+        if not sent:
+            _logger.error('%r is shorter than expected', segment)
+            self.close()
+            return False
+        self.segment_offset += sent
+        self.segment_remaining -= sent
+        if not self.segment_remaining:
+            self.segment = None
+        return True
+
+    def _finish(self):
+        """The response has been sent."""
+        self._close_response()
+        if not self.keep_alive:
+            self.close()
+            return
+        self._reset()
+        self._want(READ)
+        if self.inbuf:
+            self._process_request()
+
+    def _want(self, mask):
+        if mask != self.mask and not self.closed:
+            self.mask = mask
+            self.server._modify(self, mask)
+
+    def _close_response(self):
+        response = self.response
+        self.response = None
+        self.iterator = None
+        if hasattr(response, 'close'):
+            try:
+                response.close()
+            except Exception:
+                _logger.exception('Error closing WSGI response')
+
+    def close(self):
+        """Close the connection, abandoning any response."""
+        if self.closed:
+            return
+        if not self.fetching:
+            # Otherwise fetch_done closes it.
+            self._close_response()
+        self.server._remove(self)
+        self.closed = True
+        self.socket.close()
+
+
+class _Poller(object):
+    """A wrapper for epoll or poll, taking timeouts in seconds."""
+
+    def __init__(self):
+        if getattr(select, 'epoll', None) is not None:
+            self._poll = select.epoll()
+            self._scale = 1
+        else:
+            self._poll = select.poll()
+            self._scale = 1000
+
+    def register(self, fd, mask):
+        self._poll.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self._poll.modify(fd, mask)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self._scale
+        try:
+            return self._poll.poll(timeout)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if getattr(self._poll, 'close', None) is not None:
+            self._poll.close()
@@ -0,0 +1,311 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Caches kept by the root node of a set to avoid rereading file content.
+
+When finish-change hashes a file, a HashCache records its digest against a
+fingerprint of its stat result, so that a later scan or the server verifying
+content before serving it can reuse the digest instead of reading the file
+again. Files which changed within 3 seconds of being hashed are not recorded,
+as a change in the same second might not alter their fingerprint.
+
+A SmallFiles pack keeps the content of small files read while hashing them,
+by digest. New files are streamed from the pack rather than reread from all
+over the content root - one sequential read of recently written data, which
+the page cache usually still holds.
+
+Both are configured with 'cache KIND' lines in a set's content.conf, and kept
+in the set's metadata directory. Neither is needed: a missing or damaged
+cache is ignored, and content is then read from disk as usual.
+"""
+
+__all__ = ['fingerprint', 'HashCache', 'SmallFiles', 'CACHES']
+
+import time
+
+from bzrlib import errors
+
+HASH_CACHE = 'hashcache'
+HASH_CACHE_HEADER = 'l-mirror-hashcache-1\n'
+# A hash cache is rewritten when it holds this many more records than twice
+# the files it knows.
+HASH_CACHE_SLACK = 10000
+SMALL_FILES = 'smallfiles'
+SMALL_FILES_HEADER = 'l-mirror-smallfiles-1\n'
+# The largest file kept in a SmallFiles pack by default.
+SMALL_FILE_SIZE = 65536
+# A pack is started afresh rather than grown past this size.
+PACK_LIMIT = 64 * 1024 * 1024
+# Added content is written to the pack once this much is pending.
+PENDING_LIMIT = 4 * 1024 * 1024
+# The kinds of 'cache' line allowed in content.conf.
+CACHES = ('hashes', 'small-files')
+
+
+def fingerprint(statinfo):
+    """Get the fingerprint of a stat result.
+
+    :return: A bytestring which changes when the file is changed or replaced.
+    """
+    return '%d %f %d %f' % (statinfo.st_size,
+        getattr(statinfo, 'st_mtime', 0) or 0,
+        getattr(statinfo, 'st_ino', 0) or 0,
+        getattr(statinfo, 'st_ctime', 0) or 0)
+
+
+class HashCache(object):
+    """The digests of files, by path and stat fingerprint.
+
+    On disk the cache is a header followed by records of '\\0' terminated
+    tokens: PATH, DIGEST and FINGERPRINT for a file, or PATH and two empty
+    tokens for a file that was forgotten. Later records replace earlier ones,
+    so saving appends just the records for the changes since the cache was
+    loaded. When the records outnumber twice the files by more than
+    HASH_CACHE_SLACK, the cache is rewritten with one record per file.
+
+    :ivar transport: The transport the cache is kept in.
+    :ivar changed: True if the cache has changed since it was loaded.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.changed = False
+        self._entries = None
+        # The records in the cache on disk, or None if there is no usable
+        # cache there to append to.
+        self._records = None
+        self._pending = []
+
+    def _get_entries(self):
+        if self._entries is None:
+            entries = {}
+            try:
+                content = self.transport.get_bytes(HASH_CACHE)
+            except errors.NoSuchFile:
+                content = ''
+            if content.startswith(HASH_CACHE_HEADER):
+                tokens = content[len(HASH_CACHE_HEADER):].split('\x00')
+                self._records = 0
+                for pos in range(0, len(tokens) - 2, 3):
+                    if tokens[pos + 1]:
+                        entries[tokens[pos]] = (
+                            tokens[pos + 1], tokens[pos + 2])
+                    else:
+                        entries.pop(tokens[pos], None)
+                    self._records += 1
+                if len(tokens) % 3 != 1:
+                    # A record was cut short: rewrite the cache rather than
+                    # append to it.
+                    self._records = None
+            self._entries = entries
+        return self._entries
+
+    def get(self, path, statinfo):
+        """Get the digest of path.
+
+        :param statinfo: The stat result for path.
+        :return: The digest, formatted as for FileContent.sha1, or None if
+            path has changed since it was recorded or was never recorded.
+        """
+        entry = self._get_entries().get(path)
+        if entry is None or entry[1] != fingerprint(statinfo):
+            return None
+        return entry[0]
+
+    def add(self, path, statinfo, digest):
+        """Record the digest of path.
+
+        :param statinfo: The stat result for path, taken before it was read.
+        """
+        if time.time() - (getattr(statinfo, 'st_mtime', 0) or 0) <= 3:
+            self.remove(path)
+            return
+        entry = (digest, fingerprint(statinfo))
+        entries = self._get_entries()
+        if entries.get(path) == entry:
+            return
+        entries[path] = entry
+        self._pending.append('%s\x00%s\x00%s\x00' % (path, digest, entry[1]))
+        self.changed = True
+
+    def remove(self, path):
+        """Forget path, if it is recorded."""
+        if self._get_entries().pop(path, None) is not None:
+            self._pending.append('%s\x00\x00\x00' % path)
+            self.changed = True
+
+    def save(self):
+        """Write the cache if it has changed."""
+        if not self.changed:
+            return
+        if (self._records is None or self._records + len(self._pending) >
+            2 * len(self._entries) + HASH_CACHE_SLACK):
+            content = [HASH_CACHE_HEADER]
+            for path, (digest, stamp) in sorted(self._entries.iteritems()):
+                content.append('%s\x00%s\x00%s\x00' % (path, digest, stamp))
+            self.transport.put_bytes(HASH_CACHE, ''.join(content))
+            self._records = len(self._entries)
+        else:
+            self.transport.append_bytes(HASH_CACHE, ''.join(self._pending))
+            self._records += len(self._pending)
+        self._pending = []
+        self.changed = False
+
+
+class SmallFiles(object):
+    """The content of small files, by digest.
+
+    The content is appended to a pack file, and an index file - a header, the
+    name of the pack and a newline, then '\\0' terminated tokens DIGEST,
+    OFFSET and LENGTH for each file - says where. Added content is written to
+    the pack whenever PENDING_LIMIT bytes of it are pending, and the index
+    when the SmallFiles is saved. When the pack would grow past PACK_LIMIT a
+    new pack is started under a new name and the old one removed once the
+    index is saved, so that readers of the old index find no pack rather
+    than the wrong content.
+
+    :ivar transport: The transport the pack and index are kept in.
+    :ivar max_size: The largest file to keep.
+    """
+
+    def __init__(self, transport, max_size=SMALL_FILE_SIZE):
+        self.transport = transport
+        self.max_size = max_size
+        self._index = None
+        self._pack = None
+        self._pack_size = 0
+        self._fresh = True
+        self._pending = []
+        self._pending_size = 0
+        self._unsaved = {}
+        # Whether the index has changed since it was written, and the packs
+        # to remove once it is.
+        self._changed = False
+        self._old_packs = []
+
+    def _get_index(self):
+        if self._index is None:
+            index = {}
+            self._pack = '%s.0' % SMALL_FILES
+            self._pack_size = 0
+            try:
+                content = self.transport.get_bytes(SMALL_FILES)
+            except errors.NoSuchFile:
+                content = ''
+            if content.startswith(SMALL_FILES_HEADER):
+                pack, _, content = content[
+                    len(SMALL_FILES_HEADER):].partition('\n')
+                self._pack = pack
+                self._fresh = False
+                tokens = content.split('\x00')
+                for pos in range(0, len(tokens) - 2, 3):
+                    offset = int(tokens[pos + 1])
+                    length = int(tokens[pos + 2])
+                    index[tokens[pos]] = (offset, length)
+                    self._pack_size = max(self._pack_size, offset + length)
+            self._index = index
+        return self._index
+
+    def wants(self, statinfo):
+        """Return True if a file with stat result statinfo should be kept."""
+        return statinfo.st_size <= self.max_size
+
+    def add(self, digest, content):
+        """Keep content, which has digest."""
+        index = self._get_index()
+        if digest in index:
+            return
+        if (self._pack_size + len(content) > PACK_LIMIT and
+            self._pack_size > self._pending_size):
+            self._start_pack()
+            index = self._index
+        index[digest] = (self._pack_size, len(content))
+        self._pack_size += len(content)
+        self._pending.append(content)
+        self._pending_size += len(content)
+        self._unsaved[digest] = content
+        self._changed = True
+        if self._pending_size >= PENDING_LIMIT:
+            self._flush()
+
+    def get(self, digest):
+        """Get the content with digest.
+
+        :return: The content, or None if it is not kept.
+        """
+        entry = self._get_index().get(digest)
+        if entry is None:
+            return None
+        if digest in self._unsaved:
+            return self._unsaved[digest]
+        try:
+            for _, content in self.transport.readv(self._pack, [entry]):
+                return content
+        except (errors.PathError, errors.ShortReadvError,
+            errors.InvalidRange):
+            return None
+
+    def save(self):
+        """Write the content added since the pack was loaded, and its index."""
+        self._flush()
+        if not self._changed:
+            return
+        self._write_index()
+        self._changed = False
+        for pack in self._old_packs:
+            try:
+                self.transport.delete(pack)
+            except errors.NoSuchFile:
+                pass
+        self._old_packs = []
+
+    def _flush(self):
+        """Write the pending content to the pack."""
+        if not self._pending:
+            return
+        content = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._unsaved = {}
+        if self._fresh:
+            # Whatever is in the pack is not indexed.
+            self._fresh = False
+            self.transport.put_bytes(self._pack, content)
+        else:
+            self.transport.append_bytes(self._pack, content)
+
+    def _start_pack(self):
+        """Start a new pack holding just the pending content."""
+        if not self._fresh:
+            self._old_packs.append(self._pack)
+        base = self._pack_size - self._pending_size
+        self._pack = '%s.%d' % (SMALL_FILES,
+            int(self._pack.rpartition('.')[2]) + 1)
+        self._index = dict((digest, (offset - base, length))
+            for digest, (offset, length) in self._index.iteritems()
+            if offset >= base)
+        self._pack_size = self._pending_size
+        self._fresh = True
+        self._changed = True
+
+    def _write_index(self):
+        content = [SMALL_FILES_HEADER, self._pack, '\n']
+        for digest, (offset, length) in sorted(self._index.iteritems()):
+            content.append('%s\x00%d\x00%d\x00' % (digest, offset, length))
+        self.transport.put_bytes(SMALL_FILES, ''.join(content))
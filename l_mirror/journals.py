@@ -24,11 +24,14 @@ instance), and when a node is receiving updates it receives all the journals it
 is missing, and then the updates determined by combining all the journals
 together.
 
-The parse() function can parse a journal bytes to make a new Journal object.
+The parse() function can parse a journal bytes to make a new Journal object,
+and iter_parse() parses them lazily. map_journal() maps local journals into
+memory, so that they can be parsed without reading them into a string first.
 
 The Combiner object can combine multiple journals together, and then either
 generate the model of a tree on disk, or a new journal with redundant changes
-eliminated.
+eliminated. StreamingCombiner does the same for serialised journals without
+holding the combined journal in memory.
 
 DiskUpdater is a class to compare a memory 'tree' and a bzr transport and 
 output a journal to update the tree to match the transport. DiskUpdater uses
@@ -38,20 +41,118 @@ are useful helpers for such filtering.
 Various Replay objects can replay a journal. TransportReplay replays a journal
 by reading the file content from a transport object. ReplayGenerator is the
 core workhorse for streaming the data needed to do a replay; it is serialised
-when streaming from http and deserialised by FromFileGenerator.
+when streaming from http and deserialised by FromFileGenerator. A
+ContentIndex lets TransportReplay reuse content already present locally.
+
+Streams come in two formats. A plain stream is the serialised actions, each
+followed by the content of the file it creates, if any. An encoded stream
+starts with ENCODED_STREAM_MARKER, and each file content is preceded by the
+encoding used for it: 'identity' for the raw content, 'zlib' for a series
+of '<length>\x00<compressed bytes>' frames ending with an empty '0\x00' frame,
+or 'delta' for a single frame holding the delta.signature of the content,
+which the receiver reconstructs from its old content and range requests.
+FromFileGenerator reads either format.
 """
 
-__all__ = ['parse', 'Combiner', 'Journal', 'DiskUpdater', 'TransportReplay',
-    'FilterCombiner', 'ProcessFilter',
+__all__ = ['parse', 'iter_parse', 'Combiner', 'StreamingCombiner', 'Journal',
+    'DiskUpdater', 'TransportReplay', 'ContentIndex', 'FilterCombiner',
+    'ProcessFilter', 'parse_manifest', 'map_journal', 'unmap_journal',
     ]
 
 import errno
+import hashlib
+import heapq
+import mmap
 import os
 from hashlib import sha1 as sha
 import re
+from StringIO import StringIO
+import zlib
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
 
 from bzrlib import errors, osutils
 
+from l_mirror import changes, delta
+
+
+# Encoded streams start with this: a plain stream starts with a path, and paths
+# are never empty.
+ENCODED_STREAM_MARKER = '\x00encoded\x00'
+# The content encodings that can be asked for in an encoded stream.
+STREAM_ENCODINGS = ('zlib',)
+# Files with these suffixes are usually compressed already, and smaller files
+# are not worth compressing: such files are sent with the identity encoding.
+COMPRESSED_SUFFIXES = frozenset(['.7z', '.bz2', '.deb', '.gif', '.gpg', '.gz',
+    '.jar', '.jpeg', '.jpg', '.lz4', '.lzma', '.mp3', '.mp4', '.ogg', '.png',
+    '.rpm', '.tbz', '.tgz', '.udeb', '.whl', '.xz', '.z', '.zip', '.zst'])
+MIN_COMPRESS_SIZE = 512
+# Local journals this large are mapped into memory rather than read: see
+# map_journal.
+MAP_THRESHOLD = 1048576
+# The hashes file content can be recorded with. sha1 digests are recorded as
+# plain hex, and others as 'NAME:HEX', which only 'l-mirror-journal-4'
+# journals contain.
+HASHES = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+if blake2b is not None:
+    # Fast, for sets that are not signed.
+    HASHES['blake2b'] = lambda: blake2b(digest_size=16)
+
+
+def hash_name(digest):
+    """Get the name of the hash a digest was made with.
+
+    :param digest: A digest as recorded in FileContent.sha1.
+    :raises ValueError: If the hash is not in HASHES.
+    """
+    name, sep, _ = digest.partition(':')
+    if not sep:
+        return 'sha1'
+    if name not in HASHES:
+        raise ValueError('unknown hash %r' % name)
+    return name
+
+
+def new_hash(name):
+    """Create a hash object for the hash called name.
+
+    :raises ValueError: If the hash is not in HASHES.
+    """
+    try:
+        return HASHES[name]()
+    except KeyError:
+        raise ValueError('unknown hash %r' % name)
+
+
+def format_digest(name, hexdigest):
+    """Format a digest for recording in FileContent.sha1."""
+    if name == 'sha1':
+        return hexdigest
+    return '%s:%s' % (name, hexdigest)
+
+
+def hash_file(a_file, name='sha1'):
+    """Hash the content of a_file.
+
+    :param name: The hash to use, from HASHES.
+    :return: A tuple (size, digest), where digest is formatted as for
+        FileContent.sha1.
+    """
+    hasher = new_hash(name)
+    size = 0
+    while True:
+        content = a_file.read(65536)
+        if not content:
+            break
+        size += len(content)
+        hasher.update(content)
+    return size, format_digest(name, hasher.hexdigest())
+
 
 class PathContent(object):
     """Content about a path.
@@ -85,7 +186,8 @@ class PathContent(object):
 class FileContent(PathContent):
     """Content for files.
     
-    :ivar sha1: The sha1 of the filec ontent.
+    :ivar sha1: The digest of the file content: a hex sha1, or for other
+        hashes 'NAME:HEX' (see HASHES).
     :ivar length: The length of the file.
     :ivar mtime: The mtime of the file. None if it is not known.
     """
@@ -103,6 +205,11 @@ class FileContent(PathContent):
             mtime = "%0.6f" % self.mtime
         return [self.kind, self.sha1, str(self.length), mtime]
 
+    @property
+    def hash_name(self):
+        """The name of the hash the digest was made with."""
+        return hash_name(self.sha1)
+
 
 class SymlinkContent(PathContent):
     """Content for symlinks."""
@@ -125,6 +232,167 @@ class DirContent(PathContent):
         return [self.kind]
 
 
+def _combine_content(path, old_content, new_content):
+    """Combine two successive changes to a single path.
+
+    :param path: The path being changed, used in error messages.
+    :param old_content: The (action, kind_data) from the earlier journal.
+    :param new_content: The (action, kind_data) from the later journal.
+    :return: The combined (action, kind_data), or None if the two changes
+        cancel each other out.
+    :raises ValueError: If the changes cannot be safely combined.
+    """
+    old_action = old_content[0]
+    new_action = new_content[0]
+    if (old_action, new_action) == ('new', 'new'):
+        raise ValueError('Attempt to add %r twice.' % path)
+    elif (old_action, new_action) == ('new', 'del'):
+        if old_content[1] != new_content[1]:
+            raise ValueError('Attempt to delete wrong content %r, %r' %
+                (old_content, new_content))
+        return None
+    elif (old_action, new_action) == ('new', 'replace'):
+        if old_content[1] != new_content[1][0]:
+            raise ValueError('Attempt to replace wrong content %r, %r' %
+                (old_content, new_content))
+        return ('new', new_content[1][1])
+    elif (old_action, new_action) == ('del', 'new'):
+        return ('replace', (old_content[1], new_content[1]))
+    elif (old_action, new_action) == ('del', 'del'):
+        raise ValueError('Attempt to delete %r twice.' % path)
+    elif (old_action, new_action) == ('del', 'replace'):
+        raise ValueError('Attempt to replace deleted path %r.' % path)
+    elif (old_action, new_action) == ('replace', 'new'):
+        raise ValueError('Attempt to add %r twice.' % path)
+    elif (old_action, new_action) == ('replace', 'del'):
+        if old_content[1][1] != new_content[1]:
+            raise ValueError('Attempt to delete wrong content %r, %r' %
+                (old_content, new_content))
+        return ('del', old_content[1][0])
+    elif (old_action, new_action) == ('replace', 'replace'):
+        if old_content[1][1] != new_content[1][0]:
+            raise ValueError('Attempt to replace wrong content %r, %r' %
+                (old_content, new_content))
+        return ('replace', (old_content[1][0], new_content[1][1]))
+    elif old_action == 'move' and new_action == 'new':
+        raise ValueError('Attempt to add %r twice.' % path)
+    else:
+        raise ValueError("Unknown action pair %r" % (
+            (old_action, new_action),))
+
+
+def _same_content(old_content, new_content):
+    """Is new_content the same as old_content, ignoring file mtimes?"""
+    if old_content.kind != new_content.kind:
+        return False
+    if old_content.kind == 'file':
+        return (old_content.sha1 == new_content.sha1 and
+            old_content.length == new_content.length)
+    return old_content == new_content
+
+
+def _combine_paths(paths, path, new_content):
+    """Combine a change to path into paths, a combined journal's paths.
+
+    Most changes only affect the path being changed, but moves affect both
+    their source and their target path. When a combination of moves cannot be
+    expressed as a move (for instance when a path is moved onto a path that
+    was deleted earlier) it is expressed as deletes, news and replaces.
+
+    :param paths: The paths dict of the combined journal, updated in place.
+    :param path: The path being changed.
+    :param new_content: The (action, kind_data) for path from the journal
+        being added.
+    :raises ValueError: If the change cannot be safely combined.
+    """
+    if new_content[0] == 'move':
+        _combine_move(paths, path, new_content[1])
+        return
+    old_content = paths.get(path, None)
+    if old_content is None:
+        paths[path] = new_content
+        return
+    if old_content[0] == 'move' and new_content[0] in ('del', 'replace'):
+        # The path was moved here earlier: it did not exist before, but its
+        # source did.
+        source, content = old_content[1]
+        if new_content[0] == 'del':
+            deleted = new_content[1]
+        else:
+            deleted = new_content[1][0]
+        if not _same_content(content, deleted):
+            raise ValueError('Attempt to %s wrong content %r, %r' % (
+                new_content[0], old_content, new_content))
+        del paths[path]
+        _unmove(paths, source, content)
+        if new_content[0] == 'replace':
+            paths[path] = ('new', new_content[1][1])
+        return
+    merged_content = _combine_content(path, old_content, new_content)
+    if merged_content is None:
+        del paths[path]
+    else:
+        paths[path] = merged_content
+
+
+def _combine_move(paths, path, kind_data):
+    """Combine a move of kind_data[0] to path into paths."""
+    source, content = kind_data
+    old_content = paths.pop(source, None)
+    if old_content is None:
+        # Present before the combined journal.
+        origin = source
+    elif old_content[0] == 'del':
+        raise ValueError('Attempt to move deleted path %r.' % source)
+    else:
+        if old_content[0] == 'replace':
+            current = old_content[1][1]
+            paths[source] = ('del', old_content[1][0])
+        else:
+            current = old_content[1]
+        if old_content[0] == 'move':
+            current = current[1]
+            origin = old_content[1][0]
+        else:
+            # Created within the combined journal.
+            origin = None
+        if not _same_content(current, content):
+            raise ValueError('Attempt to move wrong content %r, %r' % (
+                old_content, ('move', kind_data)))
+    target_content = paths.get(path, None)
+    if target_content is None:
+        if origin is None:
+            paths[path] = ('new', content)
+        elif origin != path:
+            paths[path] = ('move', (origin, content))
+        # else moved back to where it started.
+    elif target_content[0] == 'del':
+        # Replacing a path that was deleted: moves cannot replace things.
+        if origin is not None:
+            _unmove(paths, origin, content)
+        paths[path] = ('replace', (target_content[1], content))
+    else:
+        raise ValueError('Attempt to add %r twice.' % path)
+
+
+def _unmove(paths, source, content):
+    """Record that content was removed from source, as a delete.
+
+    Used when a move from source can no longer be expressed as a move. Any
+    change already recorded for source happened after the content was moved
+    away.
+    """
+    later_content = paths.get(source, None)
+    if later_content is None:
+        paths[source] = ('del', content)
+        return
+    merged_content = _combine_content(source, ('del', content), later_content)
+    if merged_content is None:
+        del paths[source]
+    else:
+        paths[source] = merged_content
+
+
 class Combiner(object):
     """Combine multiple journals.
     
@@ -138,56 +406,15 @@ class Combiner(object):
     def add(self, journal):
         """Add journal to the combined journal.
 
-        :raises ValueError: If the journal cannot be safely combined.
+        The combined journal is updated in place, path by path.
+
+        :raises ValueError: If the journal cannot be safely combined. The
+            combined journal is left partially updated when this happens, so
+            the Combiner should not be used further.
         """
-        # paths to delete after iteration.
-        pending_del_paths = []
-        merged_content = {}
+        paths = self.journal.paths
         for path, new_content in journal.paths.iteritems():
-            old_content = self.journal.paths.get(path, None)
-            if old_content is None:
-                continue
-            # resolve here
-            old_action = old_content[0]
-            new_action = new_content[0]
-            if (old_action, new_action) == ('new', 'new'):
-                raise ValueError('Attempt to add %r twice.' % path)
-            elif (old_action, new_action) == ('new', 'del'):
-                if old_content[1] != new_content[1]:
-                    raise ValueError('Attempt to delete wrong content %r, %r' %
-                        (old_content, new_content))
-                pending_del_paths.append(path)
-            elif (old_action, new_action) == ('new', 'replace'):
-                if old_content[1] != new_content[1][0]:
-                    raise ValueError('Attempt to replace wrong content %r, %r' %
-                        (old_content, new_content))
-                merged_content[path] = ('new', new_content[1][1])
-            elif (old_action, new_action) == ('del', 'new'):
-                merged_content[path] = ('replace', (old_content[1], new_content[1]))
-            elif (old_action, new_action) == ('del', 'del'):
-                raise ValueError('Attempt to delete %r twice.' % path)
-            elif (old_action, new_action) == ('del', 'replace'):
-                raise ValueError('Attempt to replace deleted path %r.' % path)
-            elif (old_action, new_action) == ('replace', 'new'):
-                raise ValueError('Attempt to add %r twice.' % path)
-            elif (old_action, new_action) == ('replace', 'del'):
-                if old_content[1][1] != new_content[1]:
-                    raise ValueError('Attempt to delete wrong content %r, %r' %
-                        (old_content, new_content))
-                merged_content[path] = ('del', old_content[1][0])
-            elif (old_action, new_action) == ('replace', 'replace'):
-                if old_content[1][1] != new_content[1][0]:
-                    raise ValueError('Attempt to replace wrong content %r, %r' %
-                        (old_content, new_content))
-                merged_content[path] = ('replace', (old_content[1][0], new_content[1][1]))
-            else:
-                raise ValueError("Unknown action pair %r" % (
-                    (old_action, new_action),))
-        # backdoor for speed - XXX may be premature. 
-        self.journal.paths.update(journal.paths)
-        self.journal.paths.update(merged_content)
-        for path in pending_del_paths:
-            del self.journal.paths[path]
+            _combine_paths(paths, path, new_content)
 
     def as_tree(self):
         """Convert a from-null combined journal into a tree.
@@ -197,12 +424,12 @@ class Combiner(object):
         
         :return: A dict representing the tree that the journal would create if
             replayed.
-        :raises ValueError: If the journal contains any delete, replace actions
-            or items with missing parents.
+        :raises ValueError: If the journal contains any delete, replace or
+            move actions or items with missing parents.
         """
         result = {}
         for path, (action, kind_data) in sorted(self.journal.paths.iteritems()):
-            if action in ('del', 'replace'):
+            if action in ('del', 'replace', 'move'):
                 raise ValueError(
                     'cannot generate a tree representation for a partial '
                     ' journal, path %r is not new.' % path)
@@ -220,6 +447,196 @@ class Combiner(object):
         return result
 
 
+class StreamingCombiner(object):
+    """Combine multiple serialised journals lazily.
+
+    Serialised journals list their paths in sorted order (see
+    Journal.as_bytes), so they can be combined with a k-way merge that only
+    ever holds one pending path per journal, rather than building a dict of
+    every path in every journal as Combiner does. The combined journal is
+    regenerated from the serialised journals each time it is iterated.
+
+    A StreamingCombiner can be given to a ReplayGenerator in place of a
+    Journal. Moves affect two paths, so they cannot be combined path by path:
+    the paths that moves come from or go to are found first, and their
+    changes are combined with a Combiner which holds only those paths. The
+    other paths are merged as usual, so memory stays proportional to the
+    number of moves rather than the number of paths.
+
+    :ivar sources: The journals being combined, oldest first: serialised
+        journals, or (transport, relpath) tuples for journals on disk.
+    """
+
+    def __init__(self):
+        """Create a StreamingCombiner."""
+        self.sources = []
+        # None, or (moved paths, their combined changes in path order).
+        self._moves = None
+
+    def add(self, journal_bytes):
+        """Add a serialised journal to the combined journal.
+
+        Nothing is parsed until the combined journal is iterated.
+
+        :param journal_bytes: The bytes of a journal, as returned by
+            Journal.as_bytes, or an mmap of them from map_journal.
+        """
+        self.sources.append(journal_bytes)
+        self._moves = None
+
+    def add_file(self, transport, relpath):
+        """Add the journal at relpath in transport to the combined journal.
+
+        The journal is read with map_journal each time the combined journal
+        is iterated, and released once the iteration finishes, so that idle
+        combiners hold no mappings.
+        """
+        self.sources.append((transport, relpath))
+        self._moves = None
+
+    def _open_sources(self):
+        result = []
+        try:
+            for source in self.sources:
+                if type(source) is tuple:
+                    source = map_journal(*source)
+                result.append(source)
+        except:
+            self._close_sources(result)
+            raise
+        return result
+
+    def _close_sources(self, sources):
+        for source in sources:
+            unmap_journal(source)
+
+    def iter_paths(self):
+        """Iterate over the combined journal in path order.
+
+        :return: An iterator of (path, (action, kind_data)) tuples.
+        :raises ValueError: If the journals cannot be safely combined, or are
+            not in path order.
+        """
+        sources = self._open_sources()
+        try:
+            for item in self._iter_paths(sources):
+                yield item
+        finally:
+            self._close_sources(sources)
+
+    def _iter_paths(self, sources):
+        moved, moved_items = self._combine_moves(sources)
+        streams = [self._iter_source(pos, source, moved) for pos, source in
+            enumerate(sources)]
+        if moved_items:
+            # Already combined, and in no other stream.
+            streams.append((path, len(sources), content)
+                for path, content in moved_items)
+        current_path = None
+        current_content = None
+        # Ties on path are broken by the journal position, so each path's
+        # changes arrive oldest first.
+        for path, pos, content in heapq.merge(*streams):
+            if path != current_path:
+                if current_content is not None:
+                    yield current_path, current_content
+                current_path = path
+                current_content = content
+            elif current_content is None:
+                # Earlier changes cancelled out.
+                current_content = content
+            else:
+                current_content = _combine_content(
+                    path, current_content, content)
+        if current_content is not None:
+            yield current_path, current_content
+
+    def _combine_moves(self, sources):
+        """Combine the changes to the paths that moves affect.
+
+        :return: A tuple (moved, items): the set of paths moved from or to,
+            and a list of their combined (path, (action, kind_data)) in path
+            order.
+        """
+        if self._moves is not None:
+            return self._moves
+        moved = set()
+        for source in sources:
+            # Only journals with these headers can hold moves.
+            if source[:len('l-mirror-journal-3\n')] not in (
+                'l-mirror-journal-3\n', 'l-mirror-journal-4\n'):
+                continue
+            for path, action, kind_data in iter_parse(source):
+                if action == 'move':
+                    moved.add(path)
+                    moved.add(kind_data[0])
+        items = []
+        if moved:
+            combiner = Combiner()
+            for source in sources:
+                journal = Journal()
+                for path, action, kind_data in iter_parse(source):
+                    if path in moved:
+                        journal.paths[path] = (action, kind_data)
+                combiner.add(journal)
+            items = sorted(combiner.journal.paths.iteritems())
+        self._moves = (moved, items)
+        return self._moves
+
+    def _iter_source(self, pos, source, moved=()):
+        last_path = None
+        for path, action, kind_data in iter_parse(source):
+            if last_path is not None and path <= last_path:
+                raise ValueError('Journal %d is not in path order at %r.' %
+                    (pos, path))
+            last_path = path
+            if path not in moved:
+                yield path, pos, (action, kind_data)
+
+    def as_groups(self):
+        """Create a series of groups that can be acted on to apply the journal.
+
+        This is the same as Journal.as_groups except that the adds group is
+        a lazy iterator: only the moves, replaces and deletes, which have to
+        be done separately from the adds, are held in memory.
+
+        :Return: A list of groups. Each group is an iterable of (action, path,
+            content).
+        """
+        moves = []
+        replaces = []
+        deletes = []
+        for path, (action, content) in self.iter_paths():
+            if action == 'replace':
+                replaces.append((action, path, content))
+            elif action == 'del':
+                deletes.append((action, path, content))
+            elif action == 'move':
+                moves.append((action, path, content))
+            elif action != 'new':
+                raise ValueError('unknown action %r for %r' % (action, path))
+        # iter_paths is in path order, and both replaces and deletes are
+        # done in reverse path order.
+        replaces.reverse()
+        deletes.reverse()
+        return [moves, self._iter_adds(), replaces, deletes]
+
+    def _iter_adds(self):
+        for path, (action, content) in self.iter_paths():
+            if action == 'new':
+                yield action, path, content
+
+    def as_journal(self):
+        """Materialise the combined journal.
+
+        :return: A Journal.
+        """
+        result = Journal()
+        for path, (action, content) in self.iter_paths():
+            result.paths[path] = (action, content)
+        return result
+
+
 class DiskUpdater(object):
     """Create a journal based on local disk and a tree representation.
 
@@ -252,11 +669,29 @@ class DiskUpdater(object):
         path is considered included as if it matched the include_re. Finally,
         if the filter returns None, the path is not influenced by the filter
         callback.
+    :ivar detect_moves: If True, deleted paths whose content reappears at new
+        paths are journalled as moves, so that receivers can rename them
+        rather than fetching them again. Journals with moves can only be read
+        by receivers that support them.
+    :ivar manifest: A dict of the paths known to have changed, as returned by
+        parse_manifest. Listed paths are always examined, whatever their
+        mtime, and are only stated and hashed as far as the manifest leaves
+        their content unspecified. Digests made with a hash other than
+        hash_name are ignored and the file is hashed.
+    :ivar checksums: None, or an l_mirror.checksums.ChecksumSource giving
+        trusted sha1s for files, which are then not read.
+    :ivar hash_name: The hash to record file content with, from HASHES.
+    :ivar hash_cache: None, or an l_mirror.hashcache.HashCache which is asked
+        for the digests of files before reading them, and records the digests
+        of the files read.
+    :ivar small_files: None, or an l_mirror.hashcache.SmallFiles which keeps
+        the content of small files read.
     """
 
     def __init__(self, tree, transport, name, last_timestamp, ui,
         excludes=(), includes=(), filter_callback=lambda path:None,
-        known_changes=None):
+        known_changes=None, detect_moves=False, rescan=None, manifest=None,
+        checksums=None, hash_name='sha1', hash_cache=None, small_files=None):
         """Create a DiskUpdater.
 
         :param tree: The tree to compare with.
@@ -274,12 +709,32 @@ class DiskUpdater(object):
             the include_re.
         :param filter_callback: A path filter. See the class docstring for
             details.
-        :param known_changes: Either None, or a list of abspaths for changes
-            known within the content root being scanned. If not None, then
+        :param known_changes: Either None, a list of abspaths for changes
+            known within the content root being scanned, or an
+            l_mirror.changes.Changes for them. If not None, then
             the directory structure on disk is not walked; rather the known
             changes are used to detect changes. As a special case, the children
             of directories within known_changes that were not present in the
             last mirror update are scanned on disk.
+        :param detect_moves: If True journal moves rather than deletes and
+            adds of the same content. Defaults to False.
+        :param rescan: Either None, or a list of abspaths of directories
+            whose subtrees are scanned on disk even though known_changes is
+            given, because their changes are not known. Ignored when
+            known_changes is a Changes, which lists its own directories to
+            scan.
+        :param manifest: Either None, or a dict of the paths that have
+            changed, as returned by parse_manifest. If known_changes is None
+            only the paths in the manifest are looked at.
+        :param checksums: None, or an l_mirror.checksums.ChecksumSource to
+            ask for the sha1 of files before reading them. Only used when
+            hash_name is 'sha1'.
+        :param hash_name: The hash to record file content with, from HASHES.
+        :param hash_cache: None, or an l_mirror.hashcache.HashCache of the
+            digests of files, which is updated as files are read. Digests
+            made with another hash are not used.
+        :param small_files: None, or an l_mirror.hashcache.SmallFiles to keep
+            the content of the small files read in.
         """
         self.tree = tree
         self.transport = transport
@@ -293,7 +748,23 @@ class DiskUpdater(object):
         excludes = [r'(?:^|/)\.lmirror/'] + list(excludes)
         self.exclude_re = re.compile(self._make_re_str(excludes))
         self.filter_callback = filter_callback
+        if manifest is not None and known_changes is None:
+            known_changes = changes.Changes()
+            for relpath in manifest:
+                known_changes.add(relpath)
+        self.manifest = manifest or {}
+        if hash_name not in HASHES:
+            raise ValueError('unknown hash %r' % hash_name)
+        self.hash_name = hash_name
+        if hash_name != 'sha1':
+            checksums = None
+        self.checksums = checksums
+        self.hash_cache = hash_cache
+        self.small_files = small_files
         self.known_changes = known_changes
+        self.detect_moves = detect_moves
+        self.rescan = rescan
+        self._known = None
 
     def _make_re_str(self, re_strs):
         re_strs = ['(?:%s)' % re_str for re_str in re_strs]
@@ -305,6 +776,8 @@ class DiskUpdater(object):
     
     def _known_dir_contents(self, dirname):
         """Get the contents of dirname from self.known_changes."""
+        if self._in_rescan(dirname):
+            return self._real_dir_contents(dirname)
         cwd = self._known_changes_dirs
         if dirname == '':
             return cwd.keys()
@@ -322,26 +795,26 @@ class DiskUpdater(object):
             return self._finished_scan(self._known_dir_contents,
                 missing_is_unchanged=True)
 
+    def _in_rescan(self, dirname):
+        """Return True if dirname is within a directory to scan on disk."""
+        return (self._known is not None and self._known.in_scan(dirname))
+
     def _cache_known_changes(self):
         """Structure known_changes into a dict for lookups."""
-        root_prefix = self.transport.local_abspath('.')
-        root = {}
-        for path in self.known_changes:
-            path = path[len(root_prefix) + 1:]
-            elements = path.split('/')
-            cwd = root
-            for pos, element in enumerate(elements):
-                dirname = '/'.join(elements[:pos + 1])
-                subdir = cwd.setdefault(element, (dirname, {}))
-                cwd = subdir[1]
-        self._known_changes_dirs = root
+        known = self.known_changes
+        if not isinstance(known, changes.Changes):
+            known = changes.Changes.from_abspaths(
+                self.transport.local_abspath('.'), known, self.rescan or ())
+        self._known = known
+        self._known_changes_dirs = known.as_tree()
 
     def _finished_scan(self, dir_contents, missing_is_unchanged=False):
         """Perform finished() by scanning the disk.
         
         :param dir_contents: A callback to get the contents of a directory.
         :param missing_is_unchanged: If True, a path not listed in a directory
-            is unchanged, rather than missing.
+            is unchanged, rather than missing, except within the directories
+            being rescanned.
         """
         pending = ['']
         while pending:
@@ -363,7 +836,7 @@ class DiskUpdater(object):
             # tree_names contains the last recorded set of names.
             tree_names = set(cwd)
             names = set(names)
-            if not missing_is_unchanged:
+            if not missing_is_unchanged or self._in_rescan(dirname):
                 for name in tree_names - names:
                     # deletes
                     path = dirname and ('%s/%s' % (dirname, name)) or name
@@ -384,8 +857,21 @@ class DiskUpdater(object):
                             old_kind_details = DirContent()
                         self.journal.add(path, 'del', old_kind_details)
                     continue
+                listed = path in self.manifest
+                hint = self.manifest.get(path)
+                if (hint is not None and hint != 'del' and
+                    hash_name(hint.sha1) != self.hash_name):
+                    # A digest made with another hash would change the hash
+                    # of the set: hash the file instead, as for checksums.
+                    hint = None
                 try:
-                    statinfo = self.transport.stat(path)
+                    if hint == 'del':
+                        raise errors.NoSuchFile(path)
+                    if hint is not None and hint.length is not None:
+                        # Nothing to read from disk.
+                        statinfo = None
+                    else:
+                        statinfo = self.transport.stat(path)
                 except errors.NoSuchFile:
                     # This file doesn't actually exist: may be concurrent
                     # delete, or a seen change from a changes list.
@@ -397,9 +883,12 @@ class DiskUpdater(object):
                             old_kind_details = DirContent()
                         self.journal.add(path, 'del', old_kind_details)
                     continue
-                mtime = getattr(statinfo, 'st_mtime', 0)
-                kind = osutils.file_kind_from_stat_mode(statinfo.st_mode)
-                if (kind != 'directory' and
+                if statinfo is None:
+                    kind = 'file'
+                else:
+                    mtime = getattr(statinfo, 'st_mtime', 0)
+                    kind = osutils.file_kind_from_stat_mode(statinfo.st_mode)
+                if (kind != 'directory' and not listed and
                     (self.last_timestamp - mtime > 3 and mtime)
                     and name not in new_names):
                     # We have to look inside directories always; things that
@@ -408,12 +897,28 @@ class DiskUpdater(object):
                     # granularity) and finally its not new (new things have
                     # to be scanned always).
                     continue
-                if kind == 'file':
-                    f = self.transport.get(path)
-                    try:
-                        disk_size, disk_sha1 = osutils.size_sha_file(f)
-                    finally:
-                        f.close()
+                if hint is not None:
+                    if kind != 'file':
+                        raise ValueError('manifest gives a sha1 for %r, which '
+                            'is a %s' % (path, kind))
+                    if statinfo is None:
+                        new_kind_details = hint
+                    else:
+                        new_kind_details = FileContent(hint.sha1,
+                            statinfo.st_size, statinfo.st_mtime)
+                elif kind == 'file':
+                    disk_sha1 = None
+                    if self.checksums is not None:
+                        disk_sha1 = self.checksums.get_sha1(path, statinfo)
+                    if disk_sha1 is None and self.hash_cache is not None:
+                        disk_sha1 = self.hash_cache.get(path, statinfo)
+                        if (disk_sha1 is not None and
+                            hash_name(disk_sha1) != self.hash_name):
+                            disk_sha1 = None
+                    if disk_sha1 is not None:
+                        disk_size = statinfo.st_size
+                    else:
+                        disk_size, disk_sha1 = self._hash(path, statinfo)
                     new_kind_details = FileContent(disk_sha1, disk_size, statinfo.st_mtime)
                 elif kind == 'symlink':
                     new_kind_details = SymlinkContent(os.readlink(self.transport.local_abspath(path)))
@@ -431,11 +936,143 @@ class DiskUpdater(object):
                     if old_kind_details != new_kind_details:
                         self.journal.add(path, 'replace', (old_kind_details,
                             new_kind_details))
+        if self.detect_moves:
+            self._find_moves()
         for path, (action, details) in self.journal.paths.iteritems():
             self.ui.output_log(4, __name__, 'Journalling action %s for %r' % (
                 action, path))
+            if self.hash_cache is not None:
+                if action == 'del':
+                    self.hash_cache.remove(path)
+                elif action == 'move':
+                    self.hash_cache.remove(details[0])
         return self.journal
 
+    def _hash(self, path, statinfo):
+        """Read and hash the file at path.
+
+        :param statinfo: The stat result for path.
+        :return: A tuple (size, digest).
+        """
+        f = self.transport.get(path)
+        try:
+            if (self.small_files is not None and
+                self.small_files.wants(statinfo)):
+                content = f.read()
+                hasher = new_hash(self.hash_name)
+                hasher.update(content)
+                size = len(content)
+                digest = format_digest(self.hash_name, hasher.hexdigest())
+                self.small_files.add(digest, content)
+            else:
+                size, digest = hash_file(f, self.hash_name)
+        finally:
+            f.close()
+        if self.hash_cache is not None:
+            self.hash_cache.add(path, statinfo, digest)
+        return size, digest
+
+    def _find_moves(self):
+        """Turn deletes and adds of the same content into moves.
+
+        Directories are matched first, by the content of their whole subtree,
+        so that the paths within a moved directory are moved to the same
+        relative path; the remaining files are then matched by sha1 and
+        length. Empty files and directories, and symlinks outside of moved
+        directories, are cheaper to recreate than to match, so they are left
+        alone.
+        """
+        deleted = {}
+        added = {}
+        for path, (action, content) in self.journal.paths.iteritems():
+            if action == 'del':
+                deleted[path] = content
+            elif action == 'new':
+                added[path] = content
+        if not deleted or not added:
+            return
+        deleted_dirs = {}
+        for signature, path, relpaths in self._subtree_signatures(deleted):
+            deleted_dirs.setdefault(signature, []).append(path)
+        for signature, path, relpaths in self._subtree_signatures(added):
+            if path not in added:
+                # Inside a directory which has already been moved.
+                continue
+            for source in deleted_dirs.get(signature, ()):
+                # Parts of the directory may have been moved already.
+                if source in deleted and not [relpath for relpath in relpaths
+                    if '%s/%s' % (source, relpath) not in deleted]:
+                    break
+            else:
+                continue
+            self._add_move(source, path, added, deleted)
+            for relpath in relpaths:
+                self._add_move('%s/%s' % (source, relpath),
+                    '%s/%s' % (path, relpath), added, deleted)
+        deleted_files = {}
+        for path, content in sorted(deleted.iteritems()):
+            if content.kind == 'file' and content.length:
+                deleted_files.setdefault((content.sha1, content.length),
+                    []).append(path)
+        for path, content in sorted(added.iteritems()):
+            if content.kind != 'file' or not content.length:
+                continue
+            candidates = deleted_files.get((content.sha1, content.length))
+            if not candidates:
+                continue
+            # Prefer a file with the same name, moved to another directory.
+            name = path.rpartition('/')[2]
+            source = candidates[0]
+            for candidate in candidates:
+                if candidate.rpartition('/')[2] == name:
+                    source = candidate
+                    break
+            candidates.remove(source)
+            self._add_move(source, path, added, deleted)
+
+    def _subtree_signatures(self, contents):
+        """Calculate the signatures of the directories in contents.
+
+        :param contents: A dict of path -> content for a set of paths
+            including whole directory subtrees.
+        :return: A list of (signature, path, relpaths) tuples for the
+            directories with files in their subtree, shallowest first.
+            relpaths lists the paths in the subtree relative to the directory.
+        """
+        subtrees = {}
+        for path, content in contents.iteritems():
+            if content.kind == 'dir':
+                subtrees[path] = []
+        with_files = set()
+        for path, content in contents.iteritems():
+            if content.kind == 'file':
+                tokens = [content.kind, content.sha1, str(content.length)]
+            else:
+                tokens = content.as_tokens()
+            segments = path.split('/')
+            for pos in range(1, len(segments)):
+                parent = '/'.join(segments[:pos])
+                if parent in subtrees:
+                    relpath = '/'.join(segments[pos:])
+                    subtrees[parent].append([relpath] + tokens)
+                    if content.kind == 'file':
+                        with_files.add(parent)
+        result = []
+        for path in with_files:
+            entries = sorted(subtrees[path])
+            signature = sha('\x00'.join('\x00'.join(entry) for entry in
+                entries)).hexdigest()
+            result.append((signature, path, [entry[0] for entry in entries]))
+        result.sort(key=lambda item: (item[1].count('/'), item[1]))
+        return result
+
+    def _add_move(self, source, path, added, deleted):
+        """Journal a move of source to path."""
+        content = added.pop(path)
+        del deleted[source]
+        del self.journal.paths[source]
+        self.journal.paths[path] = ('move', (source, content))
+
     def _gather_deleted_dir(self, path, dirdict):
         # List what the tree thought it had as deletes.
         pending = [(path, dirdict)]
@@ -559,10 +1196,11 @@ class Journal(object):
         """Add a path to the journal.
         
         :param relpath: The path to journal.
-        :param action: One of new, del, replace.
+        :param action: One of new, del, replace, move.
         :param kind_data: The data for the thing being added/deleted/replaced.
             In the special case of replacement this should be a two-tuple of
-            the old data and the new data.
+            the old data and the new data, and for moves a two-tuple of the
+            path being moved to relpath and its data.
         """
         if relpath in self.paths:
             raise ValueError('path %r is already in use.' % relpath)
@@ -571,29 +1209,48 @@ class Journal(object):
                 raise ValueError(
                     'looks like only one kind_data in replace action: %r' %
                     (kind_data,))
+        elif action == 'move':
+            if (type(kind_data) is not tuple or len(kind_data) != 2 or
+                not isinstance(kind_data[1], PathContent)):
+                raise ValueError(
+                    'move action needs a source path and kind_data: %r' %
+                    (kind_data,))
         self.paths[relpath] = (action, kind_data)
 
     def as_bytes(self):
         """Return a byte representation of this journal.
 
         The representation can be parsed by l_mirror.journals.parse. The
-        structure is a header ('l-mimrror-journal-2\n') followed by '\\0'
+        structure is a header ('l-mirror-journal-2\n') followed by '\\0'
         delimited tokens. These follow the sequence PATH, ACTION, KIND_DATA* and
-        mirror the parameters to ``add``.
+        mirror the parameters to ``add``. Moves are PATH, 'move', SOURCE,
+        KIND_DATA, and journals with moves have the header
+        'l-mirror-journal-3\n' so that older readers reject them rather than
+        misreading them. Likewise journals with file digests from hashes other
+        than sha1 have the header 'l-mirror-journal-4\n', and may contain
+        moves too.
 
         :return: A bytesequence.
         """
         order = sorted(self.paths.items())
         output = []
+        version = 2
         for path, (action, kind_data) in order:
             output.append(path)
             output.append(action)
             if action == 'replace':
-                output.extend(kind_data[0].as_tokens())
-                output.extend(kind_data[1].as_tokens())
+                contents = kind_data
+            elif action == 'move':
+                version = max(version, 3)
+                output.append(kind_data[0])
+                contents = kind_data[1:]
             else:
-                output.extend(kind_data.as_tokens())
-        return 'l-mirror-journal-2\n' + '\0'.join(output)
+                contents = (kind_data,)
+            for content in contents:
+                if content.kind == 'file' and ':' in content.sha1:
+                    version = 4
+                output.extend(content.as_tokens())
+        return 'l-mirror-journal-%d\n' % version + '\0'.join(output)
 
     def as_groups(self):
         """Create a series of groups that can be acted on to apply the journal.
@@ -602,6 +1259,7 @@ class Journal(object):
             content).
         """
         groups = []
+        moves = []
         adds = []
         deletes = []
         replaces = []
@@ -612,6 +1270,8 @@ class Journal(object):
                 deletes.append((action, path, content))
             elif action == 'replace':
                 replaces.append((action, path, content))
+            elif action == 'move':
+                moves.append((action, path, content))
             else:
                 raise ValueError('unknown action %r for %r' % (action, path))
         # Ordering /can/ be more complex than just adds/replace/deletes:
@@ -622,77 +1282,225 @@ class Journal(object):
         # transform.
         # For now, simplest thing possible - want to get the concept performance
         # evaluated.
+        # Moves go first, before anything else can be put at their source
+        # paths, and parents are moved before their children.
+        moves.sort()
         adds.sort()
         replaces.sort(reverse=True)
         # Children go first when deleting a tree
         deletes.sort(reverse=True)
-        return  [adds, replaces, deletes]
+        return  [moves, adds, replaces, deletes]
 
 
 def parse(a_bytestring):
     """Parse a_bytestring into a journal.
-    
+
     :return: A Journal.
     """
+    result = Journal()
+    for path, action, kind_data in iter_parse(a_bytestring):
+        result.add(path, action, kind_data)
+    return result
+
+
+def parse_manifest(a_bytestring):
+    """Parse a manifest of changed paths.
+
+    A manifest lists the paths changed since the last journal, relative to
+    the content root, so that they can be journalled without scanning for
+    them. Each path is followed by one detail token, and every token is
+    terminated by '\\0'. The detail is one of:
+
+    * '' - the path was added, changed or deleted: it is examined on disk.
+    * 'del' - the path was deleted.
+    * SHA1 - the path is a file with content of that hex sha1: it is stated
+      but not hashed. Digests from other hashes are given as NAME:HEX (see
+      HASHES).
+    * SHA1:LENGTH - the path is a file with that content: it is not looked at
+      on disk at all.
+
+    Directories added are not scanned, so every path within them needs
+    listing.
+
+    :return: A dict of relpath -> None, 'del', or a FileContent whose length
+        and mtime may be None.
+    :raises ValueError: If a_bytestring is not a valid manifest.
+    """
+    tokens = a_bytestring.split('\x00')
+    if tokens.pop() != '' or len(tokens) % 2:
+        raise ValueError('Truncated manifest')
+    result = {}
+    for pos in range(0, len(tokens), 2):
+        path, detail = tokens[pos:pos + 2]
+        if (not path or path.startswith('/') or
+            '..' in path.split('/') or '' in path.split('/')):
+            raise ValueError('Invalid manifest path %r' % path)
+        if path in result:
+            raise ValueError('path %r is in the manifest twice' % path)
+        if not detail:
+            result[path] = None
+        elif detail == 'del':
+            result[path] = detail
+        else:
+            parts = detail.split(':')
+            if parts[0] in HASHES:
+                name = parts.pop(0)
+            else:
+                name = 'sha1'
+            hexdigest = parts[0]
+            length = None
+            try:
+                if (len(parts) > 2 or not hexdigest or
+                    hexdigest.strip('0123456789abcdef') or
+                    (name == 'sha1' and len(hexdigest) != 40)):
+                    raise ValueError(detail)
+                if len(parts) == 2:
+                    length = int(parts[1])
+            except ValueError:
+                raise ValueError('Invalid manifest detail %r for %r' % (
+                    detail, path))
+            result[path] = FileContent(format_digest(name, hexdigest),
+                length, None)
+    return result
+
+
+def iter_parse(a_bytestring):
+    """Lazily parse a_bytestring as a journal.
+
+    Unlike parse, no Journal is built: each path is yielded as soon as its
+    tokens have been read. a_bytestring may also be an mmap from map_journal:
+    only the tokens are copied out of it, one at a time.
+
+    :return: An iterator of (path, action, kind_data) tuples, in the order
+        they appear in a_bytestring.
+    """
     header1 = 'l-mirror-journal-1\n'
     header2 = 'l-mirror-journal-2\n'
-    if not a_bytestring.startswith(header1):
-        if not a_bytestring.startswith(header2):
-            raise ValueError('Not a journal: missing header %r' % (
-                a_bytestring,))
-        else:
-            def parse_kind_data(tokens, pos):
-                kind = tokens[pos]
-                pos += 1
-                if kind == 'file':
-                    return FileContent(tokens[pos], int(tokens[pos+1]), float(tokens[pos+2])), pos + 3
-                elif kind == 'dir':
-                    return DirContent(), pos
-                elif kind == 'symlink':
-                    return SymlinkContent(tokens[pos]), pos + 1
-                else:
-                    raise ValueError('unknown kind %r at token %d.' % (kind, pos))
-            content = a_bytestring[len(header2):]
+    header3 = 'l-mirror-journal-3\n'
+    header4 = 'l-mirror-journal-4\n'
+    has_moves = False
+    has_hashes = False
+    # Slice rather than startswith, so that a_bytestring can be an mmap.
+    header = a_bytestring[:len(header1)]
+    if header == header1:
+        has_mtime = False
+    elif header == header2:
+        has_mtime = True
+    elif header == header3:
+        has_mtime = True
+        has_moves = True
+    elif header == header4:
+        has_mtime = True
+        has_moves = True
+        has_hashes = True
     else:
-        def parse_kind_data(tokens, pos):
-            kind = tokens[pos]
-            pos += 1
-            if kind == 'file':
-                return FileContent(tokens[pos], int(tokens[pos+1]), None), pos + 2
-            elif kind == 'dir':
-                return DirContent(), pos
-            elif kind == 'symlink':
-                return SymlinkContent(tokens[pos]), pos + 1
+        raise ValueError('Not a journal: missing header %r' % (header,))
+    start = len(header)
+    tokens = _iter_tokens(a_bytestring, start)
+    def parse_kind_data():
+        kind = _next_token(tokens)
+        if kind == 'file':
+            sha1 = _next_token(tokens)
+            if has_hashes:
+                hash_name(sha1)
+            length = int(_next_token(tokens))
+            if has_mtime:
+                mtime = float(_next_token(tokens))
             else:
-                raise ValueError('unknown kind %r at token %d.' % (kind, pos))
-        content = a_bytestring[len(header1):]
-    tokens = content.split('\x00')
-    result = Journal()
-    pos = 0
-    if tokens[-1] == '':
-        del tokens[-1]
-    while pos < len(tokens):
-        path = tokens[pos]
-        pos += 1
-        action = tokens[pos]
-        pos += 1
+                mtime = None
+            return FileContent(sha1, length, mtime)
+        elif kind == 'dir':
+            return DirContent()
+        elif kind == 'symlink':
+            return SymlinkContent(_next_token(tokens))
+        else:
+            raise ValueError('unknown kind %r.' % (kind,))
+    for path in tokens:
+        action = _next_token(tokens)
         if action in ('new', 'del'):
-            kind_data, pos = parse_kind_data(tokens, pos)
+            kind_data = parse_kind_data()
         elif action == 'replace':
-            kind_data1, pos = parse_kind_data(tokens, pos)
-            kind_data2, pos = parse_kind_data(tokens, pos)
+            kind_data1 = parse_kind_data()
+            kind_data2 = parse_kind_data()
             kind_data = kind_data1, kind_data2
-        result.add(path, action, kind_data)
-    return result
+        elif action == 'move' and has_moves:
+            source = _next_token(tokens)
+            kind_data = source, parse_kind_data()
+        else:
+            raise ValueError('unknown action %r for %r.' % (action, path))
+        yield path, action, kind_data
+
+
+def map_journal(transport, relpath):
+    """Get the content of a journal, mapping it into memory if it is large.
+
+    Parsing a mapped journal does not need a copy of the whole journal, so
+    opening a set with a large basis journal needs little more memory than
+    the parsed paths themselves. Each mapping holds a file descriptor until
+    it is closed, so only journals of at least MAP_THRESHOLD bytes are
+    mapped, and callers should pass the result to unmap_journal once they
+    have parsed it.
+
+    :return: An mmap.mmap of the journal, or its bytes if it is small, not a
+        local file or cannot be mapped. Either can be given to iter_parse,
+        parse and StreamingCombiner.add.
+    :raises NoSuchFile: If there is no journal at relpath.
+    """
+    try:
+        path = transport.local_abspath(relpath)
+    except errors.NotLocalUrl:
+        return transport.get_bytes(relpath)
+    try:
+        journal_file = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            raise errors.NoSuchFile(relpath)
+        raise
+    try:
+        if os.fstat(journal_file.fileno()).st_size < MAP_THRESHOLD:
+            return journal_file.read()
+        try:
+            return mmap.mmap(journal_file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return journal_file.read()
+    finally:
+        journal_file.close()
+
+
+def unmap_journal(content):
+    """Release content returned by map_journal."""
+    if isinstance(content, mmap.mmap):
+        content.close()
+
+
+def _iter_tokens(a_bytestring, pos):
+    """Iterate over the '\\0' delimited tokens in a_bytestring from pos."""
+    end = len(a_bytestring)
+    while pos < end:
+        next_pos = a_bytestring.find('\x00', pos)
+        if next_pos == -1:
+            yield a_bytestring[pos:]
+            return
+        yield a_bytestring[pos:next_pos]
+        pos = next_pos + 1
+
+
+def _next_token(tokens):
+    try:
+        return tokens.next()
+    except StopIteration:
+        raise ValueError('Truncated journal.')
 
 
 class Action(object):
     """An action that can be taken.
     
-    :ivar type: new/replace/del - the action type.
+    :ivar type: new/replace/del/move - the action type.
     :ivar path: The path being acted on.
     :ivar content: The content being acted on. For deletes the old content, for
-        new the content, and for replaces the old, new content.
+        new the content, for replaces the old, new content and for moves the
+        path moved from and the content.
     """
     
     def __init__(self, action_type, path, content):
@@ -704,12 +1512,82 @@ class Action(object):
     def __repr__(self):
         return "Action: %r %s %s" % (self.path, self.type, self.content)
 
-    def as_bytes(self):
+    def as_bytes(self, encoding=None):
         """Return a generator of bytes for this action.
 
         This contains the type
         
-        :param sourcedir: A Transport to read new file content from.
+        :param encoding: None to serialise the action for a plain stream, or
+            the encoding to send file content with in an encoded stream -
+            'identity', 'delta' or one of STREAM_ENCODINGS.
+        """
+        header, content = self._header(encoding)
+        yield header
+        if content and content.kind == 'file':
+            if encoding == 'delta':
+                signature = self.get_signature()
+                yield '%d\x00%s' % (len(signature), signature)
+                return
+            chunks = self._read(self.get_file(), content.length)
+            if encoding == 'zlib':
+                chunks = _zlib_frames(chunks)
+            for read_content in chunks:
+                yield read_content
+
+    def get_signature(self):
+        """Get the delta.signature of the content for a new file."""
+        source = self.get_file()
+        try:
+            return delta.signature(source)
+        finally:
+            source.close()
+
+    def as_segments(self, encoding=None):
+        """Return a generator of bytes and FileSegments for this action.
+
+        This is the same as as_bytes except that file content which is in a
+        local file and is not being compressed is returned as a FileSegment
+        rather than being read.
+        """
+        header, content = self._header(encoding)
+        if not content or content.kind != 'file':
+            yield header
+            return
+        if encoding in ('zlib', 'delta'):
+            for read_content in self.as_bytes(encoding):
+                yield read_content
+            return
+        source = self.get_file()
+        try:
+            source.fileno()
+        except (AttributeError, IOError, ValueError):
+            # Not a real file (e.g. a StringIO).
+            yield header
+            for read_content in self._read(source, content.length):
+                yield read_content
+            return
+        try:
+            yield header
+            yield FileSegment(source, 0, content.length)
+        finally:
+            source.close()
+
+    def _read(self, source, remaining):
+        """Read remaining bytes from source in chunks of at most 64KB."""
+        while remaining:
+            read_size = min(remaining, 65536)
+            read_content = source.read(read_size)
+            remaining -= len(read_content)
+            if not read_content:
+                raise ValueError('0 byte read, expected %d' % read_size)
+            yield read_content
+
+    def _header(self, encoding=None):
+        """Get the serialised action and the content to send after it.
+
+        :param encoding: As for as_bytes.
+        :return: A tuple (header_bytes, content), where content is None when
+            no content follows the header.
         """
         if self.type == 'replace':
             content_list = []
@@ -717,23 +1595,22 @@ class Action(object):
             content_list.extend(self.content[1].as_tokens())
             content_bytes = "\x00".join(content_list)
             content = self.content[1]
+        elif self.type == 'move':
+            # The content is already present at the source path.
+            content_list = [self.content[0]]
+            content_list.extend(self.content[1].as_tokens())
+            content_bytes = "\x00".join(content_list)
+            content = None
         else:
             content_bytes = '\x00'.join(self.content.as_tokens())
             if self.type == 'new':
                 content = self.content
             else:
                 content = None
-        yield "%s\x00%s\x00%s\x00" % (self.path, self.type, content_bytes)
-        if content and content.kind == 'file':
-            source = self.get_file()
-            remaining = content.length
-            while remaining:
-                read_size = min(remaining, 65536)
-                read_content = source.read(read_size)
-                remaining -= len(read_content)
-                if not read_content:
-                    raise ValueError('0 byte read, expected %d' % read_size)
-                yield read_content
+        header = "%s\x00%s\x00%s\x00" % (self.path, self.type, content_bytes)
+        if encoding is not None and content and content.kind == 'file':
+            header += encoding + '\x00'
+        return header, content
 
     def get_file(self):
         """Get a file like object for file content for this action."""
@@ -747,17 +1624,46 @@ class TransportAction(Action):
     """An Action which gets file content from a transport.
     
     :ivar sourcedir: Transport to read file content from.
+    :ivar small_files: None, or an l_mirror.hashcache.SmallFiles to get file
+        content from in preference to sourcedir.
+    :ivar signatures: None, or a cache of the delta signatures of file
+        content, with get(path, sha1) and add(path, sha1, signature) methods,
+        such as an l_mirror.server.SignatureCache.
     """
 
-    def __init__(self, action_type, path, content, sourcedir, ui):
+    def __init__(self, action_type, path, content, sourcedir, ui,
+        small_files=None, signatures=None):
         Action.__init__(self, action_type, path, content)
         self.sourcedir = sourcedir
         self.ui = ui
+        self.small_files = small_files
+        self.signatures = signatures
 
     def get_file(self):
         """Get the content for a new file as a file-like object."""
+        if self.small_files is not None:
+            if self.type == 'replace':
+                content = self.content[1]
+            else:
+                content = self.content
+            file_bytes = self.small_files.get(content.sha1)
+            if file_bytes is not None:
+                return StringIO(file_bytes)
         return self.sourcedir.get(self.path)
 
+    def get_signature(self):
+        if self.signatures is None:
+            return Action.get_signature(self)
+        if type(self.content) is tuple:
+            sha1 = self.content[1].sha1
+        else:
+            sha1 = self.content.sha1
+        signature = self.signatures.get(self.path, sha1)
+        if signature is None:
+            signature = Action.get_signature(self)
+            self.signatures.add(self.path, sha1, signature)
+        return signature
+
     def ignore_file(self):
         if type(self.content) is tuple:
             content = self.content[1]
@@ -768,14 +1674,28 @@ class TransportAction(Action):
 
 
 class StreamedAction(Action):
-    """An Action which gets file content from a FromFileGenerator."""
+    """An Action which gets file content from a FromFileGenerator.
 
-    def __init__(self, action_type, path, content, generator, ui):
+    :ivar encoding: None or 'identity' for raw file content in the stream,
+        'zlib' for compressed content or 'delta' for a signature of the
+        content.
+    """
+
+    def __init__(self, action_type, path, content, generator, ui,
+        encoding=None):
         Action.__init__(self, action_type, path, content)
         self.generator = generator
         self.ui = ui
+        self.encoding = encoding
 
     def get_file(self):
+        if self.type == 'move':
+            # Only wanted when the source is missing locally.
+            if self.generator.content_source is None:
+                raise ValueError('content for moved path %r is not in the '
+                    'stream' % self.path)
+            return self.generator.content_source.get_whole_file(self.path,
+                self.content[1].sha1)
         if self.type == 'replace':
             content = self.content[1]
         else:
@@ -783,6 +1703,14 @@ class StreamedAction(Action):
         if content.kind != 'file':
             raise ValueError('invalid call to get_file: kind is %r' %
                 content.kind)
+        if self.encoding == 'zlib':
+            return ZlibFile(self.generator, content.length, self.ui)
+        if self.encoding == 'delta':
+            signature = _read_frame(self.generator)
+            if self.generator.delta_source is None:
+                raise ValueError('unexpected delta for %r' % self.path)
+            return self.generator.delta_source.get_file(self.path, signature,
+                content.length, content.sha1)
         return BufferedFile(self.generator, content.length, self.ui)
 
     def ignore_file(self):
@@ -792,7 +1720,7 @@ class StreamedAction(Action):
             content = self.content
         self.ui.output_log(
             4, __name__, 'Ignoring %s %r' % (content.kind, self.path))
-        if self.type != 'del':
+        if self.type in ('new', 'replace') and content.kind == 'file':
             self.get_file().close()
 
 
@@ -820,53 +1748,259 @@ class BufferedFile(object):
             self.read()
 
 
+class ZlibFile(object):
+    """A file-like object which decompresses zlib frames from a stream.
+
+    See the module docstring for the frame format.
+    """
+
+    def __init__(self, generator, remaining, ui):
+        self.generator = generator
+        self.remaining = remaining
+        self.ui = ui
+        self._decompressor = zlib.decompressobj()
+        self._buffered = ''
+        self._finished = False
+
+    def read(self, count=None):
+        if count is None or count < 0:
+            count = self.remaining
+        read_size = min(self.remaining, count)
+        self.ui.output_log(1, __name__, "Reading from compressed stream, read_size=%d remaining=%d" % (read_size, self.remaining))
+        if not read_size:
+            self._drain()
+            return ''
+        self._fill()
+        if not self._buffered:
+            raise ValueError('compressed content ended %d bytes early' %
+                self.remaining)
+        read_content = self._buffered[:read_size]
+        self._buffered = self._buffered[read_size:]
+        self.remaining -= len(read_content)
+        if not self.remaining:
+            self._drain()
+        return read_content
+
+    def close(self):
+        while self.remaining:
+            self.read(65536)
+        self._drain()
+
+    def _fill(self):
+        """Decompress frames until there is output or the frames end."""
+        while not self._buffered and not self._finished:
+            frame = _read_frame(self.generator)
+            if frame:
+                self._buffered = self._decompressor.decompress(frame)
+            else:
+                self._finished = True
+                self._buffered = self._decompressor.flush()
+
+    def _drain(self):
+        """Read up to the end of the frames, which must add no content."""
+        self._fill()
+        if self._buffered:
+            raise ValueError('compressed content is longer than expected')
+
+
+
+def _read_frame(generator):
+    """Read a '<length>\x00<bytes>' frame from a FromFileGenerator's stream."""
+    length_bytes = ''
+    while True:
+        byte = generator._next_bytes(1)
+        if not byte:
+            raise ValueError('stream ended in a frame header')
+        if byte == '\x00':
+            break
+        length_bytes += byte
+    remaining = int(length_bytes)
+    pieces = []
+    while remaining:
+        piece = generator._next_bytes(remaining)
+        if not piece:
+            raise ValueError('stream ended in a frame')
+        pieces.append(piece)
+        remaining -= len(piece)
+    return ''.join(pieces)
+
+
+def _zlib_frames(chunks):
+    """Compress chunks to zlib frames (see the module docstring)."""
+    compressor = zlib.compressobj()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield '%d\x00%s' % (len(compressed), compressed)
+    compressed = compressor.flush()
+    if compressed:
+        yield '%d\x00%s' % (len(compressed), compressed)
+    yield '0\x00'
+
+
+class FileSegment(object):
+    """A region of a local file to be sent over the network as-is.
+
+    WSGI apps may return these as chunks of their response when the environ
+    has 'lmirror.file_segments' set; the l_mirror server then sends them with
+    sendfile when it is available rather than reading them into Python.
+
+    :ivar file: A file object with a fileno().
+    :ivar offset: The offset of the region within file.
+    :ivar length: The length of the region.
+    """
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return "FileSegment: %r %d+%d" % (self.file, self.offset, self.length)
+
+    def iter_bytes(self):
+        """Read the region, yielding bytestrings of at most 64KB."""
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining:
+            read_size = min(remaining, 65536)
+            read_content = self.file.read(read_size)
+            remaining -= len(read_content)
+            if not read_content:
+                raise ValueError('0 byte read, expected %d' % read_size)
+            yield read_content
+
+
 class ReplayGenerator(object):
     """Generate the data needed to perform a replay of a journal.
 
     The stream method returns a generator of objects which can be either
     converted to an action, or to bytes.
 
-    :ivar journal: The journal being generated from.
+    :ivar journal: The journal being generated from. Any object with an
+        as_groups method, such as a StreamingCombiner, can be used.
     :ivar sourcedir: The transport content is read from.
     :ivar ui: A UI for reporting with.
+    :ivar uncompressed_re: None, or a regex matching paths whose content
+        should never be compressed in encoded streams.
+    :ivar small_files: None, or an l_mirror.hashcache.SmallFiles to read
+        the content of small files from rather than sourcedir.
+    :ivar signatures: None, or a cache of delta signatures for the actions
+        to use (see TransportAction).
     """
 
-    def __init__(self, journal, sourcedir, ui):
+    def __init__(self, journal, sourcedir, ui, uncompressed=(),
+        small_files=None, signatures=None):
         """Create a ReplayGenerator.
 
         :param journal: The journal to replay.
         :param sourcedir: The transport to read from.
         :param ui: The ui to use for reporting.
+        :param uncompressed: An optional list of uncompiled regexes matching
+            paths whose content should not be compressed.
+        :param small_files: None, or an l_mirror.hashcache.SmallFiles kept
+            when the journals were written.
+        :param signatures: None, or a cache of delta signatures (see
+            TransportAction).
         """
         self.journal = journal
         self.sourcedir = sourcedir
         self.ui = ui
+        self.small_files = small_files
+        self.signatures = signatures
+        if uncompressed:
+            self.uncompressed_re = re.compile('|'.join(
+                '(?:%s)' % re_str for re_str in uncompressed))
+        else:
+            self.uncompressed_re = None
 
     def stream(self):
         """Generate the stream."""
         groups = self.journal.as_groups()
         for group in groups:
             for action, path, content in group:
-                yield TransportAction(
-                    action, path, content, self.sourcedir, self.ui)
+                yield TransportAction(action, path, content,
+                    self.sourcedir, self.ui, small_files=self.small_files,
+                    signatures=self.signatures)
+
+    def as_bytes(self, encoding=None, delta=False):
+        """Return a generator of bytestrings for this generator's content.
+
+        :param encoding: None for a plain stream, or one of STREAM_ENCODINGS
+            for an encoded stream compressing file content with it where that
+            is worthwhile.
+        :param delta: If True, generate an encoded stream sending the
+            signatures of large replaced files rather than their content.
+        """
+        self._check_encoding(encoding)
+        if encoding is not None or delta:
+            yield ENCODED_STREAM_MARKER
+        for item in self.stream():
+            for segment in item.as_bytes(
+                self._encoding_for(item, encoding, delta)):
+                yield segment
 
-    def as_bytes(self):
-        """Return a generator of bytestrings for this generator's content."""
+    def as_segments(self, encoding=None, delta=False):
+        """Return a generator of bytestrings and FileSegments for the content.
+
+        See Action.as_segments and as_bytes.
+        """
+        self._check_encoding(encoding)
+        if encoding is not None or delta:
+            yield ENCODED_STREAM_MARKER
         for item in self.stream():
-            for segment in item.as_bytes():
+            for segment in item.as_segments(
+                self._encoding_for(item, encoding, delta)):
                 yield segment
 
+    def _check_encoding(self, encoding):
+        if encoding is not None and encoding not in STREAM_ENCODINGS:
+            raise ValueError('unknown stream encoding %r' % encoding)
+
+    def _encoding_for(self, action, encoding, deltas):
+        """Choose the encoding to send the content of action with."""
+        if encoding is None and not deltas:
+            return None
+        if action.type in ('replace', 'move'):
+            content = action.content[1]
+        else:
+            content = action.content
+        if content.kind != 'file':
+            return 'identity'
+        compressed = (
+            os.path.splitext(action.path)[1].lower() in COMPRESSED_SUFFIXES)
+        # Compressed files change throughout when their content changes, so
+        # there is nothing to gain from sending them as deltas.
+        if (deltas and action.type == 'replace' and not compressed and
+            action.content[0].kind == 'file' and
+            content.length >= delta.MIN_DELTA_SIZE):
+            return 'delta'
+        if (encoding is None or content.length < MIN_COMPRESS_SIZE or
+            compressed or (self.uncompressed_re is not None and
+             self.uncompressed_re.search(action.path))):
+            return 'identity'
+        return encoding
+
 
 class FromFileGenerator(object):
     """A ReplayGenerator that pulls from a file in read-once, no-seeking mode.
 
-    This is used for streaming from HTTP servers.
+    This is used for streaming from HTTP servers. Both plain and encoded
+    streams are understood.
+
+    :ivar delta_source: None, or the delta.DeltaSource used to reconstruct
+        file content sent as deltas.
+    :ivar content_source: None, or a delta.DeltaSource to fetch the content
+        of moved files from when their source is missing or changed locally,
+        as streams do not carry it.
     """
 
-    def __init__(self, stream, ui):
+    def __init__(self, stream, ui, delta_source=None, content_source=None):
         self._stream = stream
         self.buffered_bytes = []
         self.ui = ui
+        self.delta_source = delta_source
+        self.content_source = content_source
 
     def parse_kind_data(self, tokens, pos):
         kind = tokens[pos]
@@ -877,6 +2011,7 @@ class FromFileGenerator(object):
                 mtime = None
             else:
                 mtime = float(mtime)
+            hash_name(tokens[pos])
             return FileContent(tokens[pos], int(tokens[pos+1]), mtime), pos + 3
         elif kind == 'dir':
             return DirContent(), pos
@@ -887,6 +2022,10 @@ class FromFileGenerator(object):
 
     def stream(self):
         """Generate an object-level stream."""
+        marker = self._next_bytes(len(ENCODED_STREAM_MARKER))
+        encoded = marker == ENCODED_STREAM_MARKER
+        if marker and not encoded:
+            self._push(marker)
         while True:
             # TODO: make this more efficient: but wait till its shown to be a
             # key issue to address.
@@ -903,10 +2042,26 @@ class FromFileGenerator(object):
                 kind_data1, pos = self.parse_kind_data(tokens, 2)
                 kind_data2, pos = self.parse_kind_data(tokens, pos)
                 kind_data = kind_data1, kind_data2
+            elif action == 'move':
+                kind_data2, pos = self.parse_kind_data(tokens, 3)
+                kind_data = tokens[2], kind_data2
             else:
                 raise ValueError('unknown action %r' % action)
+            if action in ('replace', 'move'):
+                content = kind_data[1]
+            else:
+                content = kind_data
+            encoding = None
+            if (encoded and action in ('new', 'replace') and
+                content.kind == 'file'):
+                encoding = tokens[pos]
+                pos += 1
+                if (encoding not in ('identity', 'delta') and
+                    encoding not in STREAM_ENCODINGS):
+                    raise ValueError('unknown content encoding %r' % encoding)
             self._push('\x00'.join(tokens[pos:]))
-            yield StreamedAction(action, path, kind_data, self, self.ui)
+            yield StreamedAction(action, path, kind_data, self, self.ui,
+                encoding)
 
     def _next_bytes(self, count):
         """Return up to count bytes.
@@ -971,6 +2126,49 @@ class CancellableDelete:
             pass
 
 
+class ContentIndex(object):
+    """An index of the files in a tree by their content.
+
+    TransportReplay uses this to find local files with content it needs. The
+    index is only a hint: files are checked before their content is used.
+    """
+
+    def __init__(self, tree=None):
+        """Create a ContentIndex.
+
+        :param tree: An optional tree (see Combiner.as_tree) to index.
+        """
+        self._entries = {}
+        if tree is not None:
+            self._add_tree(tree, '')
+
+    def _add_tree(self, tree, prefix):
+        for name, content in tree.iteritems():
+            path = prefix + name
+            if type(content) is dict:
+                self._add_tree(content, path + '/')
+            elif content.kind == 'file':
+                self.add(path, content)
+
+    def add(self, path, content):
+        """Record that path has file content content."""
+        entries = self._entries.setdefault(content.sha1, [])
+        if (path, content) not in entries:
+            entries.append((path, content))
+
+    def find(self, content):
+        """Get the paths which may have file content content."""
+        return [path for path, found in self._entries.get(content.sha1, ())
+            if found.length == content.length]
+
+    def find_sha1(self, sha1):
+        """Get the files which may have content with sha1.
+
+        :return: A list of (path, content) tuples.
+        """
+        return list(self._entries.get(sha1, ()))
+
+
 class TransportReplay(object):
     """Replay a journal reading content from a transport.
 
@@ -982,9 +2180,15 @@ class TransportReplay(object):
     :ivar contentdir: The transport to apply changes to.
     :ivar journal: The journal to apply.
     :ivar ui: A UI for reporting with.
+    :ivar throttle: None, or a bandwidth.Throttle limiting the rate content
+        is read at.
+    :ivar content_index: None, or a ContentIndex of contentdir. When set, new
+        file content which is already present locally is hardlinked (or, if
+        that is not possible, copied) rather than read from the generator.
     """
 
-    def __init__(self, journal, generator, contentdir, ui):
+    def __init__(self, journal, generator, contentdir, ui, throttle=None,
+        content_index=None):
         """Create a TransportReplay for journal from generator to contentdir.
 
         :param journal: The journal to replay.
@@ -992,11 +2196,17 @@ class TransportReplay(object):
             actions it supplies are cross checked against journal.
         :param contentdir: The transport to apply changes to.
         :param ui: The ui to use for reporting.
+        :param throttle: If not None, a bandwidth.Throttle to limit the rate
+            content is read at.
+        :param content_index: If not None, a ContentIndex of the content in
+            contentdir to reuse content from.
         """
         self.journal = journal
         self.generator = generator.stream()
         self.contentdir = contentdir
         self.ui = ui
+        self.throttle = throttle
+        self.content_index = content_index
 
     def replay(self):
         """Replay the journal."""
@@ -1034,6 +2244,9 @@ class TransportReplay(object):
                         cancellable = CancellableDelete(
                             content, self.contentdir, path, self.ui)
                         to_delete.append(cancellable)
+                    if action == 'move':
+                        to_rename.append(self.move_with_check(path,
+                            content[0], content[1], action_obj, to_delete))
                 for cancellable in to_delete:
                     # Second pass on the group to handle deletes as late as possible
                     cancellable.delete()
@@ -1041,6 +2254,59 @@ class TransportReplay(object):
                 for doit in to_rename:
                     doit()
 
+    def move_with_check(self, path, source, content, action, to_delete):
+        """Move source to path, checking that source has content.
+
+        Files are renamed to a temporary name immediately and into place
+        later, so that moves onto paths that are themselves being moved work.
+        Directories and symlinks are created at path straight away, and the
+        old ones are deleted once their children have been moved. If source
+        does not have the expected content - for instance if the mirror was
+        modified locally - the content is obtained as for a new file instead.
+
+        :param path: A relpath to move to.
+        :param source: The relpath to move from.
+        :param content: A content description of the path.
+        :param action: An action object which can supply file content.
+        :param to_delete: A list to add the CancellableDelete of the source
+            to, when it needs deleting.
+        :return: A callable that will execute the rename-into-place.
+        """
+        self.ui.output_log(4, __name__, 'Moving %s %r to %r' % (
+            content.kind, source, path))
+        self._ensure_parents(path)
+        cancellable = CancellableDelete(content, self.contentdir, source,
+            self.ui)
+        if content.kind != 'file':
+            self.put_with_check(path, content, action)()
+            # Children are moved after their parents, so delete them first.
+            to_delete.insert(0, cancellable)
+            return lambda:None
+        try:
+            present = self.check_file(source, content)
+        except (ValueError, IOError):
+            present = False
+        if not present:
+            self.ui.output_log(5, __name__,
+                'Content for %r missing from %r' % (path, source))
+            to_delete.append(cancellable)
+            return self.put_with_check(path, content, action)
+        tempname = '%s.lmirrortemp' % path
+        if self.contentdir.has(tempname):
+            self.contentdir.delete(tempname)
+        self.contentdir.rename(source, tempname)
+        action.ignore_file()
+        if self.content_index is not None:
+            self.content_index.add(path, content)
+        return lambda: self.ensure_file(tempname, path, content)
+
+    def _ensure_parents(self, path):
+        """Ensure that the parent directories of path exist."""
+        parent = path.rpartition('/')[0]
+        if parent and not self.contentdir.has(parent):
+            self._ensure_parents(parent)
+            self.ensure_dir(parent)
+
     def ensure_dir(self, path):
         """Ensure that path is a dir.
 
@@ -1066,10 +2332,10 @@ class TransportReplay(object):
             f = self.contentdir.get(path)
             try:
                 self.ui.output_log(4, __name__, 'Hashing %s %r' % (content.kind, path))
-                size, sha1 = osutils.size_sha_file(f)
+                size, digest = hash_file(f, content.hash_name)
             finally:
                 f.close()
-            return sha1 == content.sha1 and size == content.length
+            return digest == content.sha1 and size == content.length
         except errors.NoSuchFile:
             return False
 
@@ -1130,40 +2396,117 @@ class TransportReplay(object):
             # If we can't read the file for some reason, we obviously need to
             # write it :).
             pass
+        if (self.content_index is not None and
+            self._reuse_local(tempname, path, content)):
+            action.ignore_file()
+            self.content_index.add(path, content)
+            return lambda: self.ensure_file(tempname, path, content)
         a_file = action.get_file()
-        source = _ShaFile(a_file)
         try:
-            # FIXME: mode should be supplied from above, or use 0600 and chmod
-            # later.
-            stream = self.contentdir.open_write_stream(tempname, 0644)
-            try:
-                size = osutils.pumpfile(source, stream)
-            finally:
-                stream.close()
-            # TODO: here is where we should check for a mirror-is-updating
-            # case.
-            if size != content.length or source.sha1.hexdigest() != content.sha1:
-                self.contentdir.delete(tempname)
-                raise ValueError(
-                    'read incorrect content for %r, got sha %r wanted %r' % (
-                    path, source.sha1.hexdigest(), content.sha1))
-            if content.mtime is not None:
-                try:
-                    temppath = self.contentdir.local_abspath(tempname)
-                except errors.NotLocalUrl, e:
-                    # swallow NotLocalUrl errors: they primarily indicate that
-                    # the test suite is running against memory, with files that
-                    # don't exist.
-                    self.ui.output_log(4, __name__,
-                        'Failed to set mtime for %r - nonlocal url %r.' % (
-                        tempname, self.contentdir))
-                else:
-                    # Perhaps the first param - atime - should be 'now'.
-                    os.utime(temppath, (content.mtime, content.mtime))
+            if self.throttle is None:
+                self._write_temp(tempname, path, content, a_file)
+            else:
+                self._write_temp(tempname, path, content,
+                    self.throttle.reader(a_file))
         finally:
             a_file.close()
+        if self.content_index is not None:
+            self.content_index.add(path, content)
         return lambda: self.ensure_file(tempname, path, content)
 
+    def _write_temp(self, tempname, path, content, a_file):
+        """Write the content of a_file to tempname, checking it is content.
+
+        :raises ValueError: If a_file did not have the expected content.
+        """
+        source = _ShaFile(a_file, content.hash_name)
+        # FIXME: mode should be supplied from above, or use 0600 and chmod
+        # later.
+        stream = self.contentdir.open_write_stream(tempname, 0644)
+        if self.throttle is not None:
+            # Lets an adaptive throttle see how fast we can write.
+            stream = self.throttle.writer(stream)
+        try:
+            size = osutils.pumpfile(source, stream)
+        finally:
+            stream.close()
+        # TODO: here is where we should check for a mirror-is-updating
+        # case.
+        if size != content.length or source.digest() != content.sha1:
+            self.contentdir.delete(tempname)
+            raise ValueError(
+                'read incorrect content for %r, got sha %r wanted %r' % (
+                path, source.digest(), content.sha1))
+        if content.mtime is not None:
+            try:
+                temppath = self.contentdir.local_abspath(tempname)
+            except errors.NotLocalUrl, e:
+                # swallow NotLocalUrl errors: they primarily indicate that
+                # the test suite is running against memory, with files that
+                # don't exist.
+                self.ui.output_log(4, __name__,
+                    'Failed to set mtime for %r - nonlocal url %r.' % (
+                    tempname, self.contentdir))
+            else:
+                # Perhaps the first param - atime - should be 'now'.
+                os.utime(temppath, (content.mtime, content.mtime))
+
+    def _reuse_local(self, tempname, path, content):
+        """Try to put content at tempname from a local file that has it.
+
+        :return: True if tempname now has the content.
+        """
+        for candidate in self.content_index.find(content):
+            if candidate == path:
+                # check_file has already looked at path.
+                continue
+            if (self._link_local(candidate, tempname, content) or
+                self._copy_local(candidate, tempname, path, content)):
+                self.ui.output_log(4, __name__, 'Reused %r for %r' % (
+                    candidate, path))
+                return True
+        return False
+
+    def _link_local(self, candidate, tempname, content):
+        """Hardlink candidate to tempname if it has content.
+
+        The mtime of hardlinked files is left alone, as it is shared with
+        candidate.
+        """
+        try:
+            source = self.contentdir.local_abspath(candidate)
+            target = self.contentdir.local_abspath(tempname)
+        except errors.NotLocalUrl:
+            return False
+        if self.contentdir.has(tempname):
+            self.contentdir.delete(tempname)
+        try:
+            os.link(source, target)
+        except OSError:
+            # Missing, a directory, or on a filesystem without hardlinks.
+            return False
+        try:
+            if self.check_file(tempname, content):
+                return True
+        except (ValueError, IOError):
+            pass
+        self.contentdir.delete(tempname)
+        return False
+
+    def _copy_local(self, candidate, tempname, path, content):
+        """Copy candidate to tempname if it has content."""
+        try:
+            a_file = self.contentdir.get(candidate)
+        except (errors.PathError, errors.ReadError, IOError):
+            return False
+        try:
+            self._write_temp(tempname, path, content, a_file)
+        except (ValueError, IOError):
+            return False
+        finally:
+            a_file.close()
+        return True
+
 
 class _ShaFile(object):
     """Pretend to be a file, calculating the sha and size.
@@ -1174,12 +2517,17 @@ class _ShaFile(object):
     XXX: I'm sure this is a dup with something bzrlib or somewhere else. Find
     and reuse.
 
-    :ivar sha1: A sha1 object.
+    :ivar sha1: A hash object, for the hash called name.
     """
 
-    def __init__(self, a_file):
+    def __init__(self, a_file, name='sha1'):
         self.a_file = a_file
-        self.sha1 = sha()
+        self.name = name
+        self.sha1 = new_hash(name)
+
+    def digest(self):
+        """Get the digest so far, formatted as for FileContent.sha1."""
+        return format_digest(self.name, self.sha1.hexdigest())
 
     def read(self, amount=None):
         result = self.a_file.read(amount)
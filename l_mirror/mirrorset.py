@@ -38,10 +38,12 @@ from bzrlib import urlutils
 from bzrlib.errors import NoSuchFile, NotLocalUrl
 from bzrlib.transport import get_transport
 
-from l_mirror import gpg, journals
+from l_mirror import (changes as _changes, checksums, delta, gpg,
+    hashcache, journals)
 
 
-def initialise(base, name, content_root, ui):
+def initialise(base, name, content_root, ui, hash_name=None,
+    detect_moves=False):
     """Create a mirrorset at transport, called name, mirroring content_root.
 
     :param base: The directory under which to put the mirror set
@@ -50,8 +52,14 @@ def initialise(base, name, content_root, ui):
     :param content_root: The root of the content to be mirrored. A
         bzrlib.transport.Transport.
     :param ui: A l_mirror.ui.AbstractUI.
+    :param hash_name: None, or the hash to record file content with, from
+        journals.HASHES. Defaults to sha1.
+    :param detect_moves: If True, journal moved content as moves, which only
+        receivers that support moves can read.
     :return: A MirrorSet object.
     """
+    if hash_name is not None and hash_name not in journals.HASHES:
+        raise ValueError('unknown hash %r' % hash_name)
     setdir = base.clone('.lmirror/sets/%s' % name)
     ui.output_log(8, 'l_mirror.mirrorset', 'Creating mirrorset %s at %s'
         % (name, base.base))
@@ -70,7 +78,12 @@ def initialise(base, name, content_root, ui):
     content_relative = urlutils.relative_url(base.base, content_root.base[:-1])
     if not content_relative:
         content_relative = '.'
-    setdir.put_bytes('set.conf', '[set]\ncontent_root = %s\n' % content_relative)
+    set_conf = '[set]\ncontent_root = %s\n' % content_relative
+    if hash_name is not None:
+        set_conf += 'hash = %s\n' % hash_name
+    if detect_moves:
+        set_conf += 'detect_moves = True\n'
+    setdir.put_bytes('set.conf', set_conf)
     metadir = base.clone('.lmirror/metadata/%s' % name)
     metadir.create_prefix()
     metadir.put_bytes('format', '1\n')
@@ -106,6 +119,8 @@ class _MirrorSet(object):
     * set.conf: The configuration file. This shoud have one section:
       [set]
       content_root=<relpath to root>
+      hash=<hash to record content with; sha1 if not set>
+      detect_moves=True|False # journal moves; False if not set.
     There is also state data in 
     <basedir>/.lmirror/metadata/<name>/:
     * format : Marker to allow compatibility.
@@ -127,12 +142,20 @@ class _MirrorSet(object):
     :ivar filter_programs: () if not loaded from disk, or the list of programs
         and arguments to run and use when scanning for changes in this
         mirrorset.
+    :ivar uncompressed: () if not loaded from disk, or the regexes of paths
+        whose content is never compressed in streams.
+    :ivar caches: () if not loaded from disk, or a list of (kind, argument)
+        tuples for the caches kept when scanning - see l_mirror.hashcache.
     :ivar ui: The AbstractUI output is fed to.
     :ivar gpg_strategy: A bzrlib.gpg.GPGStrategy used for doing gpg signatures.
     :ivar gpgv_strategy: A l_mirror.gpg.GPGVStrategy for doing signature
         checking.
     """
 
+    # How long get_latest waits for a new journal, and how often it checks.
+    LATEST_TIMEOUT = 25
+    LATEST_POLL_INTERVAL = 1
+
     def __init__(self, base, name, ui):
         """Open an existing MirrorSet.
 
@@ -147,6 +170,11 @@ class _MirrorSet(object):
         self.excludes = ()
         self.includes = ()
         self.filter_programs = ()
+        self.uncompressed = ()
+        self.checksum_sources = ()
+        self.caches = ()
+        # (start, stop, Combiner) from _combine_journals.
+        self._combined = None
         self.gpg_strategy = gpg.SimpleGPGStrategy(None)
         try:
             self.gpgv_strategy = gpg.GPGVStrategy(
@@ -155,13 +183,18 @@ class _MirrorSet(object):
             # won't be able to do gpgv calls.
             self.gpgv_strategy = None
 
-    def finish_change(self, dryrun=False):
+    def finish_change(self, dryrun=False, prerender=0, manifest=None):
         """Scan the mirror set for changes and write a new journal entry.
 
         This will set updating=False and update the timestamp in the metadata.
 
         :param dryrun: If True perform the content scan (and log/report it as
             appropriate) but do not change the metadata or write a new journal.
+        :param prerender: If non-zero, the number of streams to pre-render for
+            smart servers once the change is finished - see render_streams.
+        :param manifest: If not None, a dict of the paths changed, as returned
+            by journals.parse_manifest. Only those paths are looked at: the
+            rest of the content is assumed to be unchanged.
         """
         metadata = self._get_metadata()
         if metadata.get('metadata', 'updating') != 'True':
@@ -173,27 +206,52 @@ class _MirrorSet(object):
         now = time.time()
         basis = int(metadata.get('metadata', 'basis'))
         latest = int(metadata.get('metadata', 'latest'))
+        rescan = None
+        changes = None
+        if manifest is None:
+            # A watcher running alongside us knows the changes without a
+            # server.
+            changes = self._read_change_log(last)
         if metadata.has_option('metadata', 'server'):
             server_url = metadata.get('metadata', 'server')
             server_transport = get_transport(server_url)
             try:
-                changes_bytes = server_transport.get_bytes('changes/%s' % self.name)
-                # TODO: May require URL decoding to match the transport interface.
-                changes = sorted(path.encode('utf8') for path in
-                    json.loads(changes_bytes))
+                if changes is None and manifest is None:
+                    changes_bytes = server_transport.get_bytes(
+                        'changes/%s/grouped' % self.name)
+                    if changes_bytes.startswith(_changes.HEADER):
+                        # Grouped by directory, with the directories to scan.
+                        changes = _changes.parse(changes_bytes)
+                    else:
+                        # Older servers ignore 'grouped' and send JSON.
+                        changes = json.loads(changes_bytes)
+                        if isinstance(changes, dict):
+                            rescan = [path.encode('utf8')
+                                for path in changes['scan']]
+                            changes = changes['changes']
+                        # TODO: May require URL decoding to match the
+                        # transport interface.
+                        changes = sorted(path.encode('utf8')
+                            for path in changes)
             except NoSuchFile:
                 server_transport = None
                 changes = None
         else:
             server_transport = None
-            changes = None
         current_state = self._combine_journals(basis, latest)
         filter_callback = self._get_filter_callback()
         try:
             updater = journals.DiskUpdater(current_state,
                 self._content_root_dir(), self.name, last, self.ui,
                 includes = self.get_includes(), excludes=self.get_excludes(),
-                filter_callback=filter_callback, known_changes=changes)
+                filter_callback=filter_callback, known_changes=changes,
+                rescan=rescan, manifest=manifest,
+                checksums=checksums.get_source(self._content_root_dir(),
+                    self.get_checksum_sources()),
+                hash_name=self.get_hash_name(),
+                detect_moves=self.get_detect_moves(),
+                hash_cache=self.get_hash_cache(),
+                small_files=self.get_small_files())
             journal = updater.finished()
             if not dryrun and journal.paths:
                 next_id = latest + 1
@@ -209,7 +267,15 @@ class _MirrorSet(object):
                 self.ui.output_rest('No changes found in mirrorset.')
             metadata.set('metadata', 'updating', 'False')
             if not dryrun:
+                # Before the metadata, so that streams of the new journal
+                # find the small files.
+                if updater.small_files is not None:
+                    updater.small_files.save()
+                if updater.hash_cache is not None:
+                    updater.hash_cache.save()
                 self._set_metadata(metadata)
+                if prerender:
+                    self.render_streams(prerender)
                 if server_transport is not None:
                     server_transport.get_bytes('updated/%s' % self.name)
         finally:
@@ -217,6 +283,21 @@ class _MirrorSet(object):
                 # Signal it should close and wait for it.
                 filter.proc.communicate('')
 
+    def _read_change_log(self, last):
+        """Read the changes since last from a watcher's change log.
+
+        :return: None if there is no watcher writing a change log for this set
+            or it cannot answer, or an l_mirror.changes.Changes.
+        """
+        try:
+            path = self._metadatadir().local_abspath(_changes.CHANGE_LOG)
+        except NotLocalUrl:
+            return None
+        result = _changes.read_log(path, last)
+        if result is not None:
+            result.aggregate()
+        return result
+
     def get_excludes(self):
         if self.excludes == ():
             self._parse_content_conf()
@@ -227,6 +308,48 @@ class _MirrorSet(object):
             self._parse_content_conf()
         return self.includes
 
+    def get_uncompressed(self):
+        if self.uncompressed == ():
+            self._parse_content_conf()
+        return self.uncompressed
+
+    def get_checksum_sources(self):
+        """Get the (kind, path) of each configured checksum source."""
+        if self.checksum_sources == ():
+            self._parse_content_conf()
+        return self.checksum_sources
+
+    def get_caches(self):
+        """Get the (kind, argument) of each configured cache."""
+        if self.caches == ():
+            self._parse_content_conf()
+        return self.caches
+
+    def get_hash_cache(self):
+        """Get the hash cache for this set.
+
+        :return: None if content.conf does not ask for one, or an
+            l_mirror.hashcache.HashCache.
+        """
+        for kind, _ in self.get_caches():
+            if kind == 'hashes':
+                return hashcache.HashCache(self._metadatadir())
+        return None
+
+    def get_small_files(self):
+        """Get the small file pack for this set.
+
+        :return: None if content.conf does not ask for one, or an
+            l_mirror.hashcache.SmallFiles.
+        """
+        for kind, argument in self.get_caches():
+            if kind == 'small-files':
+                if argument:
+                    return hashcache.SmallFiles(self._metadatadir(),
+                        int(argument))
+                return hashcache.SmallFiles(self._metadatadir())
+        return None
+
     def _get_filter_callback(self):
         if self.filter_programs == ():
             self._parse_content_conf()
@@ -237,6 +360,38 @@ class _MirrorSet(object):
             filters.append(journals.ProcessFilter(proc, self.ui, program))
         return journals.FilterCombiner(*filters)
 
+    def get_latest(self, after=None, timeout=None, interval=None):
+        """Get the latest journal id and timestamp of the mirror set.
+
+        :param after: If not None, a journal id: wait for a later journal
+            than it, up to timeout seconds.
+        :param timeout: The most seconds to wait for when after is given.
+            None waits for LATEST_TIMEOUT seconds. Smart servers decide how
+            long to wait for themselves.
+        :param interval: How often to check the metadata for a later journal
+            while waiting. None checks every LATEST_POLL_INTERVAL seconds.
+            Smart servers are not polled, but answer as soon as there is a
+            later journal.
+        :return: A tuple (latest, timestamp), where timestamp is the string
+            from the metadata. If the wait timed out, latest may be after.
+        """
+        if timeout is None:
+            timeout = self.LATEST_TIMEOUT
+        if interval is None:
+            interval = self.LATEST_POLL_INTERVAL
+        deadline = time.time() + timeout
+        while True:
+            metadata = self._get_metadata()
+            latest = int(metadata.get('metadata', 'latest'))
+            timestamp = metadata.get('metadata', 'timestamp')
+            if after is None or latest > after:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, interval))
+        return latest, timestamp
+
     def get_server(self):
         """Get the current server for this node from metadata.conf."""
         metadata = self._get_metadata()
@@ -277,7 +432,21 @@ class _MirrorSet(object):
         metadata.set('metadata', 'updating', 'False')
         self._set_metadata(metadata)
 
-    def get_generator(self, from_journal, to_journal):
+    def get_combined(self, from_journal, to_journal):
+        """Get the combination of some journals.
+
+        :param from_journal: The first journal to include.
+        :param to_journal: The last journal to include.
+        :return: A journals.StreamingCombiner.
+        """
+        needed = range(from_journal, to_journal + 1)
+        combiner = journals.StreamingCombiner()
+        journal_dir = self._journaldir()
+        for journal_id in needed:
+            combiner.add_file(journal_dir, str(journal_id))
+        return combiner
+
+    def get_generator(self, from_journal, to_journal, basis=None):
         """Get a ReplayGenerator for some journals.
 
         Signatures are not checked - the client should be cross checking and
@@ -285,28 +454,83 @@ class _MirrorSet(object):
 
         :param from_journal: The first journal to include.
         :param to_journal: The last journal to include.
+        :param basis: None, or a transport with the receiver's existing
+            content, which generators that support deltas (see l_mirror.delta)
+            reuse content from. Mirror sets read directly from a transport
+            send whole files regardless.
+        """
+        return journals.ReplayGenerator(
+            self.get_combined(from_journal, to_journal), self._contentdir(),
+            self.ui, uncompressed=self.get_uncompressed(),
+            small_files=self.get_small_files())
+
+    def render_streams(self, count):
+        """Pre-render the streams for the last count journal ranges.
+
+        Receivers ask for a stream from the journal after the last one they
+        have up to the latest journal, so the streams for (latest - count + 1,
+        latest) ... (latest, latest) are written to the streams directory in
+        the metadata, where the smart server can send them without generating
+        them. Each range is rendered as a plain stream and as an encoded
+        stream for each of journals.STREAM_ENCODINGS (named with the encoding
+        as a suffix, e.g. 3-5.zlib). Streams for any other ranges are removed.
+
+        :param count: The number of ranges to render.
+        """
+        metadata = self._get_metadata()
+        basis = int(metadata.get('metadata', 'basis'))
+        latest = int(metadata.get('metadata', 'latest'))
+        wanted = {}
+        for from_journal in range(max(basis + 1, latest - count + 1),
+            latest + 1):
+            name = '%d-%d' % (from_journal, latest)
+            wanted[name] = from_journal, None
+            for encoding in journals.STREAM_ENCODINGS:
+                wanted['%s.%s' % (name, encoding)] = from_journal, encoding
+        streams = self._metadatadir().clone('streams')
+        streams.ensure_base()
+        present = set(streams.list_dir('.'))
+        for name in present:
+            if name not in wanted:
+                streams.delete(name)
+        for name, (from_journal, encoding) in sorted(wanted.items()):
+            if name in present:
+                continue
+            self.ui.output_log(5, 'l_mirror.mirrorset',
+                'Rendering stream %s of mirror set %s' % (name, self.name))
+            generator = self.get_generator(from_journal, latest)
+            # Write to a temporary name so that the server never sees a
+            # partial stream.
+            temp_name = name + '.tmp'
+            stream = streams.open_write_stream(temp_name)
+            try:
+                for content in generator.as_bytes(encoding):
+                    stream.write(content)
+            finally:
+                stream.close()
+            streams.rename(temp_name, name)
+
+    def receive(self, another_mirrorset, throttle=None, delta=False,
+        hardlink=False):
+        """Perform a receive from another_mirrorset.
+
+        :param throttle: If not None, a bandwidth.Throttle to limit the rate
+            content is received at.
+        :param delta: If True, ask for large replaced files to be sent as
+            deltas against the existing content.
+        :param hardlink: If True, index the existing content by sha1 and
+            hardlink (or copy, where hardlinks are not possible) files whose
+            content is already present rather than receiving them. This
+            turns renames into links rather than new content.
         """
-        needed = range(from_journal, to_journal + 1)
-        combiner = journals.Combiner()
-        journal_dir = self._journaldir()
-        for journal_id in needed:
-            journal_bytes = journal_dir.get_bytes(str(journal_id))
-            journal = journals.parse(journal_bytes)
-            combiner.add(journal)
-        return journals.ReplayGenerator(combiner.journal, self._contentdir(),
-            self.ui)
-
-    def receive(self, another_mirrorset):
-        """Perform a receive from another_mirrorset."""
         # XXX: check its a mirror of the same set. UUID or convergence?
         self.ui.output_log(5, 'l_mirror.mirrorset', 
             'Starting transmission from mirror %s at %s to %s at %s' %
             (another_mirrorset.name, another_mirrorset.base.base, self.name,
              self.base.base))
         metadata = self._get_metadata()
-        source_meta = another_mirrorset._get_metadata()
         latest = int(metadata.get('metadata', 'latest'))
-        source_latest = int(source_meta.get('metadata', 'latest'))
+        source_latest, source_timestamp = another_mirrorset.get_latest()
         signed = self._is_signed()       
         # XXX: BASIS: basis handling needed here (and thats when we
         # need non-overlapping syncing.
@@ -339,7 +563,7 @@ class _MirrorSet(object):
                 generator = journals.ReplayGenerator(minijournal,
                     another_mirrorset._contentdir(), self.ui)
                 replayer = journals.TransportReplay(minijournal, generator,
-                    self.base, self.ui)
+                    self.base, self.ui, throttle=throttle)
                 replayer.replay()
                 for journal_id in needed:
                     try:
@@ -352,13 +576,23 @@ class _MirrorSet(object):
                         journal_dir.get_bytes(str(journal_id)))
             # Now we have a journal that is GPG checked representing what we
             # want to receive.
+            if delta:
+                basis = self.base
+            else:
+                basis = None
+            if hardlink:
+                content_index = journals.ContentIndex(self._combine_journals(
+                    int(metadata.get('metadata', 'basis')), latest))
+            else:
+                content_index = None
             replayer = journals.TransportReplay(combiner.journal,
-                another_mirrorset.get_generator(latest + 1, source_latest),
-                self.base, self.ui)
+                another_mirrorset.get_generator(latest + 1, source_latest,
+                    basis=basis),
+                self.base, self.ui, throttle=throttle,
+                content_index=content_index)
             replayer.replay()
             metadata.set('metadata', 'latest', str(source_latest))
-            metadata.set('metadata', 'timestamp',
-                source_meta.get('metadata', 'timestamp'))
+            metadata.set('metadata', 'timestamp', source_timestamp)
             self._set_metadata(metadata)
         else:
             changed_paths = 0
@@ -369,13 +603,40 @@ class _MirrorSet(object):
             (changed_paths, new_journals, another_mirrorset.name,
              another_mirrorset.base.base, self.name, self.base.base))
 
-    def _combine_journals(self, start, stop):
-        """Combine a number of journals to get a tree model."""
-        model = journals.Combiner()
+    def _combine_journals(self, start, stop, keep=True):
+        """Combine a number of journals to get a tree model.
+
+        Journals never change once written, so by default the combination is
+        kept and later calls with the same start only parse the journals
+        after the last stop. This saves a long running receiver (such as
+        mirror --watch) from reparsing every journal on each receive, though
+        building the returned tree still visits every path in the set.
+
+        :param keep: If False, combine from scratch and do not keep the
+            combination. Callers that may run in several threads at once, or
+            that keep the tree themselves (such as the smart server), pass
+            False so that the set holds no state for them.
+        """
+        if (keep and self._combined is not None and
+            self._combined[0] == start and self._combined[1] <= stop):
+            _, first, model = self._combined
+            first += 1
+        else:
+            model = journals.Combiner()
+            first = start
+        if keep:
+            self._combined = None
         journaldir = self._journaldir()
-        for journal_id in range(start, stop + 1):
-            model.add(journals.parse(journaldir.get_bytes(str(journal_id))))
-        return model.as_tree()
+        for journal_id in range(first, stop + 1):
+            journal_bytes = journals.map_journal(journaldir, str(journal_id))
+            try:
+                model.add(journals.parse(journal_bytes))
+            finally:
+                journals.unmap_journal(journal_bytes)
+        tree = model.as_tree()
+        if keep:
+            self._combined = (start, stop, model)
+        return tree
 
     def _setdir(self):
         return self.base.clone('.lmirror/sets/%s' % self.name)
@@ -397,6 +658,9 @@ class _MirrorSet(object):
         includes = []
         excludes = []
         programs = []
+        uncompressed = []
+        checksum_sources = []
+        caches = []
         try:
             file_bytes = t.get_bytes('content.conf')
             for line in file_bytes.split('\n'):
@@ -408,15 +672,42 @@ class _MirrorSet(object):
                     excludes.append(line[8:])
                 elif line.startswith('program '):
                     programs.append(line[8:])
+                elif line.startswith('uncompressed '):
+                    uncompressed.append(line[13:])
+                elif line.startswith('checksums '):
+                    kind, _, path = line[10:].partition(' ')
+                    checksum_sources.append((kind, path))
+                elif line.startswith('cache '):
+                    kind, _, argument = line[6:].partition(' ')
+                    if kind not in hashcache.CACHES:
+                        raise ValueError('Unknown cache kind %r' % kind)
+                    caches.append((kind, argument))
         except NoSuchFile:
             pass
         self.includes = includes
         self.excludes = excludes
         self.filter_programs = programs
+        self.uncompressed = uncompressed
+        self.checksum_sources = checksum_sources
+        self.caches = caches
 
     def content_root_path(self):
         return self._get_settings().get('set', 'content_root')
 
+    def get_hash_name(self):
+        """Get the hash to record file content with, from set.conf."""
+        settings = self._get_settings()
+        if not settings.has_option('set', 'hash'):
+            return 'sha1'
+        return settings.get('set', 'hash')
+
+    def get_detect_moves(self):
+        """Return True if set.conf asks for moves to be journalled."""
+        settings = self._get_settings()
+        if not settings.has_option('set', 'detect_moves'):
+            return False
+        return settings.getboolean('set', 'detect_moves')
+
     def _content_root_dir(self):
         return self.base.clone(self.content_root_path())
 
@@ -453,6 +744,8 @@ class _MirrorSet(object):
 class HTTPMirrorSet(_MirrorSet):
     """Specialised MirrorSet to use an HTTP Smart server."""
 
+    _ranges = None
+
     def _metadatadir(self):
         """Get the transport for metadata."""
         return self.base.clone('metadata/%s' % self.name)
@@ -461,11 +754,42 @@ class HTTPMirrorSet(_MirrorSet):
         """Return a transport rooted at the content of this mirror set."""
         return self.base.clone('content/%s' % self.name)
 
-    def get_generator(self, from_journal, to_journal):
+    def get_latest(self, after=None, timeout=None, interval=None):
+        # The server answers from memory, and waits for new journals itself,
+        # rather than sending all of metadata.conf.
+        path = 'latest/%s' % self.name
+        if after is not None:
+            path += '/%d' % after
+        try:
+            latest_bytes = self.base.get_bytes(path)
+        except NoSuchFile:
+            # An older server, or one with too many requests already waiting.
+            return _MirrorSet.get_latest(self, after, timeout, interval)
+        latest = json.loads(latest_bytes)
+        return int(latest['latest']), str(latest['timestamp'])
+
+    def get_generator(self, from_journal, to_journal, basis=None):
+        # Ask for a zlib encoded stream: servers that do not support that
+        # send a plain stream, which FromFileGenerator also handles.
+        options = 'zlib'
+        # Ranges, and the content of moved files missing locally, are fetched
+        # while the stream is being read, so use a separate connection, kept
+        # for later receives. They are fetched by sha1 where possible, which
+        # caches can share between sets.
+        if self._ranges is None:
+            self._ranges = get_transport(self.base.base)
+        ranges = self._ranges
+        content_source = delta.DeltaSource(basis,
+            ranges.clone('content/%s' % self.name), ranges.clone('blob'))
+        delta_source = None
+        if basis is not None:
+            options += '/delta'
+            delta_source = content_source
         # Work around https://bugs.edge.launchpad.net/bzr/+bug/555032
-        code, stream = self.base._get('stream/%s/%s/%s' % (self.name, from_journal,
-            to_journal), None)
-        return journals.FromFileGenerator(stream, self.ui)
+        code, stream = self.base._get('stream/%s/%s/%s/%s' % (self.name,
+            from_journal, to_journal, options), None)
+        return journals.FromFileGenerator(stream, self.ui,
+            delta_source=delta_source, content_source=content_source)
 
 
 class OrderedConfigParser(ConfigParser.ConfigParser):
@@ -19,13 +19,21 @@
 
 """Server, the smart server for serving mirror sets."""
 
-__all__ = ['Server', 'SetWatcher']
+__all__ = ['Server', 'SetWatcher', 'JournalCache', 'SignatureCache',
+    'BlobIndex', 'LatestNotifier']
 
+from collections import OrderedDict
+import errno
+from hashlib import sha1 as sha
 import json
 import logging
 import os
+import random
+import re
+import select
+import stat
 import threading
-from time import time
+from time import sleep, time
 
 from paste import fileapp, httpexceptions, httpserver
 from paste.httpexceptions import HTTPExceptionHandler
@@ -34,9 +42,57 @@ try:
     import pyinotify
 except ImportError:
     pyinotify = None
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
 
 from bzrlib import urlutils
-from bzrlib.errors import NoSuchFile, NotLocalUrl
+from bzrlib.errors import NoSuchFile, NotLocalUrl, PathError
+
+from l_mirror import changes, eventserver, journals
+
+# 64MB of combined journals.
+JOURNAL_CACHE_SIZE = 64 * 1024 * 1024
+# 16MB of delta signatures: a signature is about 1/500th of its file.
+SIGNATURE_CACHE_SIZE = 16 * 1024 * 1024
+# The HTTP server engines a Server can use.
+ENGINES = ('paste', 'event')
+# Blobs never change, so caches may keep them for as long as they like: a
+# year is the longest max-age HTTP/1.1 caches are asked to honour.
+BLOB_MAX_AGE = 365 * 24 * 3600
+# How long a /latest/ request waits for a new journal before answering with
+# the current one. This is kept under the 30 seconds after which paste's
+# thread pool reports a request as hung.
+LONG_POLL_TIMEOUT = 25
+# Subscribers to /events/ are told of a new journal after a random delay of
+# up to EVENT_JITTER seconds, so that they do not all fetch it at once.
+EVENT_JITTER = 10
+# How often an idle event stream sends a comment, so that proxies and
+# clients do not time it out.
+EVENT_KEEPALIVE = 15
+# How long an event stream stays open before the subscriber has to
+# reconnect: threads are held for less time than paste's hung thread limit,
+# while the event engine can keep streams open much longer.
+EVENT_STREAM_DURATION = {False: LONG_POLL_TIMEOUT, True: 3600}
+# The threads in the paste engine's pool.
+PASTE_THREADS = 10
+# The most paste threads that requests waiting for new journals (/latest/
+# long polls and /events/ streams) may hold at once, so that they cannot
+# starve requests for content. Past this, waiting requests are refused as
+# though the server could not wait, and clients fall back to polling. The
+# event engine waits without holding threads, so has no limit.
+PASTE_WAITERS = PASTE_THREADS // 2
+# The most changed paths a SetWatcher keeps for each content root; about
+# 200 bytes each.
+CHANGES_LIMIT = 1000000
+# The file in a set's metadata directory where a SetWatcher saves the
+# directories it walked.
+DIR_INDEX = 'inotify-dirs'
+# Change logs are rewritten when they hold this many more records than twice
+# the changes being kept.
+LOG_SLACK = 10000
+
 
 class Server(object):
     """A server of mirror sets.
@@ -56,17 +112,49 @@ class Server(object):
         served.
     :ivar ui: An l_mirror.ui.AbstractUI to report via.
     :ivar set_watcher: A SetWatcher if inotify is enabled, or None.
+    :ivar shaper: A bandwidth.Shaper limiting the bandwidth used for content,
+        or None.
+    :ivar journal_cache: A JournalCache of the combined journals used to
+        serve streams.
+    :ivar signature_cache: A SignatureCache of the delta signatures sent in
+        streams.
+    :ivar blob_index: A BlobIndex of the content of the served sets by sha1.
+    :ivar latest: A LatestNotifier tracking the latest journal of each set.
+    :ivar event_jitter: The most seconds to delay telling each /events/
+        subscriber about a new journal.
+    :ivar engine: The HTTP server engine in use, one of ENGINES.
+    :ivar waiters: A Semaphore of the paste threads that requests waiting
+        for new journals may hold; see PASTE_WAITERS.
     """
 
-    def __init__(self, ui):
-        """Create a Server reporting to ui."""
+    def __init__(self, ui, journal_cache_size=JOURNAL_CACHE_SIZE,
+        engine='paste'):
+        """Create a Server reporting to ui.
+
+        :param journal_cache_size: The approximate number of bytes of
+            combined journals to cache for serving streams.
+        :param engine: The HTTP server engine to use: 'paste' for paste's
+            thread pool server, or 'event' for l_mirror.eventserver, which
+            can serve many more concurrent streams.
+        """
+        if engine not in ENGINES:
+            raise ValueError('unknown server engine %r' % engine)
         self.ui = ui
+        self.engine = engine
         self.addresses = []
         self.mirrorsets = {}
         logger = logging.getLogger('paste.httpserver.ThreadPool')
         # Set a decent level for paste
         logger.setLevel(logging.INFO)
         self.set_watcher = None
+        self.shaper = None
+        self.signature_cache = SignatureCache(SIGNATURE_CACHE_SIZE)
+        self.journal_cache = JournalCache(journal_cache_size,
+            self.signature_cache)
+        self.blob_index = BlobIndex()
+        self.latest = LatestNotifier()
+        self.event_jitter = EVENT_JITTER
+        self.waiters = threading.Semaphore(PASTE_WAITERS)
 
     def start(self, port=8080):
         """Start the server.
@@ -75,8 +163,12 @@ class Server(object):
         listening and shutdown the server.
         """
         app = HTTPExceptionHandler(_RootApp(self))
-        self._server = httpserver.serve(app, host='0.0.0.0', port=port,
-            start_loop=False)
+        if self.engine == 'event':
+            self._server = eventserver.EventServer(app, '0.0.0.0', port)
+        else:
+            self._server = httpserver.serve(app, host='0.0.0.0', port=port,
+                handler=_WSGIHandler, start_loop=False,
+                threadpool_workers=PASTE_THREADS)
         port = self._server.server_port
         url = 'http://127.0.0.1:%s/' % port
         self.addresses.append(url)
@@ -85,7 +177,13 @@ class Server(object):
         self._server_thread.start()
 
     def stop(self):
-        """Stop the server. This completes active requests cleanly."""
+        """Stop the server.
+
+        With the paste engine this completes active requests cleanly; the
+        event engine drops them. Requests waiting for new journals are
+        answered at once.
+        """
+        self.latest.close()
         self._server.server_close()
         self._server_thread.join()
 
@@ -108,6 +206,11 @@ class _RootApp(object):
     STREAM_PREFIX = '/stream/'
     CHANGES_PREFIX = '/changes/'
     UPDATED_PREFIX = '/updated/'
+    BLOB_PREFIX = '/blob/'
+    LATEST_PREFIX = '/latest/'
+    EVENTS_PREFIX = '/events/'
+    # A digest as recorded in journals: see journals.format_digest.
+    BLOB_RE = re.compile('^(?:[a-z0-9]+:)?[0-9a-f]+$')
 
 
     def __init__(self, server):
@@ -119,6 +222,20 @@ class _RootApp(object):
             raise httpexceptions.HTTPNotFound()
         return self.server.mirrorsets[name]
 
+    def _wait(self, environ, app):
+        """Answer with app, which waits for new journals.
+
+        Under paste, app holds its thread while waiting, so at most
+        PASTE_WAITERS such requests are answered at once and others are
+        refused with 404, which clients treat as a server that cannot wait.
+        """
+        if environ.get('lmirror.cooperative'):
+            return app
+        if not self.server.waiters.acquire(False):
+            raise httpexceptions.HTTPNotFound("Too many requests waiting for "
+                "journals: use --engine event to serve more.")
+        return _ReleasingIter(app, self.server.waiters.release)
+
     def _parse_url(self, path):
             elements = path.split('/')
             if len(elements) < 3:
@@ -129,6 +246,37 @@ class _RootApp(object):
             mirrorset = self._check_name(name)
             return mirrorset, elements[3:]
 
+    def _shape(self, environ, mirrorset, response):
+        """Apply the server's bandwidth limits, if any, to response."""
+        if self.server.shaper is None:
+            return response
+        return self.server.shaper.shape(response, mirrorset.name,
+            environ.get('REMOTE_ADDR'), environ.get('lmirror.cooperative'))
+
+    def _stream_path(self, mirrorset, from_journal, to_journal, encoding):
+        """Find a pre-rendered stream (see _MirrorSet.render_streams).
+
+        A stream in the requested encoding is preferred, but as clients that
+        ask for an encoding also understand plain streams a plain stream will
+        do.
+
+        :return: The local path of the stream, or None if it has not been
+            rendered.
+        """
+        streams = mirrorset._metadatadir().clone('streams')
+        name = '%d-%d' % (from_journal, to_journal)
+        names = [name]
+        if encoding is not None:
+            names.insert(0, '%s.%s' % (name, encoding))
+        for name in names:
+            try:
+                path = streams.local_abspath(name)
+            except NotLocalUrl:
+                return None
+            if os.path.isfile(path):
+                return path
+        return None
+
     def __call__(self, environ, start_response):
         """WSGI serve-a-response interface - dispatches to different urls."""
         path = environ['PATH_INFO']
@@ -137,13 +285,18 @@ class _RootApp(object):
             name = path[len(self.SETS_PREFIX):].split('/')[0]
             self._check_name(name)
             if path.endswith('/format'):
-                app = fileapp.DataApp('LMirror Smart Server 1',
-                    content_type='text/plain')
+                app = _ETagDataApp('LMirror Smart Server 1',
+                    '"lmirror-smart-server-1"', content_type='text/plain')
                 app.cache_control(public=True, max_age=3600)
                 return app(environ, start_response)
             elif path.endswith('/set.conf'):
                 mirrorset = self.server.mirrorsets[name]
-                app = _TransportFileApp(mirrorset._get_settings_file(), None,
+                settings_file = mirrorset._get_settings_file()
+                try:
+                    content = settings_file.read()
+                finally:
+                    settings_file.close()
+                app = _ETagDataApp(content, '"%s"' % sha(content).hexdigest(),
                     content_type='text/plain')
                 return app(environ, start_response)
         # metadata retrieval
@@ -153,8 +306,17 @@ class _RootApp(object):
             basename = remainder[-1]
             for element in remainder[:-1]:
                 backing = backing.clone(element)
-            app = fileapp.DataApp(backing.get_bytes(basename),
-                content_type='text/plain')
+            content = backing.get_bytes(basename)
+            if 'journals' in remainder:
+                # Journals never change once written.
+                etag = '"journal-%s"' % basename
+            else:
+                # metadata.conf can be rewritten several times a second
+                # without changing size, so neither size nor mtime identify
+                # it; it is small enough to hash.
+                etag = '"%s"' % sha(content).hexdigest()
+            app = _ETagDataApp(content, etag,
+                _mtime(backing.stat(basename)), content_type='text/plain')
             # Journals are not streamed yet:
             if 'journals' in remainder:
                 app.cache_control(public=True, max_age=360000)
@@ -164,15 +326,62 @@ class _RootApp(object):
             mirrorset, remainder = self._parse_url(path)
             from_journal = int(remainder[0])
             to_journal = int(remainder[1])
-            generator = mirrorset.get_generator(from_journal, to_journal)
-            return _DynamicApp(generator.as_bytes(),
-                content_type='application/x-lmirror')(environ, start_response)
+            # Clients can ask for an encoded stream, with deltas and/or
+            # compression; unknown options are ignored, and clients detect
+            # a plain stream.
+            options = remainder[2:]
+            encoding = None
+            for option in options:
+                if option in journals.STREAM_ENCODINGS:
+                    encoding = option
+                    break
+            deltas = 'delta' in options
+            if deltas:
+                # Pre-rendered streams have whole files in them.
+                stream_path = None
+            else:
+                stream_path = self._stream_path(mirrorset, from_journal,
+                    to_journal, encoding)
+            if stream_path is not None:
+                app = _StreamFileApp(stream_path,
+                    content_type='application/x-lmirror')
+                app.cache_control(public=True, max_age=360000)
+                return self._shape(environ, mirrorset,
+                    app(environ, start_response))
+            generator = self.server.journal_cache.get_generator(
+                mirrorset, from_journal, to_journal)
+            if environ.get('lmirror.file_segments'):
+                # Local file content can be sent without copying it.
+                stream = generator.as_segments(encoding, deltas)
+            else:
+                stream = generator.as_bytes(encoding, deltas)
+            app = _DynamicApp(stream,
+                content_type='application/x-lmirror')
+            return self._shape(environ, mirrorset,
+                app(environ, start_response))
         # inotify interface.
         if path.startswith(self.CHANGES_PREFIX):
             mirrorset, remainder = self._parse_url(path)
             if self.server.set_watcher is None:
                 raise httpexceptions.HTTPServiceUnavailable("No inotify thread.")
-            changes = self.server.set_watcher.get_changes(mirrorset)
+            if remainder == ['grouped']:
+                # The changes grouped by directory, with busy directories
+                # aggregated into scans: see l_mirror.changes.
+                grouped = self.server.set_watcher.get_grouped(mirrorset)
+                if grouped is None:
+                    raise httpexceptions.HTTPNotFound(
+                        "Not ready to answer from inotify cache.")
+                app = _DynamicApp(grouped.iter_bytes(),
+                    content_type='application/x-lmirror-changes')
+                app.cache_control(public=None, max_age=0)
+                return app(environ, start_response)
+            if remainder == ['scan']:
+                # The changes, and the directories still needing a full scan.
+                changes = self.server.set_watcher.get_scan(mirrorset)
+                if changes is not None:
+                    changes = {'changes': changes[0], 'scan': changes[1]}
+            else:
+                changes = self.server.set_watcher.get_changes(mirrorset)
             if changes is None:
                 raise httpexceptions.HTTPNotFound(
                     "Not ready to answer from inotify cache.")
@@ -186,10 +395,50 @@ class _RootApp(object):
         # easy as it might.
         if path.startswith(self.UPDATED_PREFIX):
             mirrorset, remainder = self._parse_url(path)
+            self.server.journal_cache.invalidate(mirrorset.name)
+            self.server.blob_index.invalidate(mirrorset.name)
+            self.server.latest.updated(mirrorset)
             if self.server.set_watcher is not None:
                 self.server.set_watcher.mirror_updated(mirrorset)
             app = fileapp.DataApp('', content_type='text/plain')
             return app(environ, start_response)
+        # the latest journal, optionally waiting for one after a given id.
+        if path.startswith(self.LATEST_PREFIX):
+            mirrorset, remainder = self._parse_url(path)
+            after = None
+            if remainder and remainder[0]:
+                try:
+                    after = int(remainder[0])
+                except ValueError:
+                    raise httpexceptions.HTTPNotFound()
+            app = _LatestApp(self.server.latest, mirrorset, after,
+                LONG_POLL_TIMEOUT)
+            if after is None:
+                return app(environ, start_response)
+            return self._wait(environ, app(environ, start_response))
+        # a stream of notifications of new journals.
+        if path.startswith(self.EVENTS_PREFIX):
+            mirrorset, remainder = self._parse_url(path)
+            cooperative = bool(environ.get('lmirror.cooperative'))
+            app = _EventsApp(self.server.latest, mirrorset,
+                self.server.event_jitter, EVENT_STREAM_DURATION[cooperative])
+            return self._wait(environ, app(environ, start_response))
+        # content by digest, from whichever set has it.
+        if path.startswith(self.BLOB_PREFIX):
+            digest = path[len(self.BLOB_PREFIX):]
+            if not self.BLOB_RE.match(digest):
+                raise httpexceptions.HTTPNotFound()
+            found = self.server.blob_index.get(
+                self.server.mirrorsets.values(), digest)
+            if found is None:
+                raise httpexceptions.HTTPNotFound()
+            mirrorset, content_file, content_length = found
+            app = _TransportFileApp(content_file, content_length,
+                etag='"%s"' % digest, content_type='application/octet-stream')
+            app.cache_control(public=True, max_age=BLOB_MAX_AGE)
+            _add_cache_directive(app.headers, 'immutable')
+            return self._shape(environ, mirrorset,
+                app(environ, start_response))
         # fallback to vanilla content.
         if path.startswith(self.CONTENT_PREFIX):
             mirrorset, remainder = self._parse_url(path)
@@ -199,19 +448,57 @@ class _RootApp(object):
                 backing = backing.clone(element)
             # strictly speaking the content type is wrong.
             content_file = backing.get(basename)
-            content_length = backing.stat(basename).st_size
+            st = backing.stat(basename)
+            etag = self.server.blob_index.etag(mirrorset, '/'.join(remainder),
+                st)
             # stream
-            app = _TransportFileApp(content_file, content_length,
-                content_type='text/plain')
+            app = _TransportFileApp(content_file, st.st_size, etag=etag,
+                last_modified=_mtime(st), content_type='text/plain')
             # Permit content files to be cached: lmirror clients currently
             # prevent caching, and when they do permit it they will know
             # how to re-request.
             if 'journals' in remainder:
                 app.cache_control(public=True, max_age=360000)
-            return app(environ, start_response)
+            return self._shape(environ, mirrorset,
+                app(environ, start_response))
         raise httpexceptions.HTTPNotFound()
 
 
+def _mtime(st):
+    """Get the mtime from st, or None if the transport does not supply it."""
+    return getattr(st, 'st_mtime', None)
+
+
+def _not_modified(environ, etag, last_modified):
+    """Should a request be answered with 304 Not Modified?
+
+    As with paste's DataApp, If-None-Match takes precedence over
+    If-Modified-Since.
+
+    :param etag: The current ETag of the resource, or None.
+    :param last_modified: The current mtime of the resource, or None.
+    """
+    client_etags = IF_NONE_MATCH.parse(environ)
+    if client_etags:
+        return etag is not None and (
+            etag in client_etags or '*' in client_etags)
+    client_clock = IF_MODIFIED_SINCE.parse(environ)
+    return (client_clock is not None and last_modified is not None and
+        client_clock >= int(last_modified))
+
+
+def _add_cache_directive(headers, directive):
+    """Add directive to the Cache-Control header in headers.
+
+    paste's CACHE_CONTROL only composes directives with values.
+    """
+    for pos, (name, value) in enumerate(headers):
+        if name.lower() == 'cache-control':
+            headers[pos] = (name, '%s, %s' % (value, directive))
+            return
+    headers.append(('Cache-Control', directive))
+
+
 class _DynamicApp(object):
     """A dynamically generated content app."""
 
@@ -234,35 +521,838 @@ class _DynamicApp(object):
         return self.generator
 
 
+class _LatestApp(object):
+    """Answer a /latest/ request.
+
+    The response is a JSON object with the latest journal id and timestamp of
+    a set. If a journal id is given, the response waits until there is a
+    later journal, or the timeout passes. Under the event server the wait is
+    done by polling cooperatively, and otherwise by blocking the request's
+    thread.
+    """
+
+    def __init__(self, notifier, mirrorset, after, timeout):
+        self.notifier = notifier
+        self.mirrorset = mirrorset
+        self.after = after
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        if self.after is None:
+            latest = self.notifier.get(self.mirrorset)
+        elif environ.get('lmirror.cooperative'):
+            deadline = time() + self.timeout
+            latest = self.notifier.get(self.mirrorset)
+            while (latest[0] <= self.after and time() < deadline and
+                not self.notifier.closed):
+                yield eventserver.NOT_READY
+                latest = self.notifier.get(self.mirrorset,
+                    self.notifier.REFRESH_INTERVAL)
+        else:
+            latest = self.notifier.wait(self.mirrorset, self.after,
+                self.timeout)
+        content = json.dumps({'latest': latest[0], 'timestamp': latest[1]})
+        headers = []
+        CONTENT_TYPE.update(headers, 'application/json')
+        CONTENT_LENGTH.update(headers, len(content))
+        CACHE_CONTROL.apply(headers, no_cache=True)
+        start_response('200 OK', headers)
+        yield content
+
+
+class _EventsApp(object):
+    """Answer an /events/ request with a stream of server-sent events.
+
+    The stream starts with a 'latest' event holding the latest journal id and
+    timestamp of the set as JSON, in the same form as /latest/, and has
+    another each time a new journal is finished, sent after a random delay
+    of up to jitter seconds. Idle streams have a comment every
+    EVENT_KEEPALIVE seconds. The stream ends after duration seconds, and
+    subscribers reconnect to continue.
+    """
+
+    def __init__(self, notifier, mirrorset, jitter, duration):
+        self.notifier = notifier
+        self.mirrorset = mirrorset
+        self.jitter = jitter
+        self.duration = duration
+
+    def _event(self, latest):
+        return 'event: latest\ndata: %s\n\n' % json.dumps(
+            {'latest': latest[0], 'timestamp': latest[1]})
+
+    def __call__(self, environ, start_response):
+        cooperative = environ.get('lmirror.cooperative')
+        end = time() + self.duration
+        latest = self.notifier.get(self.mirrorset)
+        headers = []
+        CONTENT_TYPE.update(headers, 'text/event-stream')
+        CACHE_CONTROL.apply(headers, no_cache=True)
+        start_response('200 OK', headers)
+        # Subscribers whose stream ends wait for the jitter to reconnect.
+        yield 'retry: %d\n%s' % (self.jitter * 1000, self._event(latest))
+        sent = latest[0]
+        while time() < end and not self.notifier.closed:
+            until = min(time() + EVENT_KEEPALIVE, end)
+            if cooperative:
+                latest = self.notifier.get(self.mirrorset,
+                    self.notifier.REFRESH_INTERVAL)
+                while (latest[0] <= sent and time() < until and
+                    not self.notifier.closed):
+                    yield eventserver.NOT_READY
+                    latest = self.notifier.get(self.mirrorset,
+                        self.notifier.REFRESH_INTERVAL)
+            else:
+                latest = self.notifier.wait(self.mirrorset, sent,
+                    until - time())
+            if latest[0] <= sent:
+                if time() < end:
+                    yield ': keepalive\n\n'
+                continue
+            # Spread subscribers' fetches of the new journal out.
+            until = min(time() + random.uniform(0, self.jitter), end)
+            if cooperative:
+                while time() < until:
+                    yield eventserver.NOT_READY
+            else:
+                sleep(max(0, until - time()))
+            latest = self.notifier.get(self.mirrorset,
+                self.notifier.REFRESH_INTERVAL)
+            yield self._event(latest)
+            sent = latest[0]
+
+
+class _ETagDataApp(fileapp.DataApp):
+    """A DataApp with a strong ETag.
+
+    DataApp makes its ETag from the time the app was created, so conditional
+    requests would never match.
+    """
+
+    def __init__(self, content, etag, last_modified=None, **kwargs):
+        fileapp.DataApp.__init__(self, None, **kwargs)
+        self.etag = etag
+        self.set_content(content, last_modified)
+
+    def calculate_etag(self):
+        return self.etag
+
+
 class _TransportFileApp(fileapp.DataApp):
     """An adapter to bzrlib transports.
 
     This is rarely used due to the streaming facility.
     
-    This does not support ETags or IMS yet; it could if desired in the future,
-    but as lmirror only requests content it needs there isn't much call for
-    this. What would be good would be to is to generate a sha1 ETAG as a
-    trailer, in the future, and thus work with caches.
+    When given an ETag or mtime, conditional requests are answered with 304
+    Not Modified, so that caches can revalidate content cheaply.
 
-    Likewise, range requests are not supported - that would be easy enough to
-    do, see fileapp.DataApp.get().
+    Single range requests are supported when the content length is known, as
+    receivers fetch the parts of files they are missing with them (see
+    l_mirror.delta).
     """
 
-    def __init__(self, content_file, content_length, **kwargs):
+    def __init__(self, content_file, content_length, etag=None,
+        last_modified=None, **kwargs):
         fileapp.DataApp.__init__(self, None, **kwargs)
         self.content_file = content_file
         self.content_length = content_length
+        self.etag = etag
+        self.last_modified = last_modified
 
     def get(self, environ, start_response):
         is_head = environ['REQUEST_METHOD'].upper() == 'HEAD'
         headers = self.headers[:]
-        if self.content_length is not None:
-            CONTENT_LENGTH.update(headers, self.content_length)
-        start_response('200 OK', headers)
+        if self.etag is not None:
+            ETAG.update(headers, self.etag)
+        if self.last_modified is not None:
+            LAST_MODIFIED.update(headers, time=self.last_modified)
+        if _not_modified(environ, self.etag, self.last_modified):
+            self.content_file.close()
+            for header in list_headers(entity=True):
+                header.delete(headers)
+            start_response('304 Not Modified', headers)
+            return ['']
+        lower, length = 0, self.content_length
+        status = '200 OK'
+        ranges = RANGE.parse(environ)
+        if (ranges and ranges[0] == 'bytes' and len(ranges[1]) == 1 and
+            self.content_length is not None):
+            lower, upper = ranges[1][0]
+            if upper is None or upper >= self.content_length:
+                upper = self.content_length - 1
+            if lower > upper:
+                exc = httpexceptions.HTTPRequestRangeNotSatisfiable(
+                    'Range request was made beyond the end of the content.')
+                return exc(environ, start_response)
+            length = upper - lower + 1
+            CONTENT_RANGE.update(headers, first_byte=lower, last_byte=upper,
+                total_length=self.content_length)
+            status = '206 Partial Content'
+        if length is not None:
+            CONTENT_LENGTH.update(headers, length)
+        start_response(status, headers)
         if is_head:
             return ['']
-        self.content_file.seek(0)
-        return fileapp._FileIter(self.content_file, size=self.content_length)
+        self.content_file.seek(lower)
+        return fileapp._FileIter(self.content_file, size=length)
+
+
+class _StreamFileApp(fileapp.FileApp):
+    """Serve a pre-rendered stream from disk.
+
+    This differs from FileApp in that the requested range is always honoured
+    (FileApp ignores it when using wsgi.file_wrapper), and in that the file is
+    returned as a journals.FileSegment when the server can send those.
+    """
+
+    def guess_type(self):
+        return None, None
+
+    def get(self, environ, start_response):
+        is_head = environ['REQUEST_METHOD'].upper() == 'HEAD'
+        file = None
+        try:
+            self.update()
+            if self.content is None:
+                file = open(self.filename, 'rb')
+        except (IOError, OSError):
+            # Pruned by a later render_streams.
+            exc = httpexceptions.HTTPNotFound('The resource does not exist')
+            return exc(environ, start_response)
+        retval = fileapp.DataApp.get(self, environ, start_response)
+        if isinstance(retval, list) or is_head:
+            # cached content, exception, not-modified or HEAD.
+            if file is not None:
+                file.close()
+            if is_head:
+                return ['']
+            return retval
+        (lower, content_length) = retval
+        if environ.get('lmirror.file_segments'):
+            return _SegmentIter(file,
+                [journals.FileSegment(file, lower, content_length)])
+        file.seek(lower)
+        return fileapp._FileIter(file, size=content_length)
+
+
+class _SegmentIter(object):
+    """A WSGI response of FileSegments which closes their file when done."""
+
+    def __init__(self, file, segments):
+        self.file = file
+        self.segments = segments
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def close(self):
+        self.file.close()
+
+
+class _ReleasingIter(object):
+    """A WSGI response which calls release when it is closed."""
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        release, self.release = self.release, None
+        try:
+            if getattr(self.app_iter, 'close', None) is not None:
+                self.app_iter.close()
+        finally:
+            if release is not None:
+                release()
+
+
+class _WSGIHandler(httpserver.WSGIHandler):
+    """A paste WSGI handler which can send journals.FileSegments.
+
+    Segments are sent with sendfile when the sendfile module is available, and
+    by reading and writing them otherwise.
+    """
+
+    def wsgi_setup(self, environ=None):
+        httpserver.WSGIHandler.wsgi_setup(self, environ)
+        self.wsgi_environ['lmirror.file_segments'] = True
+
+    def wsgi_write_chunk(self, chunk):
+        if not isinstance(chunk, journals.FileSegment):
+            httpserver.WSGIHandler.wsgi_write_chunk(self, chunk)
+            return
+        # Send the headers if needed, and anything still buffered.
+        httpserver.WSGIHandler.wsgi_write_chunk(self, '')
+        self.wfile.flush()
+        _send_segment(self.connection, chunk)
+
+
+def _send_segment(sock, segment):
+    """Send segment down sock."""
+    if sendfile is None:
+        for content in segment.iter_bytes():
+            sock.sendall(content)
+        return
+    out_fd = sock.fileno()
+    in_fd = segment.file.fileno()
+    offset = segment.offset
+    remaining = segment.length
+    while remaining:
+        try:
+            sent = sendfile(out_fd, in_fd, offset, remaining)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            # The socket has a timeout, so is non-blocking.
+            select.select([], [out_fd], [])
+            continue
+        if not sent:
+            raise ValueError('0 byte send, expected %d' % remaining)
+        offset += sent
+        remaining -= sent
+
+
+class JournalCache(object):
+    """An LRU cache of combined journals for serving streams.
+
+    Receivers mostly ask for the same few ranges of journals, so rather than
+    reading, parsing and combining the journals for every stream request the
+    replay groups for each (set, from, to) range are kept. The groups are
+    kept as a stream is first sent from them, and only while they fit in the
+    cache, so ranges too large to cache are streamed without being held in
+    memory. The cache is bounded by an estimate of the memory used by the
+    cached actions, and the least recently used ranges are discarded first.
+
+    :ivar max_cost: The approximate number of bytes to cache.
+    :ivar signatures: None, or a SignatureCache for the streams to use.
+    """
+
+    # Rough size of an action tuple and its content objects, excluding the
+    # path.
+    ACTION_OVERHEAD = 300
+
+    def __init__(self, max_cost, signatures=None):
+        """Create a JournalCache.
+
+        :param max_cost: The approximate number of bytes to cache.
+        :param signatures: None, or a SignatureCache for the streams to use,
+            so that the delta signatures of large files are not calculated
+            for every stream.
+        """
+        self.max_cost = max_cost
+        self.signatures = signatures
+        self._entries = OrderedDict() # (name, from, to) -> (groups, cost)
+        self._cost = 0
+        self._lock = threading.Lock()
+
+    def get_generator(self, mirrorset, from_journal, to_journal):
+        """Get a ReplayGenerator for some journals of mirrorset.
+
+        See _MirrorSet.get_generator.
+        """
+        key = (mirrorset.name, from_journal, to_journal)
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Most recently used.
+                self._entries[key] = entry
+        finally:
+            self._lock.release()
+        if entry is None:
+            journal = _CachingJournal(self, key,
+                mirrorset.get_combined(from_journal, to_journal))
+        else:
+            journal = _GroupedJournal(entry[0])
+        return journals.ReplayGenerator(journal,
+            mirrorset._contentdir(), mirrorset.ui,
+            uncompressed=mirrorset.get_uncompressed(),
+            small_files=mirrorset.get_small_files(),
+            signatures=self.signatures)
+
+    def _store(self, key, entry):
+        if entry[1] > self.max_cost:
+            return
+        self._lock.acquire()
+        try:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._cost -= old_entry[1]
+            self._entries[key] = entry
+            self._cost += entry[1]
+            while self._cost > self.max_cost:
+                _, (_, cost) = self._entries.popitem(last=False)
+                self._cost -= cost
+        finally:
+            self._lock.release()
+
+    def invalidate(self, name):
+        """Discard all the cached journals for the set called name."""
+        self._lock.acquire()
+        try:
+            for key in list(self._entries):
+                if key[0] == name:
+                    self._cost -= self._entries.pop(key)[1]
+        finally:
+            self._lock.release()
+
+
+class SignatureCache(object):
+    """An LRU cache of the delta signatures of file content.
+
+    Calculating a signature reads the whole file, and every receiver of a
+    delta stream for a range gets the same signatures, so they are kept by
+    path and sha1. As content with a given sha1 never changes, entries are
+    never stale and are only discarded, least recently used first, to stay
+    within max_cost bytes.
+
+    :ivar max_cost: The approximate number of bytes to cache.
+    """
+
+    # Rough size of an entry and its key, excluding the path and signature.
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_cost):
+        """Create a SignatureCache.
+
+        :param max_cost: The approximate number of bytes to cache.
+        """
+        self.max_cost = max_cost
+        self._entries = OrderedDict() # (path, sha1) -> signature
+        self._cost = 0
+        self._lock = threading.Lock()
+
+    def _entry_cost(self, path, signature):
+        return len(path) + len(signature) + self.ENTRY_OVERHEAD
+
+    def get(self, path, sha1):
+        """Get the signature of the content with sha1 at path.
+
+        :return: The signature, or None if it is not cached.
+        """
+        key = (path, sha1)
+        self._lock.acquire()
+        try:
+            signature = self._entries.pop(key, None)
+            if signature is not None:
+                # Most recently used.
+                self._entries[key] = signature
+            return signature
+        finally:
+            self._lock.release()
+
+    def add(self, path, sha1, signature):
+        """Cache the signature of the content with sha1 at path."""
+        cost = self._entry_cost(path, signature)
+        if cost > self.max_cost:
+            return
+        key = (path, sha1)
+        self._lock.acquire()
+        try:
+            old_signature = self._entries.pop(key, None)
+            if old_signature is not None:
+                self._cost -= self._entry_cost(path, old_signature)
+            self._entries[key] = signature
+            self._cost += cost
+            while self._cost > self.max_cost:
+                (old_path, _), old_signature = self._entries.popitem(
+                    last=False)
+                self._cost -= self._entry_cost(old_path, old_signature)
+        finally:
+            self._lock.release()
+
+
+class BlobIndex(object):
+    """An index of the file content of served mirror sets by digest.
+
+    Each set's index is a journals.ContentIndex of its combined tree, built
+    the first time content is looked up in the set and discarded when the
+    set is updated. The tree is kept too, to look up the sha1 of a path for
+    its ETag. Content may have changed on disk since the last journal
+    was written, and blobs are cached as immutable, so every file is hashed
+    before it is first served; files that have not changed since (by size and
+    mtime) are not hashed again. Nor are files whose digest the set's hash
+    cache (see l_mirror.hashcache) already has.
+    """
+
+    def __init__(self):
+        """Create a BlobIndex."""
+        self._indices = {} # name -> (tree, ContentIndex)
+        self._verified = {} # (name, path) -> (size, mtime)
+        self._hash_caches = {} # name -> None or HashCache
+        self._lock = threading.Lock()
+
+    def get(self, mirrorsets, digest):
+        """Find the content with digest in mirrorsets.
+
+        :param digest: The digest of the content, formatted as for
+            FileContent.sha1 - so hex for sha1, and 'NAME:HEX' for others.
+        :return: None if no set has the content, or a tuple (mirrorset,
+            content_file, content_length).
+        """
+        for mirrorset in sorted(mirrorsets, key=lambda mirror: mirror.name):
+            for path, content in self._index(mirrorset)[1].find_sha1(digest):
+                content_file = self._open(mirrorset, path, content)
+                if content_file is not None:
+                    return mirrorset, content_file, content.length
+        return None
+
+    def etag(self, mirrorset, path, st):
+        """Get a strong ETag for path in mirrorset.
+
+        :param st: The stat result for path.
+        :return: The sha1 of path if it has not changed since it was last
+            journalled, or else its size and mtime, or None if the mtime is
+            not known.
+        """
+        content = self._index(mirrorset)[0]
+        for segment in path.split('/'):
+            if type(content) is not dict:
+                content = None
+                break
+            content = content.get(segment)
+        mtime = _mtime(st)
+        if mtime is None:
+            return None
+        # Journals record mtimes to the microsecond.
+        if (content is not None and type(content) is not dict and
+            content.kind == 'file' and content.length == st.st_size and
+            content.mtime is not None and
+            '%f' % content.mtime == '%f' % mtime):
+            return '"%s"' % content.sha1
+        return '"%d-%f"' % (st.st_size, mtime)
+
+    def invalidate(self, name):
+        """Discard the index for the set called name."""
+        self._lock.acquire()
+        try:
+            self._indices.pop(name, None)
+            self._hash_caches.pop(name, None)
+            for key in list(self._verified):
+                if key[0] == name:
+                    del self._verified[key]
+        finally:
+            self._lock.release()
+
+    def _index(self, mirrorset):
+        self._lock.acquire()
+        try:
+            index = self._indices.get(mirrorset.name)
+        finally:
+            self._lock.release()
+        if index is not None:
+            return index
+        metadata = mirrorset._get_metadata()
+        # Requests for a set run in several threads, and the index already
+        # keeps the tree, so the set does not keep the combination.
+        tree = mirrorset._combine_journals(
+            int(metadata.get('metadata', 'basis')),
+            int(metadata.get('metadata', 'latest')), keep=False)
+        index = (tree, journals.ContentIndex(tree))
+        self._lock.acquire()
+        try:
+            self._indices[mirrorset.name] = index
+        finally:
+            self._lock.release()
+        return index
+
+    def _open(self, mirrorset, path, content):
+        """Open path if it still has content.
+
+        :return: A file, or None.
+        """
+        contentdir = mirrorset._contentdir()
+        key = (mirrorset.name, path)
+        try:
+            st = contentdir.stat(path)
+            stamp = (st.st_size, getattr(st, 'st_mtime', None))
+            if st.st_size != content.length:
+                return None
+            content_file = contentdir.get(path)
+        except PathError:
+            return None
+        if self._verified.get(key) == stamp:
+            return content_file
+        hash_cache = self._hash_cache(mirrorset)
+        if (hash_cache is None or
+            hash_cache.get(path, st) != content.sha1):
+            size, digest = journals.hash_file(content_file,
+                content.hash_name)
+            content_file.seek(0)
+            if (size, digest) != (content.length, content.sha1):
+                content_file.close()
+                return None
+        self._lock.acquire()
+        try:
+            self._verified[key] = stamp
+        finally:
+            self._lock.release()
+        return content_file
+
+    def _hash_cache(self, mirrorset):
+        self._lock.acquire()
+        try:
+            if mirrorset.name in self._hash_caches:
+                return self._hash_caches[mirrorset.name]
+        finally:
+            self._lock.release()
+        hash_cache = mirrorset.get_hash_cache()
+        self._lock.acquire()
+        try:
+            self._hash_caches[mirrorset.name] = hash_cache
+        finally:
+            self._lock.release()
+        return hash_cache
+
+
+class LatestNotifier(object):
+    """Track the latest journal of each served set for /latest/ and /events/.
+
+    Requests that wait for a new journal are woken when the server is told a
+    set was updated (see /updated/), and otherwise check its metadata every
+    REFRESH_INTERVAL seconds, in case a change was finished without telling
+    the server.
+
+    :ivar closed: True once the server is stopping, when waits end at once.
+    """
+
+    REFRESH_INTERVAL = 5
+
+    def __init__(self):
+        """Create a LatestNotifier."""
+        self._latest = {} # name -> (latest, timestamp, read_at)
+        self._condition = threading.Condition()
+        self.closed = False
+
+    def get(self, mirrorset, max_age=0):
+        """Get the latest journal of mirrorset.
+
+        :param max_age: The age in seconds past which the latest journal is
+            read again from the metadata of mirrorset.
+        :return: A tuple (latest, timestamp).
+        """
+        self._condition.acquire()
+        try:
+            entry = self._latest.get(mirrorset.name)
+        finally:
+            self._condition.release()
+        if entry is None or time() - entry[2] >= max_age:
+            entry = self._read(mirrorset)
+        return entry[:2]
+
+    def updated(self, mirrorset):
+        """Note that mirrorset has been updated, waking any waiters."""
+        self._read(mirrorset)
+
+    def wait(self, mirrorset, after, timeout):
+        """Wait for mirrorset to have a journal later than after.
+
+        :param after: A journal id.
+        :param timeout: The most seconds to wait for.
+        :return: A tuple (latest, timestamp), which is the same as before if
+            the wait timed out.
+        """
+        deadline = time() + timeout
+        latest = self.get(mirrorset)
+        while latest[0] <= after and not self.closed:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            self._condition.acquire()
+            try:
+                self._condition.wait(min(remaining, self.REFRESH_INTERVAL))
+            finally:
+                self._condition.release()
+            latest = self.get(mirrorset, self.REFRESH_INTERVAL)
+        return latest
+
+    def close(self):
+        """Stop waiting for new journals, as the server is stopping."""
+        self._condition.acquire()
+        try:
+            self.closed = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _read(self, mirrorset):
+        latest, timestamp = mirrorset.get_latest()
+        entry = (latest, timestamp, time())
+        self._condition.acquire()
+        try:
+            self._latest[mirrorset.name] = entry
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        return entry
+
+
+class _GroupedJournal(object):
+    """A combined journal whose replay groups have already been calculated."""
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def as_groups(self):
+        return self.groups
+
+
+class _CachingJournal(object):
+    """A combined journal which adds its groups to a JournalCache.
+
+    The groups are kept as they are replayed, and added to the cache once
+    they have all been replayed. If they grow past what the cache can hold
+    they are dropped, and the rest of the journal is passed on without being
+    kept.
+    """
+
+    def __init__(self, cache, key, journal):
+        """Create a _CachingJournal.
+
+        :param cache: The JournalCache to add the groups to.
+        :param key: The key to add them under.
+        :param journal: The combined journal, such as a
+            journals.StreamingCombiner.
+        """
+        self.cache = cache
+        self.key = key
+        self.journal = journal
+
+    def as_groups(self):
+        groups = self.journal.as_groups()
+        self._kept = [[] for group in groups]
+        self._cost = 0
+        return [self._iter_group(group, kept)
+            for group, kept in zip(groups, self._kept)]
+
+    def _iter_group(self, group, kept):
+        for item in group:
+            if self._kept is not None:
+                self._cost += len(item[1]) + self.cache.ACTION_OVERHEAD
+                if self._cost > self.cache.max_cost:
+                    for some_kept in self._kept:
+                        del some_kept[:]
+                    self._kept = None
+                else:
+                    kept.append(item)
+            yield item
+        if self._kept is not None and kept is self._kept[-1]:
+            self.cache._store(self.key, (self._kept, self._cost))
+
+
+class _ChangeStore(object):
+    """The changes noted under one content root.
+
+    Each changed path is kept once, with the time it last changed, in the
+    order of those times, so pruning old changes only looks at the changes
+    being pruned and a path changed over and over takes one entry. When more
+    than limit paths have changed they are forgotten, and the store cannot
+    answer until a scan started after that is finished: the changes since
+    then are still noted, but anything earlier was lost.
+
+    Until the directories under the root have all been watched (see
+    SetWatcher.start), the ones that have not are reported as needing a scan.
+
+    :ivar root: The absolute path of the content root.
+    :ivar limit: The most changed paths to keep.
+    :ivar overflowed: None, or the time the log was last emptied.
+    :ivar last: The oldest scan timestamp of the sets with this root.
+    :ivar pending: The directories, relative to root, whose subtrees are not
+        yet watched.
+    :ivar walking: True while the root is being walked.
+    :ivar rewalk: True if a set with an older scan timestamp was added while
+        the root was being walked, so it needs walking again.
+    :ivar index: None, or a dict of the directories walked, relpath ->
+        (mtime, subdirectory names).
+    :ivar index_path: Where to save the index for the next start.
+    :ivar walked: None, or the time the root was last all watched.
+    :ivar logs: The l_mirror.changes.ChangeLogs to record changes in.
+    """
+
+    def __init__(self, root, limit, index_path=None):
+        self.root = root
+        self.limit = limit
+        self.index_path = index_path
+        self.overflowed = None
+        self.last = None
+        self.pending = ['']
+        self.walking = False
+        self.rewalk = False
+        self.index = None
+        self.walked = None
+        self.logs = []
+        self._changes = OrderedDict() # path -> latest timestamp, oldest first
+
+    def abspath(self, relpath):
+        """Get the absolute path of relpath."""
+        if not relpath:
+            return self.root
+        return self.root + '/' + relpath
+
+    def relpath(self, path):
+        """Get the path of path relative to root."""
+        return path[len(self.root) + 1:]
+
+    def note(self, path, timestamp):
+        """Note that path changed at timestamp."""
+        if (self._changes.pop(path, None) is None and
+            len(self._changes) >= self.limit):
+            self._changes.clear()
+            self.overflowed = timestamp
+            for log in self.logs:
+                log.overflowed(timestamp)
+        self._changes[path] = timestamp
+        for log in self.logs:
+            log.note(self.relpath(path), timestamp)
+
+    def set_walked(self, timestamp):
+        """Note that every directory under root is watched."""
+        self.walked = timestamp
+        for log in self.logs:
+            log.walked(timestamp)
+
+    def rewrite_log(self, log):
+        """Replace the content of log with the changes in this store."""
+        walked = None
+        if not self.walking:
+            walked = self.walked
+        log.rewrite(((timestamp, self.relpath(path)) for path, timestamp in
+            self._changes.iteritems()), walked, self.overflowed)
+
+    def get(self):
+        """Get the changed paths.
+
+        :return: None if changes have been lost or the root is not all
+            watched yet, or a list of paths.
+        """
+        if self.overflowed is not None or self.pending:
+            return None
+        return list(self._changes)
+
+    def get_scan(self):
+        """Get the changed paths and the directories needing a scan.
+
+        :return: None if changes have been lost, or a tuple (paths, dirs)
+            where dirs are the directories whose whole subtrees need
+            scanning on disk.
+        """
+        if self.overflowed is not None:
+            return None
+        return list(self._changes), map(self.abspath, self.pending)
+
+    def prune(self, last):
+        """Discard the changes from before last."""
+        changes = self._changes
+        while changes:
+            path, timestamp = next(changes.iteritems())
+            if timestamp >= last:
+                break
+            del changes[path]
+        if self.overflowed is not None and self.overflowed < last:
+            self.overflowed = None
 
 
 class SetWatcher(object):
@@ -274,40 +1364,55 @@ class SetWatcher(object):
     honour excludes.
     
     SetWatcher then records all the mutation events that occur within these
-    directories. Each set has a scan date for it; when the time that an event
-    was received is older than the oldest date for a set, the event is
-    discarded. As a consequence, failing to update a monitored set can prevent
-    memory being released.
+    directories, in a _ChangeStore per content root. Each set has a scan date
+    for it; when the time that an event was received is older than the oldest
+    date for the sets sharing a content root, the event is discarded. Each
+    store keeps at most limit changed paths: past that it forgets them and
+    answers that a full scan is needed until the sets are next updated, so
+    failing to update a monitored set cannot use unbounded memory.
+
+    Watching a large tree takes a while, so each content root is walked in
+    its own thread once start() is called, and until then the directories
+    not yet reached are reported as needing a scan (see get_scan). The walk
+    notes the files changed since the last scan of the sets, which means
+    stating every file. With fast_start, the directories found by the
+    previous walk are saved when the watcher stops (see save_index), and a
+    directory whose mtime has not changed since is assumed to hold the same
+    entries, and is not listed nor are its files stated. Files rewritten in
+    place (rather than replaced) while the server was not running are then
+    not noticed.
 
-    Currently, events are just held in a dict, so pruning is an O(events) task.
+    With logs, the changes for each set are also written to a change log in
+    its metadata directory (see l_mirror.changes.ChangeLog), which
+    finish-change reads directly. Nothing tells the watcher when a set is
+    updated, so refresh() should be called from time to time to discard the
+    changes the sets have been updated past.
     """
 
-    def __init__(self):
+    def __init__(self, limit=CHANGES_LIMIT, fast_start=False, logs=False):
         """Create a SetWatcher.
 
         This creates a WatchManager and other pyinotify objects itself.
+
+        :param limit: The most events to keep for each content root.
+        :param fast_start: If True, use the directory index saved by the
+            last watcher to skip unchanged directories when walking.
+        :param logs: If True, write the changes for each set to its change
+            log.
         """
         self.wm = pyinotify.WatchManager()
         self.handler = GatherDirectories(self)
         self.notifier = pyinotify.Notifier(self.wm, default_proc_fun=self.handler)
         self.mirrorsets = {}
         self.paths = {}
-        self.changes = {} # path -> latest timestamp
+        self.limit = limit
+        self.fast_start = fast_start
+        self.logs = logs
+        self.changes = {} # content root -> _ChangeStore
         # path cleanups need to be locked so that a cleanup doesn't delete something
         # that is simultaneously changing.
         self.changes_lock = threading.Lock()
-
-    def add(self, mirror):
-        """Add mirror to be observed for changes."""
-        try:
-            path = mirror._contentdir().local_abspath('.')
-        except NotLocalUrl:
-            return
-        self.paths.setdefault(path, []).append(mirror)
-        # Add the directories recursively: to disowe can't depend on dir opens to
-        # start traversing, because processes might be active below the top
-        # when we
-        # are adding the mirror.
+        self._started = False
         # TODO: be more precise about events. Our goal is to be able to list
         # directories that need examining for changes; new directories will be
         # discovered by a change to the parent, so we don't need to recurse
@@ -315,7 +1420,7 @@ class SetWatcher(object):
         # The reason we don't record all changed files is simply to tradeoff
         # against the memory overhead of remembering everthing. This may be a
         # mistake.
-        wanted_events = (
+        self.wanted_events = (
             pyinotify.IN_MODIFY |
             pyinotify.IN_ATTRIB |
             pyinotify.IN_CLOSE_WRITE |
@@ -328,27 +1433,239 @@ class SetWatcher(object):
             pyinotify.IN_ONLYDIR | # New in 2.6.15; perhaps make it optional?
             # Should be only watching dirs, belt and bracers.
             pyinotify.IN_DONT_FOLLOW )
+
+    def add(self, mirror):
+        """Add mirror to be observed for changes.
+
+        If the watcher has been started, the content root of mirror is walked
+        straight away.
+
+        :raises ValueError: If writing logs and another watcher is writing
+            the change log of mirror.
+        """
+        try:
+            path = mirror._contentdir().local_abspath('.')
+        except NotLocalUrl:
+            return
         metadata = mirror._get_metadata()
         last = float(metadata.get('metadata', 'timestamp'))
-        for dirname, dirs, files in os.walk(path):
-            self.wm.add_watch(dirname, wanted_events)
-            for child in dirs + files:
-                fullpath = dirname + '/' + child
-                mtime = os.lstat(fullpath).st_mtime
-                if mtime >= last:
-                    # records with time.time, but thats ok, newer times won't
-                    # reduce accuracy.
-                    self.note_changed(fullpath)
+        log = None
+        if self.logs:
+            log = changes.ChangeLog(
+                mirror._metadatadir().local_abspath(changes.CHANGE_LOG))
+            log.open()
+        walk = False
+        self.changes_lock.acquire()
+        try:
+            self.paths.setdefault(path, []).append(mirror)
+            store = self.changes.get(path)
+            if store is None:
+                store = _ChangeStore(path, self.limit,
+                    mirror._metadatadir().local_abspath(DIR_INDEX))
+                self.changes[path] = store
+                walk = self._started
+            elif last < store.last:
+                # Changes since the older scan need noting too.
+                if store.walking:
+                    store.rewalk = True
+                else:
+                    walk = self._started
+            if store.last is None or last < store.last:
+                store.last = last
+            if walk:
+                store.walking = True
+            if log is not None:
+                # Start with the changes noted so far.
+                store.rewrite_log(log)
+                store.logs.append(log)
+        finally:
+            self.changes_lock.release()
         # Make this mirrorset usable in the getchanges API.
         self.mirrorsets[mirror.name] = mirror
+        if walk:
+            self._start_walk(store)
+
+    def start(self):
+        """Start walking the content roots of the sets, in parallel."""
+        self.changes_lock.acquire()
+        try:
+            self._started = True
+            stores = self.changes.values()
+            for store in stores:
+                store.walking = True
+        finally:
+            self.changes_lock.release()
+        for store in stores:
+            self._start_walk(store)
+
+    def wait(self):
+        """Wait for the content roots being walked to be watched."""
+        while True:
+            self.changes_lock.acquire()
+            try:
+                if not [store for store in self.changes.values()
+                    if store.walking]:
+                    return
+            finally:
+                self.changes_lock.release()
+            sleep(0.01)
+
+    def _start_walk(self, store):
+        walker = threading.Thread(target=self._walk, args=(store,))
+        walker.setDaemon(True)
+        walker.start()
+
+    def _walk(self, store):
+        """Watch every directory under the root of store.
+
+        Directories are walked depth first, so the unwalked subtrees are
+        always a short list, kept in store.pending.
+        """
+        index = {}
+        if self.fast_start:
+            index = self._load_index(store)
+        while True:
+            self.changes_lock.acquire()
+            try:
+                store.pending = ['']
+                store.rewalk = False
+                last = store.last
+            finally:
+                self.changes_lock.release()
+            new_index = {}
+            while True:
+                self.changes_lock.acquire()
+                try:
+                    if not store.pending:
+                        break
+                    relpath = store.pending[-1]
+                finally:
+                    self.changes_lock.release()
+                subdirs = self._walk_dir(store, relpath, last, index,
+                    new_index)
+                self.changes_lock.acquire()
+                try:
+                    store.pending.pop()
+                    store.pending.extend(relpath and relpath + '/' + name or
+                        name for name in subdirs)
+                finally:
+                    self.changes_lock.release()
+            self.changes_lock.acquire()
+            try:
+                if not store.rewalk:
+                    store.index = new_index
+                    store.walking = False
+                    store.set_walked(time())
+                    return
+            finally:
+                self.changes_lock.release()
+
+    def _walk_dir(self, store, relpath, last, index, new_index):
+        """Watch one directory, noting what has changed since last.
+
+        :return: The names of its subdirectories.
+        """
+        path = store.abspath(relpath)
+        try:
+            statinfo = os.lstat(path)
+        except OSError:
+            # Removed since its parent was listed.
+            return []
+        # Watch before listing, so that nothing is missed in between.
+        self.wm.add_watch(path, self.wanted_events)
+        entry = index.get(relpath)
+        if entry is not None and entry[0] == statinfo.st_mtime:
+            subdirs = entry[1]
+        else:
+            subdirs = []
+            for name in os.listdir(path):
+                child = path + '/' + name
+                try:
+                    child_stat = os.lstat(child)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(child_stat.st_mode):
+                    subdirs.append(name)
+                # Like DiskUpdater, allow for coarse mtimes and the rounding
+                # of the scan timestamp.
+                if child_stat.st_mtime >= last - 3:
+                    # records with time.time, but thats ok, newer times won't
+                    # reduce accuracy.
+                    self.note_changed(child)
+        new_index[relpath] = (statinfo.st_mtime, subdirs)
+        return subdirs
+
+    def _load_index(self, store):
+        """Load the directory index saved for store.
+
+        The index is removed once loaded: if the server stops without saving
+        it again, changes made while it ran are not in the index.
+        """
+        try:
+            index_file = open(store.index_path, 'rb')
+        except IOError:
+            return {}
+        try:
+            content = index_file.read()
+        finally:
+            index_file.close()
+        os.unlink(store.index_path)
+        try:
+            return dict((relpath, tuple(entry)) for relpath, entry in
+                json.loads(content).iteritems())
+        except ValueError:
+            return {}
+
+    def save_index(self):
+        """Save the directory index of each walked content root.
+
+        Directories with changes not yet scanned are left out, so that the
+        next fast start lists them again.
+        """
+        self.changes_lock.acquire()
+        try:
+            for store in self.changes.values():
+                if store.index is None or store.overflowed is not None:
+                    continue
+                index = dict(store.index)
+                for path in store._changes:
+                    relpath = path[len(store.root) + 1:]
+                    index.pop(relpath, None)
+                    index.pop(os.path.dirname(relpath), None)
+                temp_path = store.index_path + '.tmp'
+                index_file = open(temp_path, 'wb')
+                try:
+                    index_file.write(json.dumps(index))
+                finally:
+                    index_file.close()
+                os.rename(temp_path, store.index_path)
+        finally:
+            self.changes_lock.release()
 
     def note_changed(self, path):
+        if '/.lmirror/metadata/' in path:
+            # Never journalled, and the change logs are written there: noting
+            # writes to them would write to them again.
+            return
+        now = time()
         self.changes_lock.acquire()
         try:
-            self.changes[path] = time()
+            for root, store in self.changes.iteritems():
+                if path == root or path.startswith(root + '/'):
+                    store.note(path, now)
         finally:
             self.changes_lock.release()
 
+    def _store(self, mirror):
+        """Get the _ChangeStore for mirror, or None."""
+        if mirror.name not in self.mirrorsets:
+            return None
+        try:
+            basepath = mirror._contentdir().local_abspath('.')
+        except NotLocalUrl:
+            return None
+        return self.changes.get(basepath)
+
     def get_changes(self, mirror):
         """Get a list of all the paths changed that might be in mirror.
         
@@ -356,37 +1673,88 @@ class SetWatcher(object):
             self.changes, or a list of the paths that might be chagned in the
             mirror.
         """
-        # TODO: filter for the caller to one mirror
-        if mirror.name not in self.mirrorsets:
+        store = self._store(mirror)
+        if store is None:
             return None
         self.changes_lock.acquire()
         try:
-            try:
-                basepath = mirror._contentdir().local_abspath('.')
-            except NotLocalUrl:
-                return None
-            return [path for path in self.changes if path.startswith(basepath)]
+            return store.get()
         finally:
             self.changes_lock.release()
 
+    def get_scan(self, mirror):
+        """Get the paths changed in mirror, and the directories to scan.
+
+        Unlike get_changes this can answer while the content root is still
+        being walked.
+
+        :return: None if the mirror is not able to be answered from
+            self.changes, or a tuple (paths, dirs) of the paths that might be
+            changed and the directories whose subtrees need scanning.
+        """
+        store = self._store(mirror)
+        if store is None:
+            return None
+        self.changes_lock.acquire()
+        try:
+            return store.get_scan()
+        finally:
+            self.changes_lock.release()
+
+    def get_grouped(self, mirror, threshold=changes.AGGREGATE_THRESHOLD):
+        """Get the changes in mirror grouped by directory.
+
+        Directories with more than threshold changes are reported as needing
+        a scan rather than listed.
+
+        :return: None if the mirror is not able to be answered from
+            self.changes, or an l_mirror.changes.Changes.
+        """
+        scan = self.get_scan(mirror)
+        if scan is None:
+            return None
+        root = mirror._contentdir().local_abspath('.')
+        result = changes.Changes.from_abspaths(root, scan[0], scan[1])
+        result.aggregate(threshold)
+        return result
+
     def mirror_updated(self, mirror):
-        """Cleanup changes for mirror that are older than mirror."""
-        # TODO: make use of the fact different mirrors may have different paths
-        # rather than looking at all mirrors for all paths.
-        if not self.mirrorsets:
+        """Cleanup changes for mirror that are older than mirror.
+
+        Changes are kept until every set sharing mirror's content root has
+        been updated past them.
+        """
+        store = self._store(mirror)
+        if store is None:
             return
+        last = min(float(a_mirror._get_metadata().get('metadata', 'timestamp'))
+            for a_mirror in self.paths[store.root])
         self.changes_lock.acquire()
         try:
-            last = None
-            for mirror in self.mirrorsets.values():
-                metadata = mirror._get_metadata()
-                if last is None:
-                    last = float(metadata.get('metadata', 'timestamp'))
-                else:
-                    last = min(last, float(metadata.get('metadata', 'timestamp')))
-            for path, timestamp in list(self.changes.items()):
-                if timestamp < last:
-                    del self.changes[path]
+            store.prune(last)
+            for log in store.logs:
+                if log.records > 2 * len(store._changes) + LOG_SLACK:
+                    store.rewrite_log(log)
+        finally:
+            self.changes_lock.release()
+
+    def refresh(self):
+        """Discard the changes every set has been updated past.
+
+        This reads the scan timestamp of each set, for when the watcher is
+        not told about updates by a server.
+        """
+        for mirrors in self.paths.values():
+            self.mirror_updated(mirrors[0])
+
+    def close(self):
+        """Remove the change logs being written."""
+        self.changes_lock.acquire()
+        try:
+            for store in self.changes.values():
+                for log in store.logs:
+                    log.close()
+                store.logs = []
         finally:
             self.changes_lock.release()
 
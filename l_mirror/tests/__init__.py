@@ -62,8 +62,15 @@ def test_suite():
         ]
     names = [
         'arguments',
+        'bandwidth',
+        'changes',
+        'checksums',
         'commands',
+        'delta',
+        'eventserver',
+        'hashcache',
         'journals',
+        'loadtest',
         'logging_resource',
         'logging_support',
         'matchers',
@@ -30,6 +30,7 @@ def test_suite():
         'init',
         'mirror',
         'serve',
+        'watch',
         ]
     module_names = ['l_mirror.tests.commands.test_' + name for name in
         names]
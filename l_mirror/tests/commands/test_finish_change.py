@@ -20,13 +20,14 @@
 """Tests for the finish-change command."""
 
 from doctest import ELLIPSIS
+import os
 
 from bzrlib.transport import get_transport
-
+from fixtures import TempDir
 from testtools.matchers import DocTestMatches
 
 from l_mirror.commands import finish_change
-from l_mirror import mirrorset
+from l_mirror import journals, mirrorset
 from l_mirror.ui.model import UI
 from l_mirror.tests import ResourcedTestCase
 from l_mirror.tests.matchers import MatchesException
@@ -103,3 +104,40 @@ updating = False
 """))
         self.assertThat(t.get_bytes('journals/1'), DocTestMatches("""l-mirror-journal-2
 .lmirror\x00new\x00dir\x00.lmirror/sets\x00new\x00dir\x00.lmirror/sets/myname\x00new\x00dir\x00.lmirror/sets/myname/format\x00new\x00file\x00e5fa44f2b31c1fb553b6021e7360d07d5d91ff5e\x002\x000.000000\x00.lmirror/sets/myname/set.conf\x00new\x00file\x00061df21cf828bb333660621c3743cfc3a3b2bd23\x0023\x000.000000\x00abc\x00new\x00file\x0012039d6dd9a7e27622301e935b6eefc78846802e\x0011\x000.000000\x00dir1\x00new\x00dir\x00dir1/def\x00new\x00file\x001f8ac10f23c5b5bc1167bda84b833e5c057a77d2\x006\x000.000000\x00dir2\x00new\x00dir"""))
+
+    def test_prerender(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        t = get_transport(base)
+        t = t.clone('path')
+        t.create_prefix()
+        t.put_bytes('abc', '1234567890\n')
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('prerender', 2)])
+        mirror = mirrorset.initialise(t, 'myname', t, ui)
+        self.assertEqual(0, cmd.execute())
+        t = t.clone('.lmirror/metadata/myname/streams')
+        self.assertEqual(['1-1', '1-1.zlib'], sorted(t.list_dir('.')))
+
+    def test_from_manifest(self):
+        base = self.setup_memory()
+        t = get_transport(base).clone('path')
+        t.create_prefix()
+        root = t.base + 'myname'
+        mirror = mirrorset.initialise(t, 'myname', t, UI())
+        mirror.finish_change()
+        mirror.start_change()
+        t.put_bytes('abc', 'content')
+        t.put_bytes('unlisted', 'content')
+        manifest_path = os.path.join(self.useFixture(TempDir()).path,
+            'manifest')
+        manifest_file = open(manifest_path, 'wb')
+        try:
+            manifest_file.write('abc\x00\x00')
+        finally:
+            manifest_file.close()
+        ui, cmd = self.get_test_ui_and_cmd((root,),
+            [('manifest', manifest_path)])
+        self.assertEqual(0, cmd.execute())
+        journal = journals.parse(
+            t.get_bytes('.lmirror/metadata/myname/journals/2'))
+        self.assertEqual(['abc'], journal.paths.keys())
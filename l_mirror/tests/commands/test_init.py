@@ -48,6 +48,26 @@ class TestCommandCommands(ResourcedTestCase):
         self.assertEqual(0, cmd.execute())
         mirror = mirrorset.MirrorSet(t.clone('path'), 'myname', ui)
 
+    def test_hash(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        t = get_transport(base)
+        t.mkdir('path')
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('hash', 'sha256')])
+        self.assertEqual(0, cmd.execute())
+        mirror = mirrorset.MirrorSet(t.clone('path'), 'myname', ui)
+        self.assertEqual('sha256', mirror.get_hash_name())
+
+    def test_detect_moves(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        t = get_transport(base)
+        t.mkdir('path')
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('detect_moves', True)])
+        self.assertEqual(0, cmd.execute())
+        mirror = mirrorset.MirrorSet(t.clone('path'), 'myname', ui)
+        self.assertEqual(True, mirror.get_detect_moves())
+
     def test_accepts_content_root(self):
         base = self.setup_memory()
         t = get_transport(base)
@@ -20,8 +20,10 @@
 """Tests for the mirror command."""
 
 from doctest import ELLIPSIS
+import socket
 
 from bzrlib.transport import get_transport
+from fixtures import MonkeyPatch
 
 from testtools.matchers import DocTestMatches
 
@@ -34,8 +36,8 @@ from l_mirror.tests.matchers import MatchesException
 
 class TestCommandCommands(ResourcedTestCase):
 
-    def get_test_ui_and_cmd(self, args):
-        ui = UI(args=args)
+    def get_test_ui_and_cmd(self, args, options=()):
+        ui = UI(args=args, options=options)
         cmd = mirror.mirror(ui)
         ui.set_command(cmd)
         return ui, cmd
@@ -85,3 +87,171 @@ class TestCommandCommands(ResourcedTestCase):
         mirror.finish_change()
         self.assertEqual(0, cmd.execute())
         self.assertTrue(clone_t.has('something borrowed'))
+
+    def test_bwlimit(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        t.put_bytes('something blue', 'blue')
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('bwlimit', '1M'), ('adaptive', True)])
+        mirror = mirrorset.initialise(t, 'myname', t, ui)
+        mirror.finish_change()
+        throttles = []
+        receive = mirrorset._MirrorSet.receive
+        def capture(target, source, throttle=None, **kwargs):
+            throttles.append(throttle)
+            return receive(target, source, throttle=throttle, **kwargs)
+        self.useFixture(MonkeyPatch(
+            'l_mirror.mirrorset._MirrorSet.receive', capture))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual('blue', t.get_bytes('../clone/something blue'))
+        self.assertEqual(1048576, throttles[0].max_rate)
+        self.assertTrue(throttles[0].adaptive)
+
+    def test_bad_bwlimit(self):
+        base = self.setup_memory()
+        ui, cmd = self.get_test_ui_and_cmd((base + 'path/myname',
+            base + 'clone'), [('bwlimit', 'fast')])
+        t = get_transport(base).clone('path')
+        t.create_prefix()
+        mirrorset.initialise(t, 'myname', t, ui).finish_change()
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual('error', ui.outputs[-1][0])
+
+    def test_delta(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('delta', True)])
+        mirror = mirrorset.initialise(t, 'myname', t, ui)
+        mirror.finish_change()
+        calls = []
+        receive = mirrorset._MirrorSet.receive
+        def capture(target, source, **kwargs):
+            calls.append(kwargs)
+            return receive(target, source, **kwargs)
+        self.useFixture(MonkeyPatch(
+            'l_mirror.mirrorset._MirrorSet.receive', capture))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(True, calls[0]['delta'])
+        self.assertEqual(False, calls[0]['hardlink'])
+
+    def test_hardlink(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        t.put_bytes('a', 'content')
+        clone_t = t.clone('../clone')
+        clone_t.create_prefix()
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('hardlink', True)])
+        mirror = mirrorset.initialise(t, 'myname', t, ui)
+        mirror.finish_change()
+        target = mirrorset.initialise(clone_t, 'myname', clone_t, ui)
+        target.cancel_change()
+        target.receive(mirror)
+        mirror.start_change()
+        t.rename('a', 'b')
+        mirror.finish_change()
+        self.useFixture(MonkeyPatch('l_mirror.journals.TransportAction.get_file',
+            lambda self: self.fail('content read for %r' % self.path)))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual('content', clone_t.get_bytes('b'))
+        self.assertFalse(clone_t.has('a'))
+
+    def test_watch(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('watch', True), ('interval', 5)])
+        mirror = mirrorset.initialise(t, 'myname', t, ui)
+        mirror.finish_change()
+        clone_t = t.clone('../clone')
+        class StopWatching(Exception):
+            pass
+        sleeps = []
+        def publish(seconds):
+            # Called while waiting for a new journal.
+            sleeps.append(seconds)
+            if len(sleeps) > 1:
+                raise StopWatching()
+            mirror.start_change()
+            t.put_bytes('a', 'content')
+            mirror.finish_change()
+        self.useFixture(MonkeyPatch('time.sleep', publish))
+        self.assertEqual(3, cmd.execute())
+        self.assertThat(ui.outputs[-1][1], MatchesException(StopWatching()))
+        # Only transport errors are retried: the second wait stopped it.
+        self.assertEqual(2, len(sleeps))
+        self.assertEqual('content', clone_t.get_bytes('a'))
+
+    def test_watch_retries_failed_receive(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('watch', True), ('interval', 5)])
+        source_set = mirrorset.initialise(t, 'myname', t, ui)
+        t.put_bytes('a', 'content')
+        source_set.finish_change()
+        clone_t = t.clone('../clone')
+        class StopWatching(Exception):
+            pass
+        receive = mirrorset._MirrorSet.receive
+        receives = []
+        def failing_receive(self, *args, **kwargs):
+            receives.append(None)
+            if len(receives) == 1:
+                raise socket.error('source unreachable')
+            return receive(self, *args, **kwargs)
+        self.useFixture(MonkeyPatch('l_mirror.mirrorset._MirrorSet.receive',
+            failing_receive))
+        sleeps = []
+        def stop(seconds):
+            sleeps.append(seconds)
+            if len(receives) > 1:
+                raise StopWatching()
+        self.useFixture(MonkeyPatch('time.sleep', stop))
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual(2, len(receives))
+        self.assertEqual(5, sleeps[0])
+        self.assertEqual('content', clone_t.get_bytes('a'))
+        logs = [output[3] for output in ui.outputs
+            if output[0] == 'log' and output[2] == mirror.__name__]
+        self.assertThat(logs[0], DocTestMatches(
+            'Receiving ...myname/ failed, retrying in 5 seconds: source '
+            'unreachable', ELLIPSIS))
+
+    def test_watch_stops_on_verification_failure(self):
+        base = self.setup_memory()
+        source = base + 'path/myname'
+        target = base + 'clone'
+        t = get_transport(source).clone('..')
+        t.create_prefix()
+        ui, cmd = self.get_test_ui_and_cmd((source, target),
+            [('watch', True), ('interval', 5)])
+        source_set = mirrorset.initialise(t, 'myname', t, ui)
+        source_set.finish_change()
+        def corrupt_receive(self, *args, **kwargs):
+            raise ValueError('sha1 mismatch')
+        self.useFixture(MonkeyPatch('l_mirror.mirrorset._MirrorSet.receive',
+            corrupt_receive))
+        sleeps = []
+        self.useFixture(MonkeyPatch('time.sleep', sleeps.append))
+        self.assertEqual(3, cmd.execute())
+        self.assertThat(ui.outputs[-1][1],
+            MatchesException(ValueError('sha1 mismatch')))
+        self.assertEqual([], sleeps)
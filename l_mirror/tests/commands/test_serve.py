@@ -63,3 +63,64 @@ class TestCommandServer(ResourcedTestCase):
         self.useFixture(MonkeyPatch('l_mirror.server.Server.start', fake_start))
         self.assertEqual(3, cmd.execute())
         self.assertEqual([1234], fake_calls)
+
+    def test_journal_cache_size(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        root_t = get_transport(base)
+        contentdir = root_t.clone('path')
+        contentdir.create_prefix()
+        mirror = mirrorset.initialise(contentdir, 'myname', contentdir, UI())
+        mirror.finish_change()
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('journal_cache', 2)])
+        fake_calls = []
+        def fake_start(self, port=8080):
+            fake_calls.append(self.journal_cache.max_cost)
+            raise Exception("All good")
+        self.useFixture(MonkeyPatch('l_mirror.server.Server.start', fake_start))
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual([2 * 1024 * 1024], fake_calls)
+
+    def test_bandwidth_limits(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        root_t = get_transport(base)
+        contentdir = root_t.clone('path')
+        contentdir.create_prefix()
+        mirror = mirrorset.initialise(contentdir, 'myname', contentdir, UI())
+        mirror.finish_change()
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('bwlimit', '1M'),
+            ('set_bwlimit', ['myname=512K']), ('client_bwlimit', '64K')])
+        fake_calls = []
+        def fake_start(self, port=8080):
+            fake_calls.append((self.shaper.rate, self.shaper.set_rates,
+                self.shaper.client_rate))
+            raise Exception("All good")
+        self.useFixture(MonkeyPatch('l_mirror.server.Server.start', fake_start))
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual([(1024 * 1024, {'myname': 512 * 1024}, 64 * 1024)],
+            fake_calls)
+
+    def test_event_jitter(self):
+        base = self.setup_memory()
+        root = base + 'path/myname'
+        contentdir = get_transport(base).clone('path')
+        contentdir.create_prefix()
+        mirror = mirrorset.initialise(contentdir, 'myname', contentdir, UI())
+        mirror.finish_change()
+        ui, cmd = self.get_test_ui_and_cmd((root,), [('event_jitter', 2.5)])
+        fake_calls = []
+        def fake_start(self, port=8080):
+            fake_calls.append(self.event_jitter)
+            raise Exception("All good")
+        self.useFixture(MonkeyPatch('l_mirror.server.Server.start', fake_start))
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual([2.5], fake_calls)
+
+    def test_bad_set_bandwidth_limit(self):
+        base = self.setup_memory()
+        ui, cmd = self.get_test_ui_and_cmd((base + 'path/myname',),
+            [('set_bwlimit', ['512K'])])
+        self.assertEqual(3, cmd.execute())
+        self.assertThat(ui.outputs[-1][1], MatchesException(
+            ValueError("invalid set limit '512K': expected NAME=RATE")))
@@ -0,0 +1,62 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+# 
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+# 
+
+"""Tests for the watch command."""
+
+import os
+
+from bzrlib.transport import get_transport
+from fixtures import MonkeyPatch, TempDir
+
+from l_mirror.commands import watch
+from l_mirror import changes, mirrorset
+from l_mirror.ui.model import UI
+from l_mirror.tests import ResourcedTestCase
+
+
+class TestCommandWatch(ResourcedTestCase):
+
+    def get_test_ui_and_cmd(self, args, options=()):
+        ui = UI(args=args, options=options)
+        cmd = watch.watch(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_writes_change_log(self):
+        if watch.pyinotify is None:
+            self.skip('pyinotify not available')
+        path = self.useFixture(TempDir()).path
+        basedir = get_transport(path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, UI())
+        mirror.finish_change()
+        log_path = mirror._metadatadir().local_abspath(changes.CHANGE_LOG)
+        ui, cmd = self.get_test_ui_and_cmd((path + '/myname',),
+            [('refresh', 0)])
+        logs = []
+        def fake_refresh(self):
+            self.wait()
+            logs.append(changes.read_log(log_path, 0))
+            raise KeyboardInterrupt
+        self.useFixture(MonkeyPatch('l_mirror.server.SetWatcher.refresh',
+            fake_refresh))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(1, len(logs))
+        self.assertNotEqual(None, logs[0])
+        # The log is removed once the watcher stops.
+        self.assertFalse(os.path.exists(log_path))
@@ -0,0 +1,237 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""A load test harness for lmirror servers.
+
+This opens many concurrent connections to a URL - typically a /stream/ URL of
+an lmirror serve - and reads the responses, optionally at a limited rate to
+emulate slow receivers. All the clients are driven from a single thread with
+poll, so thousands of clients can be run (subject to the open file limit).
+
+Run it as a script::
+
+ $ python -m l_mirror.tests.loadtest --clients 2000 --rate 20000 \\
+     http://127.0.0.1:8080/stream/myset/1/10
+"""
+
+from optparse import OptionParser
+import errno
+import select
+import socket
+import sys
+import time
+from urlparse import urlsplit
+
+
+class ClientResult(object):
+    """The outcome of one load test client.
+
+    :ivar status: The HTTP status line, or None if none was received.
+    :ivar length: The number of bytes of body received.
+    :ivar first_byte: Seconds from starting to the first byte received.
+    :ivar duration: Seconds from starting to the end of the response.
+    :ivar error: None, or a description of why the client failed.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.length = 0
+        self.first_byte = None
+        self.duration = None
+        self.error = None
+
+
+class _Client(object):
+    """A client reading one response."""
+
+    def __init__(self, address, request, rate, start):
+        self.result = ClientResult()
+        self.request = request
+        self.rate = rate
+        self.start = start
+        self.received = 0
+        self.head = ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        err = self.socket.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            raise socket.error(err, 'connect failed')
+
+    def allowance(self, now):
+        """How many bytes the client may read at now."""
+        if self.rate is None:
+            return 65536
+        return min(65536, int(self.rate * (now - self.start)) - self.received)
+
+    def write(self):
+        sent = self.socket.send(self.request)
+        self.request = self.request[sent:]
+
+    def read(self, now):
+        """Read from the socket. Returns True when the response is done."""
+        allowance = self.allowance(now)
+        if allowance <= 0:
+            return False
+        data = self.socket.recv(allowance)
+        if not data:
+            self.finish(now)
+            return True
+        if self.result.first_byte is None:
+            self.result.first_byte = now - self.start
+        self.received += len(data)
+        if self.result.status is None:
+            self.head += data
+            end = self.head.find('\r\n\r\n')
+            if end != -1:
+                self.result.status = self.head.split('\r\n', 1)[0]
+                self.result.length = len(self.head) - end - 4
+                self.head = ''
+        else:
+            self.result.length += len(data)
+        return False
+
+    def finish(self, now, error=None):
+        self.result.duration = now - self.start
+        if error is None and self.result.status is None:
+            error = 'connection closed without a response'
+        self.result.error = error
+        self.socket.close()
+
+
+def run(url, clients, rate=None, timeout=None):
+    """Run a load test.
+
+    Each client makes an HTTP/1.0 GET of url and reads the response until the
+    server closes the connection.
+
+    :param url: The http URL to request.
+    :param clients: The number of concurrent clients to run.
+    :param rate: If not None, the most bytes per second each client reads.
+    :param timeout: If not None, clients still running after this many
+        seconds are failed.
+    :return: A list of ClientResult objects.
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 'http':
+        raise ValueError('only http URLs are supported: %r' % url)
+    address = (parts.hostname, parts.port or 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    request = 'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, parts.netloc)
+    start = time.time()
+    poller = select.poll()
+    active = {}
+    results = []
+    for _ in range(clients):
+        client = _Client(address, request, rate, start)
+        results.append(client.result)
+        active[client.socket.fileno()] = client
+        poller.register(client.socket.fileno(), select.POLLOUT)
+    while active:
+        now = time.time()
+        if timeout is not None and now - start > timeout:
+            for client in active.values():
+                client.finish(now, 'timed out')
+            break
+        # Clients which have exhausted their allowance are not polled for
+        # reading, so wake up regularly to resume them.
+        for fd, event in poller.poll(50):
+            client = active[fd]
+            now = time.time()
+            try:
+                if client.request:
+                    client.write()
+                    if not client.request:
+                        poller.modify(fd, select.POLLIN)
+                    continue
+                done = client.read(now)
+            except socket.error, e:
+                client.finish(now, str(e))
+                done = True
+            if done:
+                poller.unregister(fd)
+                del active[fd]
+            elif client.allowance(now) <= 0:
+                poller.modify(fd, 0)
+        now = time.time()
+        for fd, client in active.items():
+            if not client.request and client.allowance(now) > 0:
+                poller.modify(fd, select.POLLIN)
+    return results
+
+
+def summarise(results, elapsed):
+    """Summarise the results of a load test as a list of lines."""
+    failed = [result for result in results if result.error is not None]
+    done = [result for result in results if result.error is None]
+    statuses = {}
+    for result in done:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    total = sum(result.length for result in results)
+    lines = ['clients: %d ok, %d failed' % (len(done), len(failed))]
+    for status, count in sorted(statuses.items()):
+        lines.append('  %s: %d' % (status, count))
+    errors = {}
+    for result in failed:
+        errors[result.error] = errors.get(result.error, 0) + 1
+    for error, count in sorted(errors.items()):
+        lines.append('  error %s: %d' % (error, count))
+    lines.append('elapsed: %.2fs, %d bytes, %.0f bytes/s' % (elapsed, total,
+        total / max(elapsed, 0.001)))
+    if done:
+        durations = sorted(result.duration for result in done)
+        first_bytes = sorted(result.first_byte for result in done
+            if result.first_byte is not None)
+        lines.append('duration: min %.3fs median %.3fs max %.3fs' % (
+            durations[0], durations[len(durations) // 2], durations[-1]))
+        if first_bytes:
+            lines.append('first byte: median %.3fs max %.3fs' % (
+                first_bytes[len(first_bytes) // 2], first_bytes[-1]))
+    return lines
+
+
+def main(argv=None, stdout=None):
+    """Run a load test from the command line."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if stdout is None:
+        stdout = sys.stdout
+    parser = OptionParser(usage="%prog [options] URL")
+    parser.add_option("--clients", "-c", dest="clients", type="int",
+        default=100, help="The number of concurrent clients. Defaults to 100.")
+    parser.add_option("--rate", "-r", dest="rate", type="int", default=None,
+        help="Limit each client to reading this many bytes per second.")
+    parser.add_option("--timeout", "-t", dest="timeout", type="float",
+        default=None, help="Fail clients still running after this many "
+        "seconds.")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("A single URL is required.")
+    start = time.time()
+    results = run(args[0], options.clients, options.rate, options.timeout)
+    for line in summarise(results, time.time() - start):
+        stdout.write(line + '\n')
+    if [result for result in results if result.error is not None]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+# 
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+# 
+
+"""Tests for bandwidth limiting."""
+
+from StringIO import StringIO
+
+from l_mirror import bandwidth, eventserver, journals
+from l_mirror.tests import ResourcedTestCase
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestParseRate(ResourcedTestCase):
+
+    def test_rates(self):
+        self.assertEqual(100, bandwidth.parse_rate('100'))
+        self.assertEqual(512 * 1024, bandwidth.parse_rate('512K'))
+        self.assertEqual(1536 * 1024, bandwidth.parse_rate('1.5m'))
+        self.assertEqual(2 * 1024 ** 3, bandwidth.parse_rate('2G'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, bandwidth.parse_rate, 'fast')
+        self.assertRaises(ValueError, bandwidth.parse_rate, '0')
+        self.assertRaises(ValueError, bandwidth.parse_rate, '10T')
+
+
+class TestTokenBucket(ResourcedTestCase):
+
+    def test_take_and_refill(self):
+        clock = FakeClock()
+        bucket = bandwidth.TokenBucket(1000, burst=500, clock=clock)
+        self.assertEqual(500, bucket.take(800))
+        self.assertEqual(0, bucket.take(10))
+        self.assertEqual(0.1, bucket.wait_time(100))
+        clock.now = 0.1
+        self.assertEqual(100, bucket.take(800))
+        # Never more than the burst.
+        clock.now = 10
+        self.assertEqual(500, bucket.take(800))
+
+    def test_default_burst(self):
+        self.assertEqual(bandwidth.MIN_BURST, bandwidth.TokenBucket(10).burst)
+        self.assertEqual(1000000, bandwidth.TokenBucket(10000000).burst)
+
+
+class TestShaper(ResourcedTestCase):
+
+    def get_shaper(self, **kwargs):
+        clock = FakeClock()
+        shaper = bandwidth.Shaper(clock=clock, sleep=clock.sleep, **kwargs)
+        return shaper, clock
+
+    def test_no_limits_passes_through(self):
+        shaper, clock = self.get_shaper()
+        self.assertEqual(['abc', '', 'def'],
+            list(shaper.shape(['abc', '', 'def'], 'set', '1.2.3.4')))
+        self.assertEqual([], clock.sleeps)
+
+    def test_global_limit(self):
+        shaper, clock = self.get_shaper(rate=1000000)
+        content = 'x' * 250000
+        response = shaper.shape([content], 'set', '1.2.3.4')
+        self.assertEqual(content, ''.join(response))
+        # The initial burst is free, the rest is limited.
+        self.assertAlmostEqual(0.15, clock.now, places=5)
+
+    def test_cooperative_does_not_sleep(self):
+        shaper, clock = self.get_shaper(rate=100000)
+        response = iter(shaper.shape(['x' * 30000], 'set', '1.2.3.4',
+            cooperative=True))
+        self.assertEqual(16384, len(response.next()))
+        self.assertEqual(eventserver.NOT_READY, response.next())
+        clock.now = 1
+        self.assertEqual(13616, len(response.next()))
+        self.assertEqual([], clock.sleeps)
+
+    def test_set_and_client_limits(self):
+        shaper, clock = self.get_shaper(set_rates={'slow': 100000},
+            client_rate=200000)
+        list(shaper.shape(['x' * 120000], 'fast', '1.2.3.4'))
+        self.assertAlmostEqual(0.5, clock.now, places=5)
+        list(shaper.shape(['x' * 120000], 'slow', '1.2.3.5'))
+        self.assertAlmostEqual(0.5 + 1.03616, clock.now, places=5)
+        # Client limits are discarded when the client is idle.
+        self.assertEqual({}, shaper._clients)
+
+    def test_fair_share(self):
+        shaper, clock = self.get_shaper(rate=100000)
+        first = shaper.shape(['x' * 100000], 'set', 'a')
+        second = shaper.shape(['x' * 100000], 'set', 'b')
+        # Each active response gets half the burst at a time.
+        self.assertEqual(8192, len(iter(first).next()))
+        self.assertEqual(8192, len(iter(second).next()))
+        first.close()
+        self.assertEqual(16384, len(iter(second).next()))
+
+    def test_file_segments_are_split(self):
+        shaper, clock = self.get_shaper(rate=1000000)
+        segment = journals.FileSegment(None, 10, 200000)
+        segments = list(shaper.shape([segment], 'set', 'a'))
+        self.assertEqual([(10, 65536), (65546, 65536), (131082, 65536),
+            (196618, 3392)],
+            [(s.offset, s.length) for s in segments])
+
+    def test_close_closes_response(self):
+        closed = []
+        class Response(list):
+            def close(self):
+                closed.append(True)
+        shaper, clock = self.get_shaper(rate=100000)
+        shaper.shape(Response(['abc']), 'set', 'a').close()
+        self.assertEqual([True], closed)
+
+
+class TestThrottle(ResourcedTestCase):
+
+    def get_throttle(self, rate=None, adaptive=False):
+        clock = FakeClock()
+        return bandwidth.Throttle(rate, adaptive=adaptive, clock=clock,
+            sleep=clock.sleep), clock
+
+    def test_unlimited(self):
+        throttle, clock = self.get_throttle()
+        self.assertEqual(1000000, throttle.allow(1000000))
+        self.assertEqual([], clock.sleeps)
+
+    def test_limited(self):
+        throttle, clock = self.get_throttle(rate=100000)
+        reader = throttle.reader(StringIO('x' * 50000))
+        self.assertEqual(50000, len(reader.read()))
+        # A 16384 byte burst, then reads wait for a burst of tokens each, and
+        # the tokens not used at the end of the file are not lost.
+        self.assertAlmostEqual(0.5, clock.now, 3)
+        self.assertEqual(16384, throttle._bucket.tokens)
+
+    def test_short_reads(self):
+        throttle, clock = self.get_throttle(rate=100000)
+        reader = throttle.reader(StringIO('x' * 50000))
+        self.assertEqual(16384, len(reader.read(50000)))
+
+    def test_writer_not_timed_without_adaptive(self):
+        throttle, clock = self.get_throttle(rate=100000)
+        a_file = StringIO()
+        self.assertTrue(a_file is throttle.writer(a_file))
+
+    def test_adaptive_backs_off_and_recovers(self):
+        throttle, clock = self.get_throttle(adaptive=True)
+        # _TimedFile measures with the clock, so advance it during writes.
+        class SlowFile(object):
+            def __init__(self):
+                self.delay = 0.01
+            def write(self, content):
+                clock.now += self.delay
+        slow = SlowFile()
+        writer = throttle.writer(slow)
+        reader = throttle.reader(StringIO('x' * 200 * 65536))
+        for _ in range(200):
+            writer.write(reader.read(65536))
+        self.assertEqual(None, throttle.rate)
+        # The disk slows down: the rate drops.
+        slow.delay = 0.5
+        for _ in range(10):
+            writer.write(reader.read(65536))
+        self.assertNotEqual(None, throttle.rate)
+        slowed = throttle.rate
+        self.assertTrue(slowed >= bandwidth.MIN_ADAPTIVE_RATE)
+        # It recovers: the rate climbs back to unlimited.
+        slow.delay = 0.01
+        reader = throttle.reader(StringIO('x' * 2000 * 65536))
+        for _ in range(2000):
+            writer.write(reader.read(65536))
+            if throttle.rate is None:
+                break
+        self.assertEqual(None, throttle.rate)
+
+    def test_adaptive_respects_limit(self):
+        throttle, clock = self.get_throttle(rate=200000, adaptive=True)
+        throttle.note_write(65536, 2.0)
+        clock.now += 2
+        throttle.note_write(65536, 0.01)
+        self.assertTrue(throttle.rate <= 200000)
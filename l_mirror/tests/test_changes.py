@@ -0,0 +1,150 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+
+"""Tests for grouped changes."""
+
+import os
+
+from fixtures import TempDir
+
+from l_mirror import changes
+from l_mirror.tests import ResourcedTestCase
+
+
+class TestChanges(ResourcedTestCase):
+
+    def test_from_abspaths(self):
+        result = changes.Changes.from_abspaths('/root',
+            ['/root/a', '/root/d/b', '/root/d/c', '/root'], ['/root/e'])
+        self.assertEqual({'': set(['a']), 'd': set(['b', 'c'])}, result.dirs)
+        self.assertEqual(set(['e']), result.scan)
+
+    def test_in_scan(self):
+        result = changes.Changes()
+        self.assertFalse(result.in_scan('a'))
+        result.scan.add('a/b')
+        self.assertTrue(result.in_scan('a/b'))
+        self.assertTrue(result.in_scan('a/b/c'))
+        self.assertFalse(result.in_scan('a'))
+        self.assertFalse(result.in_scan('a/bc'))
+        result.scan.add('')
+        self.assertTrue(result.in_scan('z'))
+
+    def test_aggregate(self):
+        result = changes.Changes()
+        for name in ('a', 'b', 'c'):
+            result.add('d/' + name)
+            result.add('d/e/' + name)
+        result.add('f/a')
+        result.scan.add('d/e/g')
+        result.aggregate(2)
+        # d is scanned, so everything within it is dropped.
+        self.assertEqual(set(['d']), result.scan)
+        self.assertEqual({'f': set(['a'])}, result.dirs)
+
+    def test_round_trip(self):
+        result = changes.Changes()
+        result.add('a')
+        result.add('d/b')
+        result.add('d/c')
+        result.scan.add('e')
+        content = ''.join(result.iter_bytes())
+        self.assertEqual('l-mirror-changes-1\nscan\x00e\x00'
+            'dir\x00\x001\x00a\x00dir\x00d\x002\x00b\x00c\x00', content)
+        parsed = changes.parse(content)
+        self.assertEqual(result.dirs, parsed.dirs)
+        self.assertEqual(result.scan, parsed.scan)
+
+    def test_parse_errors(self):
+        self.assertRaises(ValueError, changes.parse, '["a"]')
+        self.assertRaises(ValueError, changes.parse,
+            'l-mirror-changes-1\nscan\x00e')
+        self.assertRaises(ValueError, changes.parse,
+            'l-mirror-changes-1\ndir\x00d\x002\x00b\x00')
+        self.assertRaises(ValueError, changes.parse,
+            'l-mirror-changes-1\nfoo\x00')
+
+    def test_as_tree(self):
+        result = changes.Changes()
+        result.add('a')
+        result.add('d/e/b')
+        result.scan.add('f')
+        self.assertEqual({
+            'a': ('a', {}),
+            'd': ('d', {'e': ('d/e', {'b': ('d/e/b', {})})}),
+            'f': ('f', {}),
+            }, result.as_tree())
+
+
+class TestChangeLog(ResourcedTestCase):
+
+    def get_log(self):
+        path = os.path.join(self.useFixture(TempDir()).path, 'changes.log')
+        log = changes.ChangeLog(path)
+        log.open()
+        self.addCleanup(log.close)
+        return log
+
+    def test_read_log(self):
+        log = self.get_log()
+        log.note('a', 10.0)
+        log.note('d/b', 20.0)
+        # Not all watched yet.
+        self.assertEqual(None, changes.read_log(log.path, 0))
+        log.walked(20.0)
+        log.note('d/c', 30.0)
+        known = changes.read_log(log.path, 0)
+        self.assertEqual({'': set(['a']), 'd': set(['b', 'c'])}, known.dirs)
+        # Changes well before the last scan are ignored.
+        known = changes.read_log(log.path, 25.0)
+        self.assertEqual({'d': set(['c'])}, known.dirs)
+        self.assertEqual(4, log.records)
+
+    def test_partial_record_ignored(self):
+        log = self.get_log()
+        log.walked(1.0)
+        log._file.write('change\x0010.0\x00partial')
+        self.assertEqual({}, changes.read_log(log.path, 0).dirs)
+
+    def test_overflow(self):
+        log = self.get_log()
+        log.walked(1.0)
+        log.overflowed(10.0)
+        self.assertEqual(None, changes.read_log(log.path, 5.0))
+        self.assertNotEqual(None, changes.read_log(log.path, 15.0))
+
+    def test_rewrite(self):
+        log = self.get_log()
+        log.note('a', 10.0)
+        log.note('b', 20.0)
+        log.rewrite([(20.0, 'b')], walked=20.0)
+        self.assertEqual(2, log.records)
+        self.assertEqual({'': set(['b'])},
+            changes.read_log(log.path, 0).dirs)
+        log.note('c', 30.0)
+        self.assertEqual({'': set(['b', 'c'])},
+            changes.read_log(log.path, 0).dirs)
+
+    def test_needs_watcher(self):
+        log = self.get_log()
+        self.assertRaises(ValueError, changes.ChangeLog(log.path).open)
+        log.walked(1.0)
+        log.close()
+        self.assertEqual(None, changes.read_log(log.path, 0))
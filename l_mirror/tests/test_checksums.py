@@ -0,0 +1,130 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Tests for trusted checksum sources."""
+
+import gzip
+from StringIO import StringIO
+
+from bzrlib.transport import get_transport
+
+from l_mirror import checksums
+from l_mirror.tests import ResourcedTestCase
+
+
+class Stat(object):
+
+    def __init__(self, size, mtime):
+        self.st_size = size
+        self.st_mtime = mtime
+
+
+PACKAGES = """Package: a
+Version: 1.0
+Filename: pool/main/a/a_1.0_all.deb
+Size: 100
+SHA1: %s
+
+Package: b
+Filename: pool/main/b/b_1.0_all.deb
+Size: 200
+SHA256: abcd
+""" % ('1' * 40)
+
+SOURCES = """Package: a
+Directory: pool/main/a
+Checksums-Sha1:
+ %s 10 a_1.0.dsc
+ %s 20 a_1.0.tar.gz
+""" % ('1' * 40, '2' * 40)
+
+
+class TestChecksums(ResourcedTestCase):
+
+    def get_transport(self):
+        transport = get_transport(self.setup_memory()).clone('path')
+        transport.create_prefix()
+        return transport
+
+    def test_sidecar(self):
+        transport = self.get_transport()
+        transport.put_bytes('sums', '%s 7 10.5 dir/a file\n' % ('1' * 40))
+        source = checksums.SidecarChecksums(transport, 'sums')
+        self.assertEqual('1' * 40,
+            source.get_sha1('dir/a file', Stat(7, 10.5)))
+        # Changed size or mtime.
+        self.assertEqual(None, source.get_sha1('dir/a file', Stat(8, 10.5)))
+        self.assertEqual(None, source.get_sha1('dir/a file', Stat(7, 11.0)))
+        self.assertEqual(None, source.get_sha1('other', Stat(7, 10.5)))
+
+    def test_sidecar_missing(self):
+        source = checksums.SidecarChecksums(self.get_transport(), 'sums')
+        self.assertEqual(None, source.get_sha1('a', Stat(7, 10.5)))
+
+    def test_sidecar_invalid(self):
+        transport = self.get_transport()
+        transport.put_bytes('sums', 'junk\n')
+        source = checksums.SidecarChecksums(transport, 'sums')
+        self.assertRaises(ValueError, source.get_sha1, 'a', Stat(7, 10.5))
+
+    def test_packages(self):
+        transport = self.get_transport()
+        transport.put_bytes('Packages', PACKAGES)
+        source = checksums.DebianIndexChecksums(transport, 'Packages')
+        # The memory transport has no mtimes, so the index is from time 0.
+        path = 'pool/main/a/a_1.0_all.deb'
+        self.assertEqual('1' * 40, source.get_sha1(path, Stat(100, 0)))
+        # Newer than the index.
+        self.assertEqual(None, source.get_sha1(path, Stat(100, 1)))
+        self.assertEqual(None, source.get_sha1(path, Stat(101, 0)))
+        # No SHA1 field.
+        self.assertEqual(None,
+            source.get_sha1('pool/main/b/b_1.0_all.deb', Stat(200, 0)))
+
+    def test_sources_gzipped(self):
+        transport = self.get_transport()
+        compressed = StringIO()
+        gz = gzip.GzipFile(fileobj=compressed, mode='wb')
+        gz.write(SOURCES)
+        gz.close()
+        transport.put_bytes('Sources.gz', compressed.getvalue())
+        source = checksums.DebianIndexChecksums(transport, 'Sources.gz')
+        self.assertEqual('2' * 40,
+            source.get_sha1('pool/main/a/a_1.0.tar.gz', Stat(20, 0)))
+
+    def test_get_source(self):
+        transport = self.get_transport()
+        self.assertEqual(None, checksums.get_source(transport, []))
+        source = checksums.get_source(transport, [('sidecar', 'sums')])
+        self.assertIsInstance(source, checksums.SidecarChecksums)
+        source = checksums.get_source(transport, [('sidecar', 'sums'),
+            ('debian', 'Packages')])
+        self.assertIsInstance(source, checksums.CombinedChecksums)
+        self.assertRaises(ValueError, checksums.get_source, transport,
+            [('unknown', 'sums')])
+
+    def test_combined(self):
+        transport = self.get_transport()
+        transport.put_bytes('sums', '%s 7 10.5 a\n' % ('1' * 40))
+        transport.put_bytes('Packages', PACKAGES)
+        source = checksums.get_source(transport, [('sidecar', 'sums'),
+            ('debian', 'Packages')])
+        self.assertEqual('1' * 40, source.get_sha1('a', Stat(7, 10.5)))
+        self.assertEqual('1' * 40,
+            source.get_sha1('pool/main/a/a_1.0_all.deb', Stat(100, 0)))
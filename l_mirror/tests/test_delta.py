@@ -0,0 +1,153 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Tests for delta transfer."""
+
+from hashlib import sha1 as sha
+from StringIO import StringIO
+
+from bzrlib.transport import get_transport
+
+from l_mirror import delta
+from l_mirror.tests import ResourcedTestCase
+
+
+def packages(count, version='1.0'):
+    """Make some Packages file like content."""
+    return ''.join('Package: p%d\nVersion: %s\nDescription: package %d\n\n'
+        % (index, version, index) for index in range(count))
+
+
+class TestChunks(ResourcedTestCase):
+
+    def test_chunks_cover_content(self):
+        content = packages(5000)
+        chunks = list(delta.iter_chunks(StringIO(content)))
+        self.assertEqual(content, ''.join(chunks))
+        for chunk in chunks[:-1]:
+            self.assertTrue(delta.MIN_CHUNK <= len(chunk) <= delta.MAX_CHUNK)
+            self.assertTrue(chunk.endswith('\n'))
+
+    def test_no_newlines(self):
+        content = 'x' * (delta.MAX_CHUNK * 2 + 10)
+        self.assertEqual([delta.MAX_CHUNK, delta.MAX_CHUNK, 10],
+            [len(chunk) for chunk in delta.iter_chunks(StringIO(content))])
+
+    def test_empty(self):
+        self.assertEqual([], list(delta.iter_chunks(StringIO(''))))
+
+    def test_edits_are_local(self):
+        old = packages(5000)
+        new = old.replace('Package: p2500\n', 'Package: p2500\nNew: yes\n')
+        old_chunks = set(delta.iter_chunks(StringIO(old)))
+        new_chunks = list(delta.iter_chunks(StringIO(new)))
+        changed = [chunk for chunk in new_chunks if chunk not in old_chunks]
+        self.assertTrue(len(changed) <= 2)
+
+    def test_signature(self):
+        content = packages(5000)
+        chunks = delta.parse_signature(delta.signature(StringIO(content)))
+        self.assertEqual(len(content), sum(chunk[1] for chunk in chunks))
+        self.assertEqual(0, chunks[0][0])
+        self.assertEqual(chunks[0][1], chunks[1][0])
+
+    def test_bad_signature(self):
+        self.assertRaises(ValueError, delta.parse_signature, 'abc')
+
+
+class TestDeltaFile(ResourcedTestCase):
+
+    def get_source(self, old, new):
+        base = get_transport(self.setup_memory())
+        basis = base.clone('basis')
+        basis.create_prefix()
+        if old is not None:
+            basis.put_bytes('Packages', old)
+        content = base.clone('content')
+        content.create_prefix()
+        content.put_bytes('Packages', new)
+        readvs = []
+        readv = content.readv
+        def logging_readv(relpath, offsets, *args, **kwargs):
+            readvs.extend(offsets)
+            return readv(relpath, offsets, *args, **kwargs)
+        content.readv = logging_readv
+        return delta.DeltaSource(basis, content), readvs
+
+    def test_reconstructs_from_basis(self):
+        old = packages(5000)
+        new = old.replace('Version: 1.0\nDescription: package 2500\n',
+            'Version: 2.0\nDescription: package 2500\n')
+        source, readvs = self.get_source(old, new)
+        a_file = source.get_file('Packages',
+            delta.signature(StringIO(new)), len(new))
+        pieces = []
+        piece = a_file.read(65536)
+        while piece:
+            pieces.append(piece)
+            piece = a_file.read(65536)
+        a_file.close()
+        self.assertEqual(new, ''.join(pieces))
+        # Only the changed chunk was fetched.
+        self.assertEqual(1, len(readvs))
+        self.assertTrue(readvs[0][1] <= delta.MAX_CHUNK)
+
+    def test_no_basis(self):
+        new = packages(500)
+        source, readvs = self.get_source(None, new)
+        a_file = source.get_file('Packages',
+            delta.signature(StringIO(new)), len(new))
+        self.assertEqual(new, a_file.read())
+        self.assertEqual([(0, len(new))], readvs)
+
+    def test_close_without_reading(self):
+        new = packages(500)
+        source, readvs = self.get_source(packages(500, '2.0'), new)
+        a_file = source.get_file('Packages',
+            delta.signature(StringIO(new)), len(new))
+        a_file.close()
+        self.assertEqual([], readvs)
+
+    def test_fetches_by_sha1_from_blobs(self):
+        new = packages(500)
+        new_sha1 = sha(new).hexdigest()
+        source, readvs = self.get_source(None, new)
+        blobs = source.content.clone('../blobs')
+        blobs.create_prefix()
+        blobs.put_bytes(new_sha1, new)
+        source.blobs = blobs
+        a_file = source.get_file('Packages',
+            delta.signature(StringIO(new)), len(new), new_sha1)
+        self.assertEqual(new, a_file.read())
+        self.assertEqual([], readvs)
+
+    def test_falls_back_to_path_without_blob(self):
+        new = packages(500)
+        source, readvs = self.get_source(None, new)
+        source.blobs = source.content.clone('../blobs')
+        a_file = source.get_file('Packages',
+            delta.signature(StringIO(new)), len(new), sha(new).hexdigest())
+        self.assertEqual(new, a_file.read())
+        self.assertEqual([(0, len(new))], readvs)
+
+    def test_wrong_length(self):
+        new = packages(500)
+        source, readvs = self.get_source(None, new)
+        self.assertRaises(ValueError, source.get_file, 'Packages',
+            delta.signature(StringIO(new)), len(new) + 1)
@@ -0,0 +1,205 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+# 
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+# 
+
+"""Tests for the event loop http server."""
+
+import httplib
+import logging
+import threading
+
+from fixtures import MonkeyPatch, TempDir
+
+from l_mirror import eventserver, journals
+from l_mirror.tests import ResourcedTestCase
+from l_mirror.tests.logging_resource import LoggingResourceManager
+
+
+class TestEventServer(ResourcedTestCase):
+
+    resources = [('logging', LoggingResourceManager())]
+
+    def start(self, app):
+        server = eventserver.EventServer(app, '127.0.0.1', 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        def stop():
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return server
+
+    def connect(self, server):
+        connection = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_get(self):
+        environs = []
+        def app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['hello ', 'world']
+        server = self.start(app)
+        connection = self.connect(server)
+        connection.request('GET', '/foo%20bar?baz=1')
+        response = connection.getresponse()
+        self.assertEqual(200, response.status)
+        self.assertEqual('hello world', response.read())
+        self.assertEqual('close', response.getheader('connection'))
+        self.assertEqual('/foo bar', environs[0]['PATH_INFO'])
+        self.assertEqual('baz=1', environs[0]['QUERY_STRING'])
+        self.assertEqual(True, environs[0]['lmirror.cooperative'])
+
+    def test_keep_alive(self):
+        def app(environ, start_response):
+            body = environ['PATH_INFO']
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+        server = self.start(app)
+        connection = self.connect(server)
+        connection.request('GET', '/first')
+        self.assertEqual('/first', connection.getresponse().read())
+        connection.request('GET', '/second')
+        self.assertEqual('/second', connection.getresponse().read())
+        self.assertEqual(1, len(server.connections))
+
+    def test_not_ready_is_polled_again(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return ['a', eventserver.NOT_READY, eventserver.NOT_READY, 'b']
+        server = self.start(app)
+        connection = self.connect(server)
+        connection.request('GET', '/')
+        self.assertEqual('ab', connection.getresponse().read())
+
+    def test_empty_chunks_not_polled(self):
+        parked = []
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '1')])
+            # As paste's fileapp answers HEAD requests.
+            return ['', 'a', '']
+        server = self.start(app)
+        park = server._park
+        def logging_park(connection):
+            parked.append(connection)
+            park(connection)
+        server._park = logging_park
+        connection = self.connect(server)
+        connection.request('GET', '/')
+        self.assertEqual('a', connection.getresponse().read())
+        self.assertEqual([], parked)
+
+    def test_slow_setup_does_not_stall_others(self):
+        release = threading.Event()
+        waited = []
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                # As when combining journals that are not cached.
+                release.wait(5)
+                waited.append(release.isSet())
+            start_response('200 OK', [])
+            return [environ['PATH_INFO']]
+        server = self.start(app)
+        slow = self.connect(server)
+        slow.request('GET', '/slow')
+        fast = self.connect(server)
+        fast.request('GET', '/fast')
+        self.assertEqual('/fast', fast.getresponse().read())
+        release.set()
+        self.assertEqual('/slow', slow.getresponse().read())
+        # The slow request was still being set up when the fast one was
+        # answered.
+        self.assertEqual([True], waited)
+
+    def test_slow_chunk_does_not_stall_others(self):
+        release = threading.Event()
+        waited = []
+        def slow_chunks():
+            yield 'a'
+            # As when calculating the signature of a large file.
+            release.wait(5)
+            waited.append(release.isSet())
+            yield 'b'
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            if environ['PATH_INFO'] == '/slow':
+                return slow_chunks()
+            return [environ['PATH_INFO']]
+        server = self.start(app)
+        slow = self.connect(server)
+        slow.request('GET', '/slow')
+        response = slow.getresponse()
+        self.assertEqual('a', response.read(1))
+        fast = self.connect(server)
+        fast.request('GET', '/fast')
+        self.assertEqual('/fast', fast.getresponse().read())
+        release.set()
+        self.assertEqual('b', response.read())
+        # The slow chunk was still being got when the fast request was
+        # answered.
+        self.assertEqual([True], waited)
+
+    def test_file_segments(self):
+        path = self.useFixture(TempDir()).path + '/content'
+        f = open(path, 'wb')
+        try:
+            f.write('0123456789' * 10000)
+        finally:
+            f.close()
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            content = open(path, 'rb')
+            return ['a', journals.FileSegment(content, 5, 99990), 'b']
+        server = self.start(app)
+        connection = self.connect(server)
+        connection.request('GET', '/')
+        expected = 'a' + ('0123456789' * 10000)[5:-5] + 'b'
+        self.assertEqual(expected, connection.getresponse().read())
+        self.useFixture(MonkeyPatch('l_mirror.eventserver.sendfile', None))
+        connection = self.connect(server)
+        connection.request('GET', '/')
+        self.assertEqual(expected, connection.getresponse().read())
+
+    def test_application_error(self):
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        # The logger predates the logging resource, so capture it directly.
+        eventserver._logger.addHandler(handler)
+        self.addCleanup(eventserver._logger.removeHandler, handler)
+        def app(environ, start_response):
+            raise ValueError('boom')
+        server = self.start(app)
+        connection = self.connect(server)
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        self.assertEqual(500, response.status)
+        response.read()
+        self.assertEqual('Error calling WSGI application for %s',
+            records[0].msg)
+
+    def test_bad_request(self):
+        server = self.start(None)
+        connection = self.connect(server)
+        connection.connect()
+        connection.sock.sendall('nonsense\r\n\r\n')
+        self.assertEqual('HTTP/1.0 400 Bad Request',
+            connection.sock.recv(4096).split('\r\n')[0])
@@ -0,0 +1,220 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+#
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+#
+
+"""Tests for the hash cache and small file pack."""
+
+import time
+
+from bzrlib.transport import get_transport
+from fixtures import MonkeyPatch
+
+from l_mirror import hashcache
+from l_mirror.tests import ResourcedTestCase
+
+
+class Stat(object):
+
+    def __init__(self, size, mtime, ino=1, ctime=None):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ino = ino
+        self.st_ctime = ctime or mtime
+
+
+class TestHashCache(ResourcedTestCase):
+
+    def get_transport(self):
+        transport = get_transport(self.setup_memory()).clone('path')
+        transport.create_prefix()
+        return transport
+
+    def test_add_get(self):
+        cache = hashcache.HashCache(self.get_transport())
+        self.assertEqual(None, cache.get('a', Stat(7, 10.5)))
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        self.assertEqual('1' * 40, cache.get('a', Stat(7, 10.5)))
+        self.assertEqual(None, cache.get('a', Stat(8, 10.5)))
+        self.assertEqual(None, cache.get('a', Stat(7, 10.6)))
+        self.assertEqual(None, cache.get('a', Stat(7, 10.5, ino=2)))
+        self.assertEqual(None, cache.get('a', Stat(7, 10.5, ctime=11)))
+
+    def test_recent_files_not_added(self):
+        cache = hashcache.HashCache(self.get_transport())
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        now = time.time()
+        cache.add('a', Stat(7, now), '2' * 40)
+        self.assertEqual(None, cache.get('a', Stat(7, now)))
+        self.assertEqual(None, cache.get('a', Stat(7, 10.5)))
+
+    def test_save_load(self):
+        transport = self.get_transport()
+        cache = hashcache.HashCache(transport)
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        cache.add('dir/b', Stat(3, 20), 'sha256:abcd')
+        cache.add('c', Stat(3, 20), '2' * 40)
+        cache.remove('c')
+        cache.save()
+        self.assertFalse(cache.changed)
+        cache = hashcache.HashCache(transport)
+        self.assertEqual('1' * 40, cache.get('a', Stat(7, 10.5)))
+        self.assertEqual('sha256:abcd', cache.get('dir/b', Stat(3, 20)))
+        self.assertEqual(None, cache.get('c', Stat(3, 20)))
+
+    def test_save_appends(self):
+        transport = self.get_transport()
+        cache = hashcache.HashCache(transport)
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        cache.add('b', Stat(3, 20), '2' * 40)
+        cache.save()
+        saved = transport.get_bytes(hashcache.HASH_CACHE)
+        cache = hashcache.HashCache(transport)
+        cache.add('a', Stat(8, 11.5), '3' * 40)
+        cache.remove('b')
+        # Unchanged entries are not written again.
+        cache.add('a', Stat(8, 11.5), '3' * 40)
+        cache.save()
+        fingerprint = hashcache.fingerprint(Stat(8, 11.5))
+        self.assertEqual(saved + 'a\x00%s\x00%s\x00b\x00\x00\x00' % (
+            '3' * 40, fingerprint), transport.get_bytes(hashcache.HASH_CACHE))
+        cache = hashcache.HashCache(transport)
+        self.assertEqual('3' * 40, cache.get('a', Stat(8, 11.5)))
+        self.assertEqual(None, cache.get('b', Stat(3, 20)))
+
+    def test_save_compacts(self):
+        transport = self.get_transport()
+        self.useFixture(MonkeyPatch('l_mirror.hashcache.HASH_CACHE_SLACK', 2))
+        cache = hashcache.HashCache(transport)
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        cache.save()
+        for size in range(8, 12):
+            cache.add('a', Stat(size, 10.5), '1' * 40)
+            cache.save()
+        cache = hashcache.HashCache(transport)
+        self.assertEqual('1' * 40, cache.get('a', Stat(11, 10.5)))
+        # Rewritten when 5 records outnumbered 2 * 1 + 2.
+        self.assertEqual(1, transport.get_bytes(
+            hashcache.HASH_CACHE).count('a\x00'))
+
+    def test_cut_short_cache_rewritten(self):
+        transport = self.get_transport()
+        cache = hashcache.HashCache(transport)
+        cache.add('a', Stat(7, 10.5), '1' * 40)
+        cache.save()
+        transport.append_bytes(hashcache.HASH_CACHE, 'b\x00' + '2' * 40)
+        cache = hashcache.HashCache(transport)
+        self.assertEqual('1' * 40, cache.get('a', Stat(7, 10.5)))
+        cache.add('c', Stat(3, 20), '3' * 40)
+        cache.save()
+        cache = hashcache.HashCache(transport)
+        self.assertEqual('1' * 40, cache.get('a', Stat(7, 10.5)))
+        self.assertEqual('3' * 40, cache.get('c', Stat(3, 20)))
+        self.assertFalse('2' * 40 in transport.get_bytes(hashcache.HASH_CACHE))
+
+    def test_damaged_cache_ignored(self):
+        transport = self.get_transport()
+        transport.put_bytes(hashcache.HASH_CACHE, 'rubbish')
+        cache = hashcache.HashCache(transport)
+        self.assertEqual(None, cache.get('a', Stat(7, 10.5)))
+
+
+class TestSmallFiles(ResourcedTestCase):
+
+    def get_transport(self):
+        transport = get_transport(self.setup_memory()).clone('path')
+        transport.create_prefix()
+        return transport
+
+    def test_wants(self):
+        small_files = hashcache.SmallFiles(self.get_transport(), 10)
+        self.assertTrue(small_files.wants(Stat(10, 0)))
+        self.assertFalse(small_files.wants(Stat(11, 0)))
+
+    def test_add_get(self):
+        transport = self.get_transport()
+        small_files = hashcache.SmallFiles(transport)
+        self.assertEqual(None, small_files.get('a'))
+        small_files.add('a', 'content a')
+        self.assertEqual('content a', small_files.get('a'))
+        small_files.save()
+        small_files.add('b', 'content b')
+        small_files.save()
+        small_files = hashcache.SmallFiles(transport)
+        self.assertEqual('content a', small_files.get('a'))
+        self.assertEqual('content b', small_files.get('b'))
+        self.assertEqual('content acontent b',
+            transport.get_bytes('smallfiles.0'))
+
+    def test_unindexed_pack_replaced(self):
+        transport = self.get_transport()
+        transport.put_bytes('smallfiles.0', 'stale')
+        small_files = hashcache.SmallFiles(transport)
+        small_files.add('a', 'content a')
+        small_files.save()
+        self.assertEqual('content a', transport.get_bytes('smallfiles.0'))
+        self.assertEqual('content a',
+            hashcache.SmallFiles(transport).get('a'))
+
+    def test_full_pack_replaced(self):
+        self.useFixture(MonkeyPatch('l_mirror.hashcache.PACK_LIMIT', 15))
+        transport = self.get_transport()
+        small_files = hashcache.SmallFiles(transport)
+        small_files.add('a', 'content a')
+        small_files.save()
+        reader = hashcache.SmallFiles(transport)
+        self.assertEqual('content a', reader.get('a'))
+        small_files.add('b', 'content b')
+        small_files.save()
+        self.assertFalse(transport.has('smallfiles.0'))
+        self.assertEqual('content b', transport.get_bytes('smallfiles.1'))
+        small_files = hashcache.SmallFiles(transport)
+        self.assertEqual(None, small_files.get('a'))
+        self.assertEqual('content b', small_files.get('b'))
+        # Readers of the old index find nothing rather than the wrong bytes.
+        self.assertEqual(None, reader.get('a'))
+
+    def test_pending_content_bounded(self):
+        self.useFixture(MonkeyPatch('l_mirror.hashcache.PENDING_LIMIT', 20))
+        transport = self.get_transport()
+        small_files = hashcache.SmallFiles(transport)
+        for name in 'abcdefghij':
+            small_files.add(name, 'content ' + name)
+            self.assertTrue(small_files._pending_size < 20)
+            self.assertEqual('content ' + name, small_files.get(name))
+        # Written to the pack, but not yet indexed.
+        self.assertEqual('content acontent bcontent c',
+            transport.get_bytes('smallfiles.0')[:27])
+        self.assertFalse(transport.has('smallfiles'))
+        small_files.save()
+        small_files = hashcache.SmallFiles(transport)
+        for name in 'abcdefghij':
+            self.assertEqual('content ' + name, small_files.get(name))
+
+    def test_fresh_pack_limited(self):
+        self.useFixture(MonkeyPatch('l_mirror.hashcache.PACK_LIMIT', 15))
+        self.useFixture(MonkeyPatch('l_mirror.hashcache.PENDING_LIMIT', 5))
+        transport = self.get_transport()
+        small_files = hashcache.SmallFiles(transport)
+        small_files.add('a', 'content a')
+        small_files.add('b', 'content b')
+        small_files.save()
+        self.assertFalse(transport.has('smallfiles.0'))
+        self.assertEqual('content b', transport.get_bytes('smallfiles.1'))
+        small_files = hashcache.SmallFiles(transport)
+        self.assertEqual(None, small_files.get('a'))
+        self.assertEqual('content b', small_files.get('b'))
@@ -20,16 +20,20 @@
 """Tests for the journals module."""
 
 from doctest import ELLIPSIS
+from hashlib import sha1 as sha, sha256
 from io import BytesIO
+import mmap
+import os
 from StringIO import StringIO
 import time
 
+from bzrlib import errors
 from bzrlib.transport import get_transport
 from bzrlib.transport.memory import MemoryServer
-from fixtures import MonkeyPatch
+from fixtures import MonkeyPatch, TempDir
 from testtools.matchers import DocTestMatches
 
-from l_mirror import journals
+from l_mirror import bandwidth, changes, delta, hashcache, journals
 from l_mirror.ui.model import UI, ProcessModel
 from l_mirror.tests import ResourcedTestCase
 
@@ -266,6 +270,179 @@ class TestCombiner(ResourcedTestCase):
         self.assertRaises(ValueError, combiner.as_tree)
 
 
+    def combine_moves(self, *changes):
+        # Combine one journal per change, returning the combined paths.
+        combiner = journals.Combiner()
+        for path, action, kind_data in changes:
+            journal = journals.Journal()
+            journal.add(path, action, kind_data)
+            combiner.add(journal)
+        return combiner.journal.paths
+
+    def test_move_chain_is_one_move(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        self.assertEqual({'c': ('move', ('a', file1))}, self.combine_moves(
+            ('b', 'move', ('a', file1)), ('c', 'move', ('b', file1))))
+
+    def test_move_back_cancels(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        self.assertEqual({}, self.combine_moves(
+            ('b', 'move', ('a', file1)), ('a', 'move', ('b', file1))))
+
+    def test_move_of_new_is_new(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        self.assertEqual({'b': ('new', file1)}, self.combine_moves(
+            ('a', 'new', file1), ('b', 'move', ('a', file1))))
+
+    def test_move_then_delete_is_delete(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        self.assertEqual({'a': ('del', file1)}, self.combine_moves(
+            ('b', 'move', ('a', file1)), ('b', 'del', file1)))
+
+    def test_move_then_replace(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        file2 = journals.FileContent('abcdef0123412312341234123412341234123412', 34, None)
+        self.assertEqual({'a': ('del', file1), 'b': ('new', file2)},
+            self.combine_moves(('b', 'move', ('a', file1)),
+                ('b', 'replace', (file1, file2))))
+
+    def test_move_onto_deleted_path(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        file2 = journals.FileContent('abcdef0123412312341234123412341234123412', 34, None)
+        self.assertEqual({'a': ('del', file1), 'b': ('replace', (file2, file1))},
+            self.combine_moves(('b', 'del', file2), ('b', 'move', ('a', file1))))
+
+    def test_move_source_reused(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        file2 = journals.FileContent('abcdef0123412312341234123412341234123412', 34, None)
+        self.assertEqual({'a': ('replace', (file1, file2)),
+            'b': ('new', file2)},
+            self.combine_moves(('b', 'move', ('a', file1)),
+                ('a', 'new', file2), ('b', 'replace', (file1, file2))))
+
+    def test_move_wrong_content_conflicts(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        file2 = journals.FileContent('abcdef0123412312341234123412341234123412', 34, None)
+        self.assertRaises(ValueError, self.combine_moves,
+            ('a', 'new', file1), ('b', 'move', ('a', file2)))
+
+    def test_move_deleted_conflicts(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, None)
+        self.assertRaises(ValueError, self.combine_moves,
+            ('a', 'del', file1), ('b', 'move', ('a', file1)))
+
+
+class TestStreamingCombiner(ResourcedTestCase):
+
+    def make_journals(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, 1.0)
+        file2 = journals.FileContent('abcdef0123412312341234123412341234123412', 34, 2.0)
+        j1 = journals.Journal()
+        j1.add('bar', 'new', journals.DirContent())
+        j1.add('bar/gam', 'new', file1)
+        j1.add('foo', 'new', file1)
+        j1.add('old', 'del', file2)
+        j2 = journals.Journal()
+        j2.add('bar/gam', 'replace', (file1, file2))
+        j2.add('foo', 'del', file1)
+        j2.add('quux', 'new', journals.SymlinkContent('foo bar/baz'))
+        j3 = journals.Journal()
+        j3.add('foo', 'new', file2)
+        j3.add('gone', 'del', journals.DirContent())
+        return [j1, j2, j3]
+
+    def test_matches_combiner(self):
+        combiner = journals.Combiner()
+        streaming = journals.StreamingCombiner()
+        for journal in self.make_journals():
+            combiner.add(journal)
+            streaming.add(journal.as_bytes())
+        self.assertEqual(combiner.journal.paths,
+            streaming.as_journal().paths)
+        self.assertEqual(sorted(combiner.journal.paths.items()),
+            list(streaming.iter_paths()))
+
+    def test_as_groups_matches_journal(self):
+        combiner = journals.Combiner()
+        streaming = journals.StreamingCombiner()
+        for journal in self.make_journals():
+            combiner.add(journal)
+            streaming.add(journal.as_bytes())
+        self.assertEqual(combiner.journal.as_groups(),
+            [list(group) for group in streaming.as_groups()])
+
+    def test_conflict_errors(self):
+        j1 = journals.Journal()
+        j1.add('abc', 'new', journals.DirContent())
+        streaming = journals.StreamingCombiner()
+        streaming.add(j1.as_bytes())
+        streaming.add(j1.as_bytes())
+        self.assertRaises(ValueError, list, streaming.iter_paths())
+
+    def test_unsorted_journal_errors(self):
+        streaming = journals.StreamingCombiner()
+        streaming.add('l-mirror-journal-2\nb\0new\0dir\0a\0new\0dir')
+        self.assertRaises(ValueError, list, streaming.iter_paths())
+
+    def test_moves_match_combiner(self):
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, 1.0)
+        j4 = journals.Journal()
+        j4.add('bar/moved', 'move', ('bar/gam', journals.FileContent(
+            'abcdef0123412312341234123412341234123412', 34, 2.0)))
+        j4.add('dir', 'move', ('old-dir', journals.DirContent()))
+        combiner = journals.Combiner()
+        streaming = journals.StreamingCombiner()
+        for journal in self.make_journals() + [j4]:
+            combiner.add(journal)
+            streaming.add(journal.as_bytes())
+        self.assertEqual(sorted(combiner.journal.paths.items()),
+            list(streaming.iter_paths()))
+        self.assertEqual(combiner.journal.as_groups(),
+            [list(group) for group in streaming.as_groups()])
+        self.assertEqual([('move', 'dir', ('old-dir', journals.DirContent()))],
+            list(streaming.as_groups()[0]))
+
+    def test_moves_combine_only_moved_paths(self):
+        # Only the paths moves affect are held in a Combiner: the rest are
+        # merged path by path.
+        file1 = journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, 1.0)
+        j1 = journals.Journal()
+        for index in range(100):
+            j1.add('file%03d' % index, 'new', file1)
+        j2 = journals.Journal()
+        j2.add('moved', 'move', ('file050', file1))
+        j2.add('other', 'new', file1)
+        combined = []
+        combine_paths = journals._combine_paths
+        def logging_combine_paths(paths, path, new_content):
+            combined.append(path)
+            return combine_paths(paths, path, new_content)
+        self.useFixture(MonkeyPatch('l_mirror.journals._combine_paths',
+            logging_combine_paths))
+        streaming = journals.StreamingCombiner()
+        streaming.add(j1.as_bytes())
+        streaming.add(j2.as_bytes())
+        paths = dict(streaming.iter_paths())
+        self.assertEqual(['file050', 'moved'], sorted(set(combined)))
+        self.assertEqual(('new', file1), paths['moved'])
+        self.assertFalse('file050' in paths)
+        self.assertEqual(101, len(paths))
+
+    def test_path_named_move_merged(self):
+        # A path called move in a journal with other hashes is not a move.
+        file1 = journals.FileContent('sha256:' + 'a' * 64, 11, 1.0)
+        j1 = journals.Journal()
+        j1.add('move', 'new', file1)
+        combined = []
+        self.useFixture(MonkeyPatch('l_mirror.journals._combine_paths',
+            lambda paths, path, new_content: combined.append(path)))
+        streaming = journals.StreamingCombiner()
+        streaming.add(j1.as_bytes())
+        self.assertEqual([('move', ('new', file1))],
+            list(streaming.iter_paths()))
+        self.assertEqual([], combined)
+
+
 class TestJournal(ResourcedTestCase):
 
     def test_add_new_ok(self):
@@ -328,6 +505,42 @@ class TestJournal(ResourcedTestCase):
         self.assertEqual("""l-mirror-journal-2
 1234\0replace\0symlink\0foo bar/baz\0file\0e935b6eefc78846802e12039d6dd9a7e27622301\0000\x001.500000\x00abc\0new\0file\00012039d6dd9a7e27622301e935b6eefc78846802e\00011\x000.000000\x00abc/def\0del\0dir""", j1.as_bytes())
 
+    def test_move_round_trips(self):
+        # Journals with moves have a new header.
+        j1 = journals.Journal()
+        j1.add('abc', 'new', journals.DirContent())
+        j1.add('abc/def', 'move', ('def',
+            journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 11, 0.0)))
+        self.assertEqual("""l-mirror-journal-3
+abc\0new\0dir\0abc/def\0move\0def\0file\00012039d6dd9a7e27622301e935b6eefc78846802e\00011\x000.000000""", j1.as_bytes())
+        self.assertEqual(j1.paths, journals.parse(j1.as_bytes()).paths)
+
+    def test_hashes_round_trip(self):
+        # Journals with digests from other hashes have a new header.
+        digest = 'sha256:' + sha256('content').hexdigest()
+        j1 = journals.Journal()
+        j1.add('abc', 'new', journals.FileContent(digest, 7, 0.0))
+        self.assertEqual('l-mirror-journal-4\nabc\0new\0file\0%s\x007\x00'
+            '0.000000' % digest, j1.as_bytes())
+        self.assertEqual(j1.paths, journals.parse(j1.as_bytes()).paths)
+        self.assertEqual('sha256', j1.paths['abc'][1].hash_name)
+
+    def test_move_needs_source(self):
+        j1 = journals.Journal()
+        self.assertRaises(ValueError, j1.add, 'abc', 'move',
+            journals.DirContent())
+
+    def test_as_groups_moves_first(self):
+        j1 = journals.Journal()
+        j1.add('b', 'new', journals.DirContent())
+        j1.add('c/d', 'move', ('a/d', journals.DirContent()))
+        j1.add('c', 'move', ('a', journals.DirContent()))
+        self.assertEqual([
+            [('move', 'c', ('a', journals.DirContent())),
+             ('move', 'c/d', ('a/d', journals.DirContent()))],
+            [('new', 'b', journals.DirContent())], [], []],
+            j1.as_groups())
+
 
 class TestTransportReplay(ResourcedTestCase):
 
@@ -381,6 +594,136 @@ class TestTransportReplay(ResourcedTestCase):
             ],
             basedir._activity)
 
+    def test_throttle_limits_content_reads(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('new', '12341234')
+        j1 = journals.Journal()
+        j1.add('new', 'new', journals.FileContent('c129b324aee662b04eccf68babba85851346dff9', 8, None))
+        allowed = []
+        class Throttle(object):
+            def reader(self, a_file):
+                return bandwidth.ThrottledFile(a_file, self)
+            def writer(self, a_file):
+                return a_file
+            def allow(self, count):
+                allowed.append(count)
+                return 3
+            def refund(self, count):
+                pass
+        ui = UI()
+        generator = journals.ReplayGenerator(j1, sourcedir, ui)
+        replay = journals.TransportReplay(j1, generator, basedir, ui,
+            throttle=Throttle())
+        replay.replay()
+        self.assertEqual('12341234', basedir.get_bytes('new'))
+        # Reads were done in throttled pieces.
+        self.assertTrue(len(allowed) > 3)
+
+    def test_content_index_copies_local_content(self):
+        # A rename is a del and a new of the same content: with a content
+        # index the new file is made from the local copy.
+        basedir = get_transport('trace+' + self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.put_bytes('old', '12341234')
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        content = journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)
+        j1 = journals.Journal()
+        j1.add('new', 'new', content)
+        j1.add('old', 'del', content)
+        index = journals.ContentIndex({'old': content})
+        del basedir._activity[:]
+        ui = UI()
+        generator = journals.ReplayGenerator(j1, sourcedir, ui)
+        self.useFixture(MonkeyPatch(
+            'l_mirror.journals.TransportAction.get_file',
+            lambda self: self.fail('content read for %r' % self.path)))
+        replay = journals.TransportReplay(j1, generator, basedir, ui,
+            content_index=index)
+        replay.replay()
+        self.assertEqual('12341234', basedir.get_bytes('new'))
+        self.assertFalse(basedir.has('old'))
+        self.assertTrue('new' in index.find(content))
+
+    def test_content_index_from_tree(self):
+        content = journals.FileContent('abc', 3, None)
+        index = journals.ContentIndex({'a': content, 'dir': {
+            'b': journals.FileContent('abc', 3, None),
+            'c': journals.FileContent('abc', 4, None),
+            'link': journals.SymlinkContent('a')}})
+        self.assertEqual(['a', 'dir/b'], sorted(index.find(content)))
+        self.assertEqual(['dir/c'], index.find(
+            journals.FileContent('abc', 4, None)))
+        self.assertEqual([], index.find(journals.FileContent('def', 3, None)))
+
+    def test_content_index_hardlinks_local_files(self):
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', '12341234')
+        sourcedir = basedir.clone('source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('b', '12341234')
+        content = journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)
+        j1 = journals.Journal()
+        j1.add('b', 'new', content)
+        ui = UI()
+        generator = journals.ReplayGenerator(j1, sourcedir, ui)
+        replay = journals.TransportReplay(j1, generator, basedir, ui,
+            content_index=journals.ContentIndex({'a': content}))
+        replay.replay()
+        self.assertEqual(os.stat(basedir.local_abspath('a')).st_ino,
+            os.stat(basedir.local_abspath('b')).st_ino)
+
+    def test_moves_are_local_renames(self):
+        basedir = get_transport('trace+' + self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.mkdir('dir')
+        basedir.put_bytes('dir/a', '12341234')
+        basedir.put_bytes('b', 'bb')
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        content = journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)
+        b_content = journals.FileContent(
+            '9a900f538965a426994e1e90600920aff0b4e8d2', 2, None)
+        j1 = journals.Journal()
+        j1.add('new', 'move', ('dir', journals.DirContent()))
+        j1.add('new/a', 'move', ('dir/a', content))
+        # Moving a path onto a path which is itself being moved away works.
+        j1.add('dir2', 'move', ('b', b_content))
+        self.useFixture(MonkeyPatch(
+            'l_mirror.journals.TransportAction.get_file',
+            lambda self: self.fail('content read for %r' % self.path)))
+        ui = UI()
+        generator = journals.ReplayGenerator(j1, sourcedir, ui)
+        replay = journals.TransportReplay(j1, generator, basedir, ui)
+        replay.replay()
+        self.assertEqual('12341234', basedir.get_bytes('new/a'))
+        self.assertEqual('bb', basedir.get_bytes('dir2'))
+        self.assertFalse(basedir.has('dir'))
+        self.assertFalse(basedir.has('b'))
+
+    def test_move_of_changed_source_fetches_content(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.put_bytes('a', 'local edit')
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('b', '12341234')
+        j1 = journals.Journal()
+        j1.add('b', 'move', ('a', journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)))
+        ui = UI()
+        generator = journals.ReplayGenerator(j1, sourcedir, ui)
+        replay = journals.TransportReplay(j1, generator, basedir, ui)
+        replay.replay()
+        self.assertEqual('12341234', basedir.get_bytes('b'))
+        self.assertFalse(basedir.has('a'))
+
     def test_excess_files_on_delete_directory(self):
         # bzrlib.trace doesn't trace delete_tree
         def delete_tree(self, relpath):
@@ -473,6 +816,185 @@ class TestFromFileGenerator(ResourcedTestCase):
             item.ignore_file()
 
 
+    def get_encoded_journal(self):
+        sourcedir = get_transport(self.setup_memory()).clone('source')
+        sourcedir.create_prefix()
+        text = 'Package: lmirror\n' * 200
+        sourcedir.put_bytes('Packages', text)
+        sourcedir.put_bytes('lmirror.deb', text)
+        sourcedir.put_bytes('small', 'abc')
+        j1 = journals.Journal()
+        j1.add('Packages', 'new', journals.FileContent(
+            sha(text).hexdigest(), len(text), None))
+        j1.add('lmirror.deb', 'new', journals.FileContent(
+            sha(text).hexdigest(), len(text), None))
+        j1.add('small', 'new', journals.FileContent(
+            sha('abc').hexdigest(), 3, None))
+        j1.add('subdir', 'new', journals.DirContent())
+        return j1, sourcedir, text
+
+    def test_encoded_stream(self):
+        j1, sourcedir, text = self.get_encoded_journal()
+        ui = UI()
+        stream = journals.ReplayGenerator(j1, sourcedir, ui)
+        content = ''.join(stream.as_bytes('zlib'))
+        self.assertTrue(content.startswith(journals.ENCODED_STREAM_MARKER))
+        self.assertTrue(len(content) < 2 * len(text))
+        replay = journals.FromFileGenerator(BytesIO(content), ui)
+        received = {}
+        encodings = {}
+        for item in replay.stream():
+            encodings[item.path] = item.encoding
+            if item.content.kind == 'file':
+                # Read in small pieces to cross frame boundaries.
+                a_file = item.get_file()
+                pieces = []
+                piece = a_file.read(100)
+                while piece:
+                    pieces.append(piece)
+                    piece = a_file.read(100)
+                received[item.path] = ''.join(pieces)
+        self.assertEqual({'Packages': 'zlib', 'lmirror.deb': 'identity',
+            'small': 'identity', 'subdir': None}, encodings)
+        self.assertEqual({'Packages': text, 'lmirror.deb': text,
+            'small': 'abc'}, received)
+
+    def test_encoded_stream_ignorable(self):
+        j1, sourcedir, text = self.get_encoded_journal()
+        ui = UI()
+        stream = journals.ReplayGenerator(j1, sourcedir, ui)
+        content = ''.join(stream.as_bytes('zlib'))
+        replay = journals.FromFileGenerator(BytesIO(content), ui)
+        paths = []
+        for item in replay.stream():
+            paths.append(item.path)
+            item.ignore_file()
+        self.assertEqual(['Packages', 'lmirror.deb', 'small', 'subdir'],
+            sorted(paths))
+
+    def test_encoded_stream_replay(self):
+        j1, sourcedir, text = self.get_encoded_journal()
+        basedir = sourcedir.clone('../target')
+        basedir.create_prefix()
+        ui = UI()
+        stream = journals.ReplayGenerator(j1, sourcedir, ui)
+        content = ''.join(stream.as_bytes('zlib'))
+        generator = journals.FromFileGenerator(BytesIO(content), ui)
+        journals.TransportReplay(j1, generator, basedir, ui).replay()
+        self.assertEqual(text, basedir.get_bytes('Packages'))
+        self.assertEqual(text, basedir.get_bytes('lmirror.deb'))
+        self.assertEqual('abc', basedir.get_bytes('small'))
+
+    def test_delta_stream_replay(self):
+        old = ''.join('Package: p%d\nVersion: 1.0\n\n' % index
+            for index in range(10000))
+        new = old.replace('Package: p5000\nVersion: 1.0',
+            'Package: p5000\nVersion: 2.0')
+        sourcedir = get_transport(self.setup_memory()).clone('source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('Packages', new)
+        basedir = sourcedir.clone('../target')
+        basedir.create_prefix()
+        basedir.put_bytes('Packages', old)
+        j1 = journals.Journal()
+        j1.add('Packages', 'replace', (
+            journals.FileContent(sha(old).hexdigest(), len(old), None),
+            journals.FileContent(sha(new).hexdigest(), len(new), None)))
+        ui = UI()
+        stream = journals.ReplayGenerator(j1, sourcedir, ui)
+        content = ''.join(stream.as_bytes(delta=True))
+        self.assertTrue(len(content) < len(new) // 10)
+        fetched = []
+        readv = sourcedir.readv
+        def logging_readv(relpath, offsets, *args, **kwargs):
+            fetched.extend(offsets)
+            return readv(relpath, offsets, *args, **kwargs)
+        sourcedir.readv = logging_readv
+        generator = journals.FromFileGenerator(BytesIO(content), ui,
+            delta_source=delta.DeltaSource(basedir, sourcedir))
+        journals.TransportReplay(j1, generator, basedir, ui).replay()
+        self.assertEqual(new, basedir.get_bytes('Packages'))
+        self.assertEqual(1, len(fetched))
+
+    def test_move_stream_replay(self):
+        # Moves carry no content in either plain or encoded streams.
+        basedir = get_transport(self.setup_memory()).clone('target')
+        basedir.create_prefix()
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        j1 = journals.Journal()
+        j1.add('b', 'move', ('a', journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)))
+        ui = UI()
+        for encoding in (None, 'zlib'):
+            basedir.put_bytes('a', '12341234')
+            stream = journals.ReplayGenerator(j1, sourcedir, ui)
+            content = ''.join(stream.as_bytes(encoding))
+            self.assertFalse('12341234' in content)
+            generator = journals.FromFileGenerator(BytesIO(content), ui)
+            journals.TransportReplay(j1, generator, basedir, ui).replay()
+            self.assertEqual('12341234', basedir.get_bytes('b'))
+            self.assertFalse(basedir.has('a'))
+            basedir.delete('b')
+
+    def test_move_stream_replay_changed_source(self):
+        # Content for moves whose source has changed locally is fetched from
+        # the content source, as the stream does not carry it.
+        basedir = get_transport(self.setup_memory()).clone('target')
+        basedir.create_prefix()
+        sourcedir = basedir.clone('../source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('b', '12341234')
+        j1 = journals.Journal()
+        j1.add('b', 'move', ('a', journals.FileContent(
+            'c129b324aee662b04eccf68babba85851346dff9', 8, None)))
+        ui = UI()
+        for encoding in (None, 'zlib'):
+            basedir.put_bytes('a', 'local edit')
+            stream = journals.ReplayGenerator(j1, sourcedir, ui)
+            content = ''.join(stream.as_bytes(encoding))
+            generator = journals.FromFileGenerator(BytesIO(content), ui)
+            replay = journals.TransportReplay(j1, generator, basedir, ui)
+            self.assertRaises(ValueError, replay.replay)
+            generator = journals.FromFileGenerator(BytesIO(content), ui,
+                content_source=delta.DeltaSource(None, sourcedir))
+            journals.TransportReplay(j1, generator, basedir, ui).replay()
+            self.assertEqual('12341234', basedir.get_bytes('b'))
+            self.assertFalse(basedir.has('a'))
+            basedir.delete('b')
+
+    def test_delta_only_for_large_replaced_files(self):
+        j1, sourcedir, text = self.get_encoded_journal()
+        sourcedir.put_bytes('big', 'x\n' * 50000)
+        sourcedir.put_bytes('big.gz', 'x\n' * 50000)
+        old = journals.FileContent('a', 10, None)
+        j1.add('big', 'replace', (old, journals.FileContent(
+            sha('x\n' * 50000).hexdigest(), 100000, None)))
+        j1.add('big.gz', 'replace', (old, journals.FileContent(
+            sha('x\n' * 50000).hexdigest(), 100000, None)))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI())
+        content = ''.join(stream.as_bytes(delta=True))
+        replay = journals.FromFileGenerator(BytesIO(content), UI(),
+            delta_source=delta.DeltaSource(None, None))
+        encodings = {}
+        for item in replay.stream():
+            encodings[item.path] = item.encoding
+            item.ignore_file()
+        self.assertEqual({'Packages': 'identity', 'lmirror.deb': 'identity',
+            'small': 'identity', 'subdir': None, 'big': 'delta',
+            'big.gz': 'identity'}, encodings)
+
+    def test_truncated_compressed_content(self):
+        j1, sourcedir, text = self.get_encoded_journal()
+        ui = UI()
+        stream = journals.ReplayGenerator(j1, sourcedir, ui)
+        content = ''.join(stream.as_bytes('zlib'))
+        replay = journals.FromFileGenerator(BytesIO(content[:100]), ui)
+        item = iter(replay.stream()).next()
+        self.assertEqual('Packages', item.path)
+        self.assertRaises(ValueError, item.get_file().read)
+
+
 class TestReplayGenerator(ResourcedTestCase):
 
     def test_orders_new_replace_delete(self):
@@ -521,6 +1043,93 @@ class TestReplayGenerator(ResourcedTestCase):
         for item in stream.stream():
             item.ignore_file()
 
+    def test_uncompressed(self):
+        sourcedir = get_transport(self.setup_memory()).clone('source')
+        sourcedir.create_prefix()
+        text = 'x' * 1000
+        sourcedir.put_bytes('Packages', text)
+        j1 = journals.Journal()
+        j1.add('Packages', 'new', journals.FileContent(
+            sha(text).hexdigest(), len(text), None))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI(),
+            uncompressed=['^Pack'])
+        self.assertEqual(journals.ENCODED_STREAM_MARKER +
+            'Packages\x00new\x00file\x00%s\x001000\x00None\x00identity\x00%s'
+            % (sha(text).hexdigest(), text),
+            ''.join(stream.as_bytes('zlib')))
+
+    def test_small_files(self):
+        sourcedir = get_transport(self.setup_memory()).clone('source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('new', 'changed on disk')
+        small_files = hashcache.SmallFiles(sourcedir.clone('../meta'))
+        small_files.add(sha('12341234').hexdigest(), '12341234')
+        j1 = journals.Journal()
+        j1.add('new', 'new',
+            journals.FileContent(sha('12341234').hexdigest(), 8, None))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI(),
+            small_files=small_files)
+        self.assertEqual('new\x00new\x00file\x00%s\x008\x00None\x0012341234'
+            % sha('12341234').hexdigest(), ''.join(stream.as_bytes()))
+        self.assertEqual('new\x00new\x00file\x00%s\x008\x00None\x0012341234'
+            % sha('12341234').hexdigest(), ''.join(stream.as_segments()))
+
+    def test_unknown_encoding(self):
+        stream = journals.ReplayGenerator(journals.Journal(), None, UI())
+        self.assertRaises(ValueError, list, stream.as_bytes('bogus'))
+
+    def test_as_segments_zlib(self):
+        sourcedir = get_transport(self.useFixture(TempDir()).path)
+        text = 'y' * 1000
+        sourcedir.put_bytes('Packages', text)
+        sourcedir.put_bytes('lmirror.deb', text)
+        j1 = journals.Journal()
+        j1.add('Packages', 'new', journals.FileContent(
+            sha(text).hexdigest(), len(text), None))
+        j1.add('lmirror.deb', 'new', journals.FileContent(
+            sha(text).hexdigest(), len(text), None))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI())
+        segments = list(stream.as_segments('zlib'))
+        # The compressed file is read, the uncompressed one is not.
+        self.assertEqual(1, len([segment for segment in segments
+            if isinstance(segment, journals.FileSegment)]))
+        for segment in segments:
+            if isinstance(segment, journals.FileSegment):
+                segment.file.close()
+
+    def test_as_segments_memory(self):
+        # Content which is not in a real file is returned as bytes.
+        sourcedir = get_transport(self.setup_memory()).clone('source')
+        sourcedir.create_prefix()
+        sourcedir.put_bytes('new', '12341234')
+        j1 = journals.Journal()
+        j1.add('new', 'new',
+            journals.FileContent('c129b324aee662b04eccf68babba85851346dff9', 8, None))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI())
+        self.assertEqual(list(stream.as_bytes()), list(stream.as_segments()))
+
+    def test_as_segments_local(self):
+        sourcedir = get_transport(self.useFixture(TempDir()).path)
+        sourcedir.put_bytes('abc', '123412341234')
+        sourcedir.put_bytes('new', '12341234')
+        j1 = journals.Journal()
+        j1.add('abc', 'replace', (
+            journals.FileContent('12039d6dd9a7e27622301e935b6eefc78846802e', 3, None),
+            journals.FileContent('5a78babbb162531b3a16c55310a4e7228d68f2e9', 12, None)))
+        j1.add('bye', 'del', journals.FileContent('d', 2, None))
+        j1.add('new', 'new',
+            journals.FileContent('c129b324aee662b04eccf68babba85851346dff9', 8, None))
+        stream = journals.ReplayGenerator(j1, sourcedir, UI())
+        content = []
+        segments = 0
+        for segment in stream.as_segments():
+            if isinstance(segment, journals.FileSegment):
+                segments += 1
+                segment = ''.join(segment.iter_bytes())
+            content.append(segment)
+        self.assertEqual(2, segments)
+        self.assertEqual(''.join(stream.as_bytes()), ''.join(content))
+
 
 class TestParser(ResourcedTestCase):
 
@@ -554,7 +1163,105 @@ class TestParser(ResourcedTestCase):
 
     def test_parse_wrong_header(self):
         self.assertRaises(ValueError, journals.parse, 'l-mirror-journal-1')
-        self.assertRaises(ValueError, journals.parse, 'l-mirror-journal-3\n')
+        self.assertRaises(ValueError, journals.parse, 'l-mirror-journal-5\n')
+
+    def test_map_journal(self):
+        journal = journals.Journal()
+        journal.add('abc', 'new', journals.FileContent('1' * 40, 11, 2.0))
+        journal.add('abc/def', 'del', journals.DirContent())
+        journal_bytes = journal.as_bytes()
+        journaldir = get_transport(self.useFixture(TempDir()).path)
+        journaldir.put_bytes('1', journal_bytes)
+        # Small journals are read.
+        self.assertEqual(journal_bytes, journals.map_journal(journaldir, '1'))
+        self.useFixture(MonkeyPatch('l_mirror.journals.MAP_THRESHOLD', 10))
+        mapped = journals.map_journal(journaldir, '1')
+        self.assertIsInstance(mapped, mmap.mmap)
+        self.assertEqual(journal.paths, journals.parse(mapped).paths)
+        self.assertEqual(list(journals.iter_parse(journal_bytes)),
+            list(journals.iter_parse(mapped)))
+        journals.unmap_journal(mapped)
+        self.assertRaises(ValueError, mapped.find, '\x00')
+        journals.unmap_journal(journal_bytes)
+        # Empty files cannot be mapped, but are still read.
+        journaldir.put_bytes('2', '')
+        self.assertEqual('', journals.map_journal(journaldir, '2'))
+        self.assertRaises(errors.NoSuchFile, journals.map_journal,
+            journaldir, '3')
+        # Transports without local files are read.
+        memory = get_transport(self.setup_memory())
+        memory.put_bytes('1', journal_bytes)
+        self.assertEqual(journal_bytes, journals.map_journal(memory, '1'))
+
+    def test_streaming_combiner_mapped(self):
+        j1 = journals.Journal()
+        j1.add('a', 'new', journals.FileContent('1' * 40, 1, 0.0))
+        j2 = journals.Journal()
+        j2.add('b', 'move', ('a', journals.FileContent('1' * 40, 1, 0.0)))
+        journaldir = get_transport(self.useFixture(TempDir()).path)
+        journaldir.put_bytes('1', j1.as_bytes())
+        journaldir.put_bytes('2', j2.as_bytes())
+        self.useFixture(MonkeyPatch('l_mirror.journals.MAP_THRESHOLD', 10))
+        unmapped = []
+        unmap_journal = journals.unmap_journal
+        def logging_unmap(content):
+            if isinstance(content, mmap.mmap):
+                unmapped.append(content)
+            unmap_journal(content)
+        self.useFixture(MonkeyPatch('l_mirror.journals.unmap_journal',
+            logging_unmap))
+        mapped = journals.StreamingCombiner()
+        plain = journals.StreamingCombiner()
+        for name in ('1', '2'):
+            mapped.add_file(journaldir, name)
+            plain.add(journaldir.get_bytes(name))
+        self.assertEqual(list(plain.iter_paths()), list(mapped.iter_paths()))
+        self.assertEqual(2, len(unmapped))
+        self.assertEqual(['b'], [path for path, _ in mapped.iter_paths()])
+        # Mappings are released even when iteration stops early.
+        paths = mapped.iter_paths()
+        paths.next()
+        paths.close()
+        self.assertEqual(6, len(unmapped))
+        for content in unmapped:
+            self.assertRaises(ValueError, content.find, '\x00')
+
+    def test_parse_unknown_hash(self):
+        self.assertRaises(ValueError, journals.parse,
+            'l-mirror-journal-4\nabc\0new\0file\0md4:abcd\x007\x000.0')
+
+    def test_parse_truncated(self):
+        self.assertRaises(ValueError, journals.parse,
+            'l-mirror-journal-2\nabc\0new\0file\00012039d6dd9a7e27622301e935b6eefc78846802e')
+
+    def test_iter_parse(self):
+        self.assertEqual([
+            ('abc', 'new', journals.DirContent()),
+            ('abc/def', 'del', journals.SymlinkContent('foo')),
+            ], list(journals.iter_parse(
+            'l-mirror-journal-2\nabc\0new\0dir\0abc/def\0del\0symlink\0foo\0')))
+
+
+class TestHashes(ResourcedTestCase):
+
+    def test_hash_name(self):
+        self.assertEqual('sha1', journals.hash_name('1' * 40))
+        self.assertEqual('sha256', journals.hash_name('sha256:abcd'))
+        self.assertRaises(ValueError, journals.hash_name, 'md4:abcd')
+
+    def test_hash_file(self):
+        self.assertEqual((7, sha('content').hexdigest()),
+            journals.hash_file(StringIO('content')))
+        self.assertEqual((7, 'sha256:' + sha256('content').hexdigest()),
+            journals.hash_file(StringIO('content'), 'sha256'))
+        self.assertRaises(ValueError, journals.hash_file, StringIO(''), 'md4')
+
+    def test_blake2b(self):
+        if 'blake2b' not in journals.HASHES:
+            self.skip('blake2b not available')
+        size, digest = journals.hash_file(StringIO('content'), 'blake2b')
+        self.assertEqual('blake2b', journals.hash_name(digest))
+        self.assertEqual(len('blake2b:') + 32, len(digest))
 
 
 class TestDiskUpdater(ResourcedTestCase):
@@ -645,6 +1352,237 @@ class TestDiskUpdater(ResourcedTestCase):
         self.assertEqual(set(['dir2', 'dir1', 'abc', 'dir1/def']), set(paths))
 
 
+    def test_detects_moved_files(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.mkdir('dir')
+        basedir.put_bytes('dir/b', 'content')
+        basedir.put_bytes('empty', '')
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        tree = {'a': content,
+            'old': journals.FileContent('da39a3ee5e6b4b0d3255bfef95601890afd80709', 0, None)}
+        updater = journals.DiskUpdater(tree, basedir, 'name', 0, ui,
+            detect_moves=True)
+        journal = updater.finished()
+        action, (source, new_content) = journal.paths['dir/b']
+        self.assertEqual(('move', 'a'), (action, source))
+        self.assertEqual(content.sha1, new_content.sha1)
+        self.assertFalse('a' in journal.paths)
+        # Empty files are not worth matching.
+        self.assertEqual('del', journal.paths['old'][0])
+        self.assertEqual('new', journal.paths['empty'][0])
+
+    def test_detects_moved_directories(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.mkdir('new')
+        basedir.mkdir('new/sub')
+        basedir.put_bytes('new/a', 'content')
+        basedir.put_bytes('new/sub/a', 'content')
+        basedir.put_bytes('copy', 'content')
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        tree = {'old': {'a': content, 'sub': {'a': content}}}
+        updater = journals.DiskUpdater(tree, basedir, 'name', 0, ui,
+            detect_moves=True)
+        journal = updater.finished()
+        self.assertEqual({
+            'copy': 'new',
+            'new': ('move', 'old'),
+            'new/a': ('move', 'old/a'),
+            'new/sub': ('move', 'old/sub'),
+            'new/sub/a': ('move', 'old/sub/a'),
+            }, dict((path, action == 'move' and (action, kind_data[0]) or
+                action) for path, (action, kind_data) in
+                journal.paths.iteritems()))
+
+    def test_detect_moves_disabled(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.put_bytes('b', 'content')
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        updater = journals.DiskUpdater({'a': content}, basedir, 'name', 0, ui,
+            detect_moves=False)
+        journal = updater.finished()
+        self.assertEqual(['del', 'new'],
+            [journal.paths[path][0] for path in ('a', 'b')])
+
+    def test_known_changes_with_rescan(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', 'content')
+        basedir.mkdir('sub')
+        basedir.put_bytes('sub/b', 'content')
+        basedir.put_bytes('c', 'content')
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        tree = {'a': content, 'sub': {'old': content}}
+        root = basedir.local_abspath('.')
+        updater = journals.DiskUpdater(tree, basedir, 'name', 0, ui,
+            known_changes=[], rescan=[root + '/sub'], detect_moves=False)
+        journal = updater.finished()
+        # Only the subtree to rescan is looked at on disk: c is not noticed.
+        self.assertEqual({'sub/b': 'new', 'sub/old': 'del'},
+            dict((path, action) for path, (action, _) in
+                journal.paths.iteritems()))
+
+    def test_known_changes_grouped(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', 'content')
+        basedir.mkdir('sub')
+        basedir.put_bytes('sub/b', 'content')
+        basedir.put_bytes('c', 'content')
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        tree = {'sub': {'old': content}}
+        known = changes.Changes()
+        known.add('a')
+        known.scan.add('sub')
+        updater = journals.DiskUpdater(tree, basedir, 'name', 0, ui,
+            known_changes=known, detect_moves=False)
+        journal = updater.finished()
+        self.assertEqual({'a': 'new', 'sub/b': 'new', 'sub/old': 'del'},
+            dict((path, action) for path, (action, _) in
+                journal.paths.iteritems()))
+
+    def test_manifest(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', 'content')
+        basedir.put_bytes('unlisted', 'content')
+        basedir.mkdir('sub')
+        basedir.put_bytes('sub/c', 'content')
+        basedir.put_bytes('old', 'changed')
+        root = basedir.local_abspath('.')
+        # Listed paths are examined however old they are.
+        os.utime(root + '/old', (0, 0))
+        content = journals.FileContent(
+            '040f06fd774092478d450774f5ba30c5da78acc8', 7, None)
+        tree = {'old': content, 'gone': content}
+        manifest = journals.parse_manifest('a\x00\x00gone\x00del\x00'
+            'sub/c\x00%s\x00b\x00%s:12\x00old\x00\x00' % (
+            '1' * 40, '2' * 40))
+        updater = journals.DiskUpdater(tree, basedir, 'name', time.time(),
+            ui, manifest=manifest, detect_moves=False)
+        journal = updater.finished()
+        self.assertEqual(set(['a', 'b', 'gone', 'old', 'sub', 'sub/c']),
+            set(journal.paths))
+        self.assertEqual(('new', content.sha1),
+            (journal.paths['a'][0], journal.paths['a'][1].sha1))
+        # b is not on disk at all: its content comes from the manifest.
+        self.assertEqual(('new', journals.FileContent('2' * 40, 12, None)),
+            journal.paths['b'])
+        # The sha1 of sub/c comes from the manifest, its length from disk.
+        self.assertEqual(('1' * 40, 7), (journal.paths['sub/c'][1].sha1,
+            journal.paths['sub/c'][1].length))
+        self.assertEqual(('del', content), journal.paths['gone'])
+        self.assertEqual('replace', journal.paths['old'][0])
+
+    def test_manifest_other_hash(self):
+        # Digests made with another hash than the set's are not recorded.
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', 'content')
+        basedir.put_bytes('b', 'content')
+        manifest = journals.parse_manifest('a\x00%s:7\x00b\x00sha256:%s\x00'
+            % ('1' * 40, '2' * 64))
+        updater = journals.DiskUpdater({}, basedir, 'name', time.time(), ui,
+            manifest=manifest, hash_name='sha256')
+        journal = updater.finished()
+        self.assertEqual('sha256:' + sha256('content').hexdigest(),
+            journal.paths['a'][1].sha1)
+        self.assertEqual('sha256:' + '2' * 64, journal.paths['b'][1].sha1)
+        updater = journals.DiskUpdater({}, basedir, 'name', time.time(), ui,
+            manifest=manifest)
+        journal = updater.finished()
+        self.assertEqual('1' * 40, journal.paths['a'][1].sha1)
+        self.assertEqual(sha('content').hexdigest(),
+            journal.paths['b'][1].sha1)
+        self.assertFalse(':' in journal.as_bytes().split('\n', 1)[1])
+
+    def test_parse_manifest(self):
+        self.assertEqual({'a': None, 'b/c': 'del',
+            'd': journals.FileContent('1' * 40, None, None),
+            'e': journals.FileContent('2' * 40, 5, None)},
+            journals.parse_manifest('a\x00\x00b/c\x00del\x00d\x00%s\x00'
+                'e\x00%s:5\x00' % ('1' * 40, '2' * 40)))
+        self.assertEqual({}, journals.parse_manifest(''))
+
+    def test_parse_manifest_hashes(self):
+        self.assertEqual({
+            'a': journals.FileContent('sha256:abcd', None, None),
+            'b': journals.FileContent('sha256:abcd', 5, None)},
+            journals.parse_manifest('a\x00sha256:abcd\x00'
+                'b\x00sha256:abcd:5\x00'))
+
+    def test_hash_name(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory())
+        basedir.put_bytes('a', 'content')
+        updater = journals.DiskUpdater({}, basedir, 'name', 0, ui,
+            hash_name='sha256')
+        journal = updater.finished()
+        self.assertEqual('sha256:' + sha256('content').hexdigest(),
+            journal.paths['a'][1].sha1)
+        self.assertRaises(ValueError, journals.DiskUpdater, {}, basedir,
+            'name', 0, ui, hash_name='md4')
+
+    def test_hash_cache(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.put_bytes('a', 'content')
+        basedir.put_bytes('b', 'content b')
+        hash_cache = hashcache.HashCache(basedir.clone('../meta'))
+        hash_cache.add('a', basedir.stat('a'), '1' * 40)
+        # Digests made with another hash are not used.
+        hash_cache.add('b', basedir.stat('b'), 'sha256:abcd')
+        updater = journals.DiskUpdater({}, basedir, 'name', 0, ui,
+            hash_cache=hash_cache)
+        journal = updater.finished()
+        self.assertEqual('1' * 40, journal.paths['a'][1].sha1)
+        self.assertEqual(sha('content b').hexdigest(),
+            journal.paths['b'][1].sha1)
+        self.assertEqual(sha('content b').hexdigest(),
+            hash_cache.get('b', basedir.stat('b')))
+        basedir.delete('a')
+        tree = journals.Combiner()
+        tree.add(journal)
+        updater = journals.DiskUpdater(tree.as_tree(), basedir, 'name', 0, ui,
+            hash_cache=hash_cache)
+        updater.finished()
+        self.assertEqual({'b'}, set(hash_cache._get_entries()))
+
+    def test_small_files(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        basedir.put_bytes('a', 'content')
+        basedir.put_bytes('b', 'larger content')
+        small_files = hashcache.SmallFiles(basedir.clone('../meta'), 10)
+        updater = journals.DiskUpdater({}, basedir, 'name', 0, ui,
+            small_files=small_files, hash_name='sha256')
+        journal = updater.finished()
+        self.assertEqual(journals.FileContent(
+            'sha256:' + sha256('content').hexdigest(), 7, 0),
+            journal.paths['a'][1])
+        self.assertEqual('content',
+            small_files.get(journal.paths['a'][1].sha1))
+        self.assertEqual(None, small_files.get(journal.paths['b'][1].sha1))
+
+    def test_parse_manifest_errors(self):
+        for manifest in ['a\x00', 'a\x00\x00b', '/a\x00\x00',
+            'a/../b\x00\x00', 'a//b\x00\x00', 'a\x00\x00a\x00del\x00',
+            'a\x00xyz\x00', 'a\x00%s:x\x00' % ('1' * 40)]:
+            self.assertRaises(ValueError, journals.parse_manifest, manifest)
+
+
 class TestFilterCombiner(ResourcedTestCase):
 
     def test_include_short_circuits(self):
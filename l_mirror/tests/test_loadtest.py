@@ -0,0 +1,69 @@
+#
+# LMirror is Copyright (C) 2010 Robert Collins <robertc@robertcollins.net>
+# 
+# LMirror is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# In the LMirror source tree the file COPYING.txt contains the GNU General Public
+# License version 3.
+# 
+
+"""Tests for the load test harness."""
+
+from StringIO import StringIO
+
+from bzrlib.transport import get_transport
+
+from l_mirror import mirrorset, server
+from l_mirror.tests import loadtest
+from l_mirror.ui.model import UI
+from l_mirror.tests import ResourcedTestCase
+from l_mirror.tests.logging_resource import LoggingResourceManager
+
+
+class TestLoadTest(ResourcedTestCase):
+
+    resources = [('logging', LoggingResourceManager())]
+
+    def test_many_slow_streams(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = UI()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('abc', '1234567890\n' * 1000)
+        mirror.finish_change()
+        expected = len(''.join(mirror.get_generator(1, 1).as_bytes()))
+        serve = server.Server(ui, engine='event')
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            url = serve.addresses[0] + 'stream/myname/1/1'
+            results = loadtest.run(url, 50, rate=100000, timeout=30)
+        finally:
+            serve.stop()
+        self.assertEqual([(None, expected)] * 50,
+            [(result.error, result.length) for result in results])
+        self.assertEqual(['HTTP/1.0 200 OK'],
+            list(set(result.status for result in results)))
+
+    def test_main(self):
+        serve = server.Server(UI(), engine='event')
+        serve.start(port=0)
+        output = StringIO()
+        try:
+            self.assertEqual(0, loadtest.main(['--clients', '3',
+                serve.addresses[0] + 'missing'], output))
+        finally:
+            serve.stop()
+        self.assertEqual(['clients: 3 ok, 0 failed',
+            '  HTTP/1.0 404 Not Found: 3'],
+            output.getvalue().splitlines()[:2])
@@ -20,13 +20,15 @@
 """Tests for the mirrorset module."""
 
 from doctest import ELLIPSIS
+from hashlib import sha1 as sha
+import time
 
 from bzrlib import gpg as bzrgpg
 from bzrlib.transport import get_transport
-
+from fixtures import MonkeyPatch, TempDir
 from testtools.matchers import DocTestMatches
 
-from l_mirror import gpg, mirrorset
+from l_mirror import changes, gpg, journals, mirrorset
 from l_mirror.ui.model import UI
 from l_mirror.tests import ResourcedTestCase
 
@@ -174,6 +176,46 @@ exclude another regex
         mirror.set_server(None)
         self.assertEqual(None, mirror.get_server())
 
+    def test_get_latest(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        metadata = mirror._get_metadata()
+        expected = (1, metadata.get('metadata', 'timestamp'))
+        self.assertEqual(expected, mirror.get_latest())
+        self.assertEqual(expected, mirror.get_latest(after=0))
+        # Waiting for a later journal gives up after the timeout.
+        self.assertEqual(expected, mirror.get_latest(after=1, timeout=0))
+
+    def test_combine_journals_reuses_combination(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        self.assertFalse('a' in mirror._combine_journals(0, 1))
+        mirror.start_change()
+        basedir.put_bytes('a', 'content')
+        mirror.finish_change()
+        parsed = []
+        parse = journals.parse
+        def logging_parse(journal_bytes):
+            parsed.append(journal_bytes)
+            return parse(journal_bytes)
+        self.useFixture(MonkeyPatch('l_mirror.journals.parse', logging_parse))
+        self.assertTrue('a' in mirror._combine_journals(0, 2))
+        self.assertEqual(1, len(parsed))
+        # A different start combines from scratch.
+        self.assertEqual(['a'], mirror._combine_journals(2, 2).keys())
+        self.assertEqual(2, len(parsed))
+        # Without keep the combination is neither used nor kept.
+        combined = mirror._combined
+        self.assertTrue('a' in mirror._combine_journals(0, 2, keep=False))
+        self.assertEqual(5, len(parsed))
+        self.assertEqual(combined, mirror._combined)
+
     def test_finish_change_not_updating_error(self):
         basedir = get_transport(self.setup_memory()).clone('path')
         basedir.create_prefix()
@@ -236,6 +278,111 @@ updating = False
         self.assertThat(t.get_bytes('journals/1'), DocTestMatches("""l-mirror-journal-2
 .lmirror\x00new\x00dir\x00.lmirror/sets\x00new\x00dir\x00.lmirror/sets/myname\x00new\x00dir\x00.lmirror/sets/myname/format\x00new\x00file\x00e5fa44f2b31c1fb553b6021e7360d07d5d91ff5e\x002\x000.000000\x00.lmirror/sets/myname/set.conf\x00new\x00file\x00061df21cf828bb333660621c3743cfc3a3b2bd23\x0023\x000.000000\x00abc\x00new\x00file\x0012039d6dd9a7e27622301e935b6eefc78846802e\x0011\x000.000000\x00dir1\x00new\x00dir\x00dir1/def\x00new\x00file\x001f8ac10f23c5b5bc1167bda84b833e5c057a77d2\x006\x000.000000\x00dir2\x00new\x00dir"""))
     
+    def test_finish_change_reads_change_log(self):
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        log = changes.ChangeLog(
+            mirror._metadatadir().local_abspath(changes.CHANGE_LOG))
+        log.open()
+        self.addCleanup(log.close)
+        log.walked(time.time())
+        mirror.start_change()
+        basedir.put_bytes('abc', 'content')
+        basedir.put_bytes('unlogged', 'content')
+        log.note('abc', time.time())
+        mirror.finish_change()
+        # Only the logged change is looked at.
+        journal = journals.parse(mirror._journaldir().get_bytes('2'))
+        self.assertEqual(['abc'], journal.paths.keys())
+
+    def test_render_streams(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('abc', '1234567890\n')
+        mirror.finish_change()
+        mirror.start_change()
+        basedir.put_bytes('def', 'abcdef')
+        mirror.finish_change()
+        mirror.render_streams(5)
+        streams = basedir.clone('.lmirror/metadata/myname/streams')
+        self.assertEqual(['1-2', '1-2.zlib', '2-2', '2-2.zlib'],
+            sorted(streams.list_dir('.')))
+        self.assertEqual(''.join(mirror.get_generator(1, 2).as_bytes()),
+            streams.get_bytes('1-2'))
+        self.assertEqual(''.join(mirror.get_generator(2, 2).as_bytes()),
+            streams.get_bytes('2-2'))
+        self.assertEqual(''.join(mirror.get_generator(1, 2).as_bytes('zlib')),
+            streams.get_bytes('1-2.zlib'))
+        # Streams no longer wanted are removed.
+        mirror.start_change()
+        basedir.put_bytes('ghi', 'abcdef')
+        mirror.finish_change(prerender=1)
+        self.assertEqual(['3-3', '3-3.zlib'], sorted(streams.list_dir('.')))
+
+    def test_uncompressed_from_content_conf(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('.lmirror/sets/myname/content.conf',
+            'uncompressed ^pool/\n')
+        mirror = mirrorset.MirrorSet(basedir, 'myname', ui)
+        self.assertEqual(['^pool/'], mirror.get_uncompressed())
+        self.assertNotEqual(None,
+            mirror.get_generator(0, 0).uncompressed_re.search('pool/a'))
+
+    def test_checksums_from_content_conf(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('.lmirror/sets/myname/content.conf',
+            'checksums sidecar sums\n')
+        basedir.put_bytes('abc', 'content')
+        # A deliberately wrong sha1, to show the file is not read.
+        basedir.put_bytes('sums', '%s 7 0.0 abc\n' % ('1' * 40))
+        mirror = mirrorset.MirrorSet(basedir, 'myname', ui)
+        self.assertEqual([('sidecar', 'sums')], mirror.get_checksum_sources())
+        mirror.finish_change()
+        journal = journals.parse(mirror._journaldir().get_bytes('1'))
+        self.assertEqual('1' * 40, journal.paths['abc'][1].sha1)
+
+    def test_caches_from_content_conf(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('.lmirror/sets/myname/content.conf',
+            'cache hashes\ncache small-files 10\n')
+        basedir.put_bytes('abc', 'content')
+        mirror = mirrorset.MirrorSet(basedir, 'myname', ui)
+        self.assertEqual([('hashes', ''), ('small-files', '10')],
+            mirror.get_caches())
+        mirror.finish_change()
+        sha1 = sha('content').hexdigest()
+        self.assertEqual(sha1,
+            mirror.get_hash_cache().get('abc', basedir.stat('abc')))
+        self.assertEqual(10, mirror.get_small_files().max_size)
+        # New content is streamed from the small file pack.
+        basedir.put_bytes('abc', 'changed')
+        self.assertTrue(''.join(mirror.get_generator(1, 1).as_bytes()
+            ).endswith('abc\x00new\x00file\x00%s\x007\x000.000000\x00content'
+            % sha1))
+
+    def test_unknown_cache(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('.lmirror/sets/myname/content.conf',
+            'cache everything\n')
+        mirror = mirrorset.MirrorSet(basedir, 'myname', ui)
+        self.assertRaises(ValueError, mirror.get_caches)
+
     def test_include_excludes_honoured(self):
         basedir = get_transport(self.setup_memory()).clone('path')
         basedir.create_prefix()
@@ -314,6 +461,71 @@ updating = False
         self.assertEqual(mirrorjournal.get_bytes('1'), clonejournal.get_bytes('1'))
         self.assertEqual(mirrorjournal.get_bytes('2'), clonejournal.get_bytes('2'))
 
+    def test_receive_sha256(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui,
+            hash_name='sha256')
+        self.assertEqual('sha256', mirror.get_hash_name())
+        basedir.put_bytes('abc', 'content')
+        mirror.finish_change()
+        self.assertEqual('l-mirror-journal-4\n',
+            mirror._journaldir().get_bytes('1')[:19])
+        clonedir = basedir.clone('../clone')
+        clonedir.create_prefix()
+        clone = mirrorset.initialise(clonedir, 'myname', clonedir, ui)
+        clone.cancel_change()
+        clone.receive(mirror)
+        self.assertEqual('content', clonedir.get_bytes('abc'))
+        # The hash setting is mirrored with the set.
+        self.assertEqual('sha256', clone.get_hash_name())
+
+    def test_initialise_unknown_hash(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        self.assertRaises(ValueError, mirrorset.initialise, basedir,
+            'myname', basedir, self.get_test_ui(), hash_name='md4')
+
+    def test_receive_moves(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui,
+            detect_moves=True)
+        self.assertEqual(True, mirror.get_detect_moves())
+        basedir.mkdir('dir1')
+        basedir.put_bytes('dir1/def', 'abcdef')
+        mirror.finish_change()
+        clonedir = basedir.clone('../clone')
+        clonedir.create_prefix()
+        clone = mirrorset.initialise(clonedir, 'myname', clonedir, ui)
+        clone.cancel_change()
+        clone.receive(mirror)
+        mirror.start_change()
+        basedir.rename('dir1', 'dir2')
+        mirror.finish_change()
+        self.assertEqual('l-mirror-journal-3\n',
+            mirror._journaldir().get_bytes('2')[:19])
+        clone.receive(mirror)
+        self.assertEqual('abcdef', clonedir.get_bytes('dir2/def'))
+        self.assertFalse(clonedir.has('dir1'))
+
+    def test_moves_not_detected_by_default(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        self.assertEqual(False, mirror.get_detect_moves())
+        basedir.mkdir('dir1')
+        basedir.put_bytes('dir1/def', 'abcdef')
+        mirror.finish_change()
+        mirror.start_change()
+        basedir.rename('dir1', 'dir2')
+        mirror.finish_change()
+        self.assertEqual('l-mirror-journal-2\n',
+            mirror._journaldir().get_bytes('2')[:19])
+
     def test_checks_when_there_is_a_keyring(self):
         basedir = get_transport(self.setup_memory()).clone('path')
         basedir.create_prefix()
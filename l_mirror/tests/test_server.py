@@ -20,12 +20,23 @@
 """Tests for the lmirror server."""
 
 from doctest import ELLIPSIS
+from hashlib import sha1 as sha, sha256
+import httplib
+import json
+import os
+import threading
+import time
+import urllib2
+import urlparse
 
 from bzrlib.transport import get_transport
 
+from fixtures import MonkeyPatch, TempDir
+from paste import httpexceptions
 from testtools.matchers import DocTestMatches
 
-from l_mirror import gpg, mirrorset, server
+from l_mirror import (bandwidth, changes, delta, eventserver, gpg, journals,
+    mirrorset, server)
 from l_mirror.ui.model import UI
 from l_mirror.tests import ResourcedTestCase
 from l_mirror.tests.logging_resource import LoggingResourceManager
@@ -59,3 +70,837 @@ class TestServer(ResourcedTestCase):
             self.assertIsInstance(opened_mirror, mirrorset.HTTPMirrorSet)
         finally:
             serve.stop()
+
+    def test_open_on_event_server(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = self.get_test_ui()
+        serve = server.Server(ui, engine='event')
+        serve.start(port=0)
+        try:
+            source_mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+            serve.add(source_mirror)
+            server_transport = get_transport(serve.addresses[0])
+            opened_mirror = mirrorset.MirrorSet(server_transport, 'myname', ui)
+            self.assertIsInstance(opened_mirror, mirrorset.HTTPMirrorSet)
+        finally:
+            serve.stop()
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, server.Server, self.get_test_ui(),
+            engine='bogus')
+
+    def get_rendered_mirror(self, ui):
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('abc', '1234567890\n' * 10000)
+        mirror.finish_change(prerender=1)
+        return mirror
+
+    def get_stream(self, serve, headers={}, suffix=''):
+        request = urllib2.Request(
+            serve.addresses[0] + 'stream/myname/1/1' + suffix, headers=headers)
+        return urllib2.urlopen(request).read()
+
+    def test_prerendered_stream(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        expected = ''.join(mirror.get_generator(1, 1).as_bytes())
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            # The stream is not generated.
+            mirror.get_generator = None
+            self.assertEqual(expected, self.get_stream(serve))
+            self.assertEqual(expected[100:200],
+                self.get_stream(serve, {'Range': 'bytes=100-199'}))
+        finally:
+            serve.stop()
+
+    def test_prerendered_stream_without_sendfile(self):
+        self.useFixture(MonkeyPatch('l_mirror.server.sendfile', None))
+        self.test_prerendered_stream()
+
+    def test_dynamic_stream_from_local_files(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('abc', '1234567890\n' * 10000)
+        mirror.finish_change()
+        expected = ''.join(mirror.get_generator(1, 1).as_bytes())
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            self.assertEqual(expected, self.get_stream(serve))
+        finally:
+            serve.stop()
+
+    def test_encoded_streams(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        expected = ''.join(mirror.get_generator(1, 1).as_bytes('zlib'))
+        streams = mirror._metadatadir().clone('streams')
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            plain = ''.join(mirror.get_generator(1, 1).as_bytes())
+            # The pre-rendered encoded stream is preferred, then a
+            # pre-rendered plain stream, then a dynamic encoded stream.
+            self.assertEqual(expected, self.get_stream(serve, suffix='/zlib'))
+            streams.delete('1-1.zlib')
+            self.assertEqual(plain, self.get_stream(serve, suffix='/zlib'))
+            streams.delete('1-1')
+            self.assertEqual(expected, self.get_stream(serve, suffix='/zlib'))
+            # Unknown encodings get a plain stream.
+            self.assertEqual(plain, self.get_stream(serve, suffix='/bogus'))
+            # And receivers ask for and handle encoded streams.
+            target_dir = get_transport(self.useFixture(TempDir()).path)
+            target = mirrorset.initialise(target_dir, 'myname', target_dir, ui)
+            target.cancel_change()
+            source = mirrorset.MirrorSet(get_transport(serve.addresses[0]),
+                'myname', ui)
+            target.receive(source)
+            self.assertEqual('1234567890\n' * 10000,
+                target_dir.get_bytes('abc'))
+        finally:
+            serve.stop()
+
+    def test_content_ranges(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            request = urllib2.Request(serve.addresses[0] + 'content/myname/abc',
+                headers={'Range': 'bytes=11-21'})
+            response = urllib2.urlopen(request)
+            self.assertEqual(206, response.code)
+            self.assertEqual('1234567890\n', response.read())
+        finally:
+            serve.stop()
+
+    def test_blobs(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        content = '1234567890\n' * 10000
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            url = serve.addresses[0] + 'blob/'
+            response = urllib2.urlopen(url + sha(content).hexdigest())
+            self.assertEqual(content, response.read())
+            self.assertEqual('public, max-age=%d, immutable' %
+                server.BLOB_MAX_AGE, response.info()['Cache-Control'])
+            request = urllib2.Request(url + sha(content).hexdigest(),
+                headers={'Range': 'bytes=11-21'})
+            self.assertEqual('1234567890\n', urllib2.urlopen(request).read())
+            for missing in (sha('other').hexdigest(), 'abc', '../myname'):
+                error = self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                    url + missing)
+                self.assertEqual(404, error.code)
+        finally:
+            serve.stop()
+
+    def test_blobs_sha256(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui,
+            hash_name='sha256')
+        content = '1234567890\n' * 10000
+        basedir.put_bytes('abc', content)
+        mirror.finish_change()
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            url = serve.addresses[0] + 'blob/'
+            digest = sha256(content).hexdigest()
+            response = urllib2.urlopen(url + 'sha256:' + digest)
+            self.assertEqual(content, response.read())
+            self.assertEqual('"sha256:%s"' % digest, response.info()['ETag'])
+            # Only the full digest finds the content.
+            for missing in (digest, sha(content).hexdigest()):
+                error = self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                    url + missing)
+                self.assertEqual(404, error.code)
+        finally:
+            serve.stop()
+
+    def test_blobs_check_content(self):
+        # Content changed since the last journal is not served as a blob.
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        content = '1234567890\n' * 10000
+        serve = server.Server(ui)
+        serve.add(mirror)
+        mirror._contentdir().put_bytes('abc', '0987654321\n' * 10000)
+        self.assertEqual(None,
+            serve.blob_index.get([mirror], sha(content).hexdigest()))
+        mirror._contentdir().put_bytes('abc', content)
+        found = serve.blob_index.get([mirror], sha(content).hexdigest())
+        self.assertEqual(content, found[1].read())
+
+    def test_blobs_hash_cache(self):
+        # Content whose digest the hash cache has is not hashed again.
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        content = '1234567890\n' * 10000
+        contentdir = mirror._contentdir()
+        os.utime(contentdir.local_abspath('abc'), (1000, 1000))
+        mirror._setdir().put_bytes('content.conf', 'cache hashes\n')
+        mirror = mirrorset.MirrorSet(mirror.base, 'myname', ui)
+        hash_cache = mirror.get_hash_cache()
+        hash_cache.add('abc', contentdir.stat('abc'), sha(content).hexdigest())
+        hash_cache.save()
+        serve = server.Server(ui)
+        serve.add(mirror)
+        def hash_file(a_file, name='sha1'):
+            self.fail('%r was hashed' % a_file)
+        self.useFixture(MonkeyPatch('l_mirror.journals.hash_file', hash_file))
+        found = serve.blob_index.get([mirror], sha(content).hexdigest())
+        self.assertEqual(content, found[1].read())
+
+    def test_receive_move_of_changed_source(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.put_bytes('a', 'content')
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui,
+            detect_moves=True)
+        mirror.finish_change()
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            target_dir = get_transport(self.useFixture(TempDir()).path)
+            target = mirrorset.initialise(target_dir, 'myname', target_dir, ui)
+            target.cancel_change()
+            source = mirrorset.MirrorSet(get_transport(serve.addresses[0]),
+                'myname', ui)
+            target.receive(source)
+            target_dir.put_bytes('a', 'local edit')
+            mirror.start_change()
+            basedir.rename('a', 'b')
+            mirror.finish_change()
+            target.receive(source)
+            self.assertEqual('content', target_dir.get_bytes('b'))
+            self.assertFalse(target_dir.has('a'))
+        finally:
+            serve.stop()
+
+    def test_delta_receive(self):
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        old = ''.join('Package: p%d\nVersion: 1.0\n\n' % index
+            for index in range(10000))
+        new = old.replace('Package: p5000\nVersion: 1.0',
+            'Package: p5000\nVersion: 2.0')
+        basedir.put_bytes('Packages', old)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change(prerender=1)
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            target_dir = get_transport(self.useFixture(TempDir()).path)
+            target = mirrorset.initialise(target_dir, 'myname', target_dir, ui)
+            target.cancel_change()
+            source = mirrorset.MirrorSet(get_transport(serve.addresses[0]),
+                'myname', ui)
+            target.receive(source, delta=True)
+            self.assertEqual(old, target_dir.get_bytes('Packages'))
+            mirror.start_change()
+            basedir.put_bytes('Packages', new)
+            mirror.finish_change(prerender=1)
+            fetches = []
+            fetch = delta.DeltaFile._fetch
+            def logging_fetch(self, offset, length):
+                fetches.append(length)
+                return fetch(self, offset, length)
+            self.useFixture(MonkeyPatch('l_mirror.delta.DeltaFile._fetch',
+                logging_fetch))
+            blobs = []
+            get_blob = serve.blob_index.get
+            def logging_get_blob(mirrorsets, sha1):
+                blobs.append(sha1)
+                return get_blob(mirrorsets, sha1)
+            serve.blob_index.get = logging_get_blob
+            target.receive(source, delta=True)
+            self.assertEqual(new, target_dir.get_bytes('Packages'))
+            # Only the changed part of Packages was fetched, by sha1.
+            self.assertEqual(1, len(fetches))
+            self.assertTrue(fetches[0] < len(new) // 10)
+            self.assertEqual([sha(new).hexdigest()], blobs)
+        finally:
+            serve.stop()
+
+    def test_shaped_streams(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        expected = ''.join(mirror.get_generator(1, 1).as_bytes())
+        for engine in server.ENGINES:
+            serve = server.Server(ui, engine=engine)
+            serve.shaper = bandwidth.Shaper(client_rate=10 * 1024 * 1024)
+            serve.start(port=0)
+            try:
+                serve.add(mirror)
+                self.assertEqual(expected, self.get_stream(serve))
+            finally:
+                serve.stop()
+            self.assertEqual({}, serve.shaper._clients)
+
+    def test_prerendered_stream_without_segments(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        expected = ''.join(mirror.get_generator(1, 1).as_bytes())
+        serve = server.Server(ui)
+        serve.add(mirror)
+        app = server._RootApp(serve)
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+        environ = {'wsgi.version': (1, 0), 'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/stream/myname/1/1', 'HTTP_RANGE': 'bytes=10-'}
+        self.assertEqual(expected[10:], ''.join(app(environ, start_response)))
+        self.assertEqual('206 Partial Content', responses[0][0])
+        self.assertEqual(str(len(expected) - 10),
+            responses[0][1]['Content-Length'])
+
+    def get_response(self, serve, path, **environ):
+        app = server._RootApp(serve)
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+        environ.update({'wsgi.version': (1, 0), 'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path})
+        app_iter = app(environ, start_response)
+        try:
+            body = ''.join(chunk for chunk in app_iter
+                if chunk is not eventserver.NOT_READY)
+        finally:
+            if getattr(app_iter, 'close', None) is not None:
+                app_iter.close()
+        return responses[0][0], responses[0][1], body
+
+    def test_conditional_metadata(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.add(mirror)
+        for path, etag in [
+            ('/metadata/myname/metadata.conf', '"%s"' % sha(
+                mirror._metadatadir().get_bytes('metadata.conf')).hexdigest()),
+            ('/metadata/myname/journals/1', '"journal-1"'),
+            ('/.lmirror/sets/myname/format', '"lmirror-smart-server-1"'),
+            ]:
+            status, headers, body = self.get_response(serve, path)
+            self.assertEqual(('200 OK', etag), (status, headers['ETag']))
+            status, headers, body = self.get_response(serve, path,
+                HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(('304 Not Modified', ''), (status, body))
+            status, headers, body = self.get_response(serve, path,
+                HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual('200 OK', status)
+
+    def test_conditional_content(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        content = '1234567890\n' * 10000
+        serve = server.Server(ui)
+        serve.add(mirror)
+        # Unchanged content is tagged with its sha1.
+        etag = '"%s"' % sha(content).hexdigest()
+        for path in ('/content/myname/abc', '/blob/' + etag[1:-1]):
+            status, headers, body = self.get_response(serve, path)
+            self.assertEqual(('200 OK', etag, content),
+                (status, headers['ETag'], body))
+            status, headers, body = self.get_response(serve, path,
+                HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(('304 Not Modified', ''), (status, body))
+            self.assertFalse('Content-Length' in headers)
+        # Content changed since the last journal is tagged by size and mtime.
+        mirror._contentdir().put_bytes('abc', 'changed')
+        status, headers, body = self.get_response(serve,
+            '/content/myname/abc', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual('200 OK', status)
+        self.assertThat(headers['ETag'], DocTestMatches('"7-..."', ELLIPSIS))
+        status, headers, body = self.get_response(serve,
+            '/content/myname/abc', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual('304 Not Modified', status)
+
+    def test_latest(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        timestamp = mirror._get_metadata().get('metadata', 'timestamp')
+        serve = server.Server(ui)
+        serve.add(mirror)
+        for path in ('/latest/myname', '/latest/myname/0'):
+            status, headers, body = self.get_response(serve, path)
+            self.assertEqual(('200 OK', 'application/json'),
+                (status, headers['Content-Type']))
+            self.assertEqual({'latest': 1, 'timestamp': timestamp},
+                json.loads(body))
+        self.assertRaises(httpexceptions.HTTPNotFound, self.get_response,
+            serve, '/latest/myname/bogus')
+
+    def test_latest_times_out(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.add(mirror)
+        self.useFixture(MonkeyPatch('l_mirror.server.LONG_POLL_TIMEOUT', 0.1))
+        for cooperative in (False, True):
+            status, headers, body = self.get_response(serve,
+                '/latest/myname/1', **{'lmirror.cooperative': cooperative})
+            self.assertEqual(1, json.loads(body)['latest'])
+
+    def test_waiting_threads_limited(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.add(mirror)
+        self.useFixture(MonkeyPatch('l_mirror.server.LONG_POLL_TIMEOUT', 0))
+        self.useFixture(MonkeyPatch('l_mirror.server.EVENT_STREAM_DURATION',
+            {False: 0, True: 0}))
+        # Waiting requests are answered while threads are free for them, and
+        # give their thread back when done.
+        for _ in range(server.PASTE_WAITERS + 1):
+            for path in ('/latest/myname/1', '/events/myname'):
+                self.get_response(serve, path)
+        for _ in range(server.PASTE_WAITERS):
+            serve.waiters.acquire()
+        for path in ('/latest/myname/1', '/events/myname'):
+            self.assertRaises(httpexceptions.HTTPNotFound, self.get_response,
+                serve, path)
+            # The event engine does not use threads to wait.
+            self.get_response(serve, path, **{'lmirror.cooperative': True})
+        # Requests that do not wait are still answered.
+        status, headers, body = self.get_response(serve, '/latest/myname')
+        self.assertEqual(1, json.loads(body)['latest'])
+
+    def test_latest_long_poll_busy_server(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            source = mirrorset.MirrorSet(
+                get_transport(serve.addresses[0]), 'myname', ui)
+            for _ in range(server.PASTE_WAITERS):
+                serve.waiters.acquire()
+            # The client polls the set's metadata instead.
+            self.assertEqual(mirror.get_latest(),
+                source.get_latest(after=1, timeout=0))
+        finally:
+            serve.stop()
+
+    def test_latest_long_poll(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        for engine in server.ENGINES:
+            serve = server.Server(ui, engine=engine)
+            serve.start(port=0)
+            try:
+                serve.add(mirror)
+                source = mirrorset.MirrorSet(
+                    get_transport(serve.addresses[0]), 'myname', ui)
+                latest = mirror.get_latest()[0]
+                self.assertEqual(latest, source.get_latest()[0])
+                results = []
+                waiter = threading.Thread(target=lambda:
+                    results.append(source.get_latest(after=latest)))
+                waiter.start()
+                mirror.start_change()
+                mirror._contentdir().put_bytes('new', 'content')
+                mirror.finish_change()
+                # As finish_change does when the set has a server configured.
+                urllib2.urlopen(serve.addresses[0] + 'updated/myname').read()
+                waiter.join(10)
+                self.assertEqual([mirror.get_latest()], results)
+                self.assertEqual(latest + 1, results[0][0])
+            finally:
+                serve.stop()
+
+    def read_event(self, response):
+        lines = []
+        while True:
+            # urllib2 buffers responses 8K at a time, so read lines directly.
+            line = response.fp.readline()
+            if line in ('\n', ''):
+                break
+            if not line.startswith(':'):
+                lines.append(line)
+        return lines
+
+    def test_events(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        for engine in server.ENGINES:
+            serve = server.Server(ui, engine=engine)
+            serve.event_jitter = 0
+            serve.start(port=0)
+            try:
+                serve.add(mirror)
+                connection = httplib.HTTPConnection(
+                    urlparse.urlsplit(serve.addresses[0]).netloc)
+                connection.request('GET', '/events/myname')
+                response = connection.getresponse()
+                self.assertEqual('text/event-stream',
+                    response.getheader('Content-Type'))
+                latest, timestamp = mirror.get_latest()
+                self.assertEqual(['retry: 0\n', 'event: latest\n',
+                    'data: %s\n' % json.dumps(
+                        {'latest': latest, 'timestamp': timestamp})],
+                    self.read_event(response))
+                mirror.start_change()
+                mirror._contentdir().put_bytes('new', 'content')
+                mirror.finish_change()
+                urllib2.urlopen(serve.addresses[0] + 'updated/myname').read()
+                latest, timestamp = mirror.get_latest()
+                self.assertEqual(['event: latest\n',
+                    'data: %s\n' % json.dumps(
+                        {'latest': latest, 'timestamp': timestamp})],
+                    self.read_event(response))
+                connection.close()
+            finally:
+                serve.stop()
+
+    def test_events_end(self):
+        ui = self.get_test_ui()
+        mirror = self.get_rendered_mirror(ui)
+        serve = server.Server(ui)
+        serve.add(mirror)
+        self.useFixture(MonkeyPatch('l_mirror.server.EVENT_STREAM_DURATION',
+            {False: 0.1, True: 0.1}))
+        for cooperative in (False, True):
+            status, headers, body = self.get_response(serve,
+                '/events/myname', **{'lmirror.cooperative': cooperative})
+            self.assertEqual(1, body.count('event: latest\n'))
+
+
+    def test_finish_change_while_walking(self):
+        if server.pyinotify is None:
+            self.skip('pyinotify not available')
+        ui = self.get_test_ui()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        serve = server.Server(ui)
+        serve.set_watcher = server.SetWatcher()
+        serve.start(port=0)
+        try:
+            serve.add(mirror)
+            serve.set_watcher.add(mirror)
+            mirror.set_server(serve.addresses[0])
+            # Not walked yet: the whole tree needs scanning.
+            scan = json.loads(urllib2.urlopen(
+                serve.addresses[0] + 'changes/myname/scan').read())
+            self.assertEqual([basedir.local_abspath('.')], scan['scan'])
+            grouped = changes.parse(urllib2.urlopen(
+                serve.addresses[0] + 'changes/myname/grouped').read())
+            self.assertEqual(set(['']), grouped.scan)
+            mirror.start_change()
+            basedir.put_bytes('abc', 'content')
+            mirror.finish_change()
+            journal = journals.parse(mirror._journaldir().get_bytes('2'))
+            self.assertEqual('new', journal.paths['abc'][0])
+        finally:
+            mirror.set_server(None)
+            serve.stop()
+
+class TestJournalCache(ResourcedTestCase):
+
+    def get_mirror(self):
+        basedir = get_transport(self.setup_memory()).clone('path')
+        basedir.create_prefix()
+        ui = UI()
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        basedir.put_bytes('abc', '1234567890\n')
+        mirror.finish_change()
+        calls = []
+        get_combined = mirror.get_combined
+        def logging_get_combined(from_journal, to_journal):
+            calls.append((from_journal, to_journal))
+            return get_combined(from_journal, to_journal)
+        mirror.get_combined = logging_get_combined
+        return mirror, calls
+
+    def test_cached_stream_matches_uncached(self):
+        mirror, calls = self.get_mirror()
+        cache = server.JournalCache(1024 * 1024)
+        expected = ''.join(mirror.get_generator(0, 1).as_bytes())
+        self.assertEqual(expected,
+            ''.join(cache.get_generator(mirror, 0, 1).as_bytes()))
+        self.assertEqual(expected,
+            ''.join(cache.get_generator(mirror, 0, 1).as_bytes()))
+
+    def send(self, cache, mirror, from_journal, to_journal):
+        return ''.join(cache.get_generator(
+            mirror, from_journal, to_journal).as_bytes())
+
+    def test_hit_does_not_combine(self):
+        mirror, calls = self.get_mirror()
+        cache = server.JournalCache(1024 * 1024)
+        self.send(cache, mirror, 0, 1)
+        self.send(cache, mirror, 0, 1)
+        self.send(cache, mirror, 1, 1)
+        self.assertEqual([(0, 1), (1, 1)], calls)
+
+    def test_cached_once_sent(self):
+        mirror, calls = self.get_mirror()
+        cache = server.JournalCache(1024 * 1024)
+        # A stream that was never sent is not cached.
+        cache.get_generator(mirror, 0, 1)
+        self.send(cache, mirror, 0, 1)
+        self.send(cache, mirror, 0, 1)
+        self.assertEqual([(0, 1), (0, 1)], calls)
+
+    def test_invalidate(self):
+        mirror, calls = self.get_mirror()
+        cache = server.JournalCache(1024 * 1024)
+        self.send(cache, mirror, 0, 1)
+        cache.invalidate('othername')
+        self.send(cache, mirror, 0, 1)
+        cache.invalidate('myname')
+        self.send(cache, mirror, 0, 1)
+        self.assertEqual([(0, 1), (0, 1)], calls)
+
+    def test_oversized_not_cached(self):
+        mirror, calls = self.get_mirror()
+        cache = server.JournalCache(10)
+        expected = ''.join(mirror.get_generator(0, 1).as_bytes())
+        del calls[:]
+        self.assertEqual(expected, self.send(cache, mirror, 0, 1))
+        self.assertEqual(expected, self.send(cache, mirror, 0, 1))
+        self.assertEqual([(0, 1), (0, 1)], calls)
+
+    def test_least_recently_used_discarded(self):
+        mirror, calls = self.get_mirror()
+        # Room for one range only.
+        cache = server.JournalCache(server.JournalCache.ACTION_OVERHEAD * 10)
+        self.send(cache, mirror, 0, 1)
+        self.send(cache, mirror, 1, 1)
+        self.send(cache, mirror, 0, 1)
+        self.assertEqual([(0, 1), (1, 1), (0, 1)], calls)
+
+
+    def test_signatures_cached(self):
+        mirror, calls = self.get_mirror()
+        basedir = mirror._contentdir()
+        mirror.start_change()
+        basedir.put_bytes('abc', 'line\n' * 20000)
+        mirror.finish_change()
+        signatures = server.SignatureCache(1024 * 1024)
+        cache = server.JournalCache(1024 * 1024, signatures)
+        calculated = []
+        signature = delta.signature
+        def logging_signature(a_file):
+            calculated.append(None)
+            return signature(a_file)
+        self.useFixture(MonkeyPatch('l_mirror.delta.signature',
+            logging_signature))
+        streams = [''.join(cache.get_generator(mirror, 2, 2).as_bytes(
+            delta=True)) for _ in range(2)]
+        self.assertEqual(streams[0], streams[1])
+        self.assertEqual(1, len(calculated))
+        # The cached stream is the same as an uncached one.
+        self.assertEqual(streams[0],
+            ''.join(mirror.get_generator(2, 2).as_bytes(delta=True)))
+        self.assertEqual(2, len(calculated))
+
+
+class TestSignatureCache(ResourcedTestCase):
+
+    def test_get(self):
+        cache = server.SignatureCache(1024)
+        self.assertEqual(None, cache.get('a', 'sha'))
+        cache.add('a', 'sha', 'signature')
+        self.assertEqual('signature', cache.get('a', 'sha'))
+        self.assertEqual(None, cache.get('a', 'othersha'))
+        self.assertEqual(None, cache.get('b', 'sha'))
+
+    def test_oversized_not_cached(self):
+        cache = server.SignatureCache(10)
+        cache.add('a', 'sha', 'signature')
+        self.assertEqual(None, cache.get('a', 'sha'))
+
+    def test_least_recently_used_discarded(self):
+        # Room for two entries.
+        cache = server.SignatureCache(
+            (server.SignatureCache.ENTRY_OVERHEAD + 2) * 2)
+        cache.add('a', 'sha', '1')
+        cache.add('b', 'sha', '2')
+        cache.get('a', 'sha')
+        cache.add('c', 'sha', '3')
+        self.assertEqual('1', cache.get('a', 'sha'))
+        self.assertEqual(None, cache.get('b', 'sha'))
+        self.assertEqual('3', cache.get('c', 'sha'))
+
+
+class TestChangeStore(ResourcedTestCase):
+
+    def test_prune(self):
+        store = server._ChangeStore('/root', 10)
+        store.pending = []
+        store.note('/root/a', 1.0)
+        store.note('/root/b', 2.0)
+        store.note('/root/a', 3.0)
+        self.assertEqual(['/root/a', '/root/b'], sorted(store.get()))
+        store.prune(2.5)
+        # a changed again after the prune point.
+        self.assertEqual(['/root/a'], store.get())
+        store.prune(4.0)
+        self.assertEqual([], store.get())
+
+    def test_overflow(self):
+        store = server._ChangeStore('/root', 2)
+        store.pending = []
+        store.note('/root/a', 1.0)
+        store.note('/root/b', 2.0)
+        store.note('/root/c', 3.0)
+        self.assertEqual(None, store.get())
+        store.note('/root/d', 4.0)
+        # Until a scan after the overflow is finished, changes are lost.
+        store.prune(2.0)
+        self.assertEqual(None, store.get())
+        store.prune(3.5)
+        self.assertEqual(['/root/d'], store.get())
+
+    def test_repeated_changes(self):
+        # A path changed over and over is kept once.
+        store = server._ChangeStore('/root', 2)
+        store.pending = []
+        for timestamp in range(10):
+            store.note('/root/a', float(timestamp))
+        store.note('/root/b', 10.0)
+        self.assertEqual(['/root/a', '/root/b'], sorted(store.get()))
+        store.prune(9.5)
+        self.assertEqual(['/root/b'], store.get())
+
+    def test_unwalked(self):
+        store = server._ChangeStore('/root', 10)
+        store.note('/root/a', 1.0)
+        self.assertEqual(None, store.get())
+        self.assertEqual((['/root/a'], ['/root']), store.get_scan())
+        store.pending = ['sub/dir']
+        self.assertEqual((['/root/a'], ['/root/sub/dir']), store.get_scan())
+
+
+class TestSetWatcher(ResourcedTestCase):
+
+    def setUp(self):
+        super(TestSetWatcher, self).setUp()
+        if server.pyinotify is None:
+            self.skip('pyinotify not available')
+
+    def test_changes_per_content_root(self):
+        ui = UI()
+        mirrors = []
+        for name in ('one', 'two'):
+            basedir = get_transport(self.useFixture(TempDir()).path)
+            mirror = mirrorset.initialise(basedir, name, basedir, ui)
+            mirror.finish_change()
+            mirrors.append(mirror)
+        watcher = server.SetWatcher()
+        for mirror in mirrors:
+            watcher.add(mirror)
+        self.assertEqual(None, watcher.get_changes(mirrors[0]))
+        watcher.start()
+        watcher.wait()
+        root = mirrors[0]._contentdir().local_abspath('.')
+        watcher.note_changed(root + '/abc')
+        self.assertTrue(root + '/abc' in watcher.get_changes(mirrors[0]))
+        self.assertFalse(root + '/abc' in watcher.get_changes(mirrors[1]))
+        # Scan timestamps are rounded to a hundredth of a second.
+        time.sleep(0.05)
+        mirrors[0].start_change()
+        mirrors[0]._contentdir().put_bytes('abc', 'content')
+        mirrors[0].finish_change()
+        watcher.mirror_updated(mirrors[0])
+        self.assertEqual([], watcher.get_changes(mirrors[0]))
+
+    def test_walk_notes_changes(self):
+        ui = UI()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        basedir.mkdir('sub')
+        basedir.put_bytes('sub/new', 'content')
+        watcher = server.SetWatcher()
+        watcher.add(mirror)
+        watcher.start()
+        watcher.wait()
+        root = basedir.local_abspath('.')
+        changes, scan = watcher.get_scan(mirror)
+        self.assertEqual([], scan)
+        self.assertTrue(root + '/sub/new' in changes)
+
+    def test_fast_start(self):
+        ui = UI()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        basedir.mkdir('sub')
+        basedir.put_bytes('sub/a', 'content')
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        root = basedir.local_abspath('.')
+        # Unchanged since the last scan.
+        for path in ('sub/a', 'sub'):
+            os.utime(root + '/' + path, (0, 0))
+        watcher = server.SetWatcher()
+        watcher.add(mirror)
+        watcher.start()
+        watcher.wait()
+        watcher.save_index()
+        index_path = mirror._metadatadir().local_abspath(server.DIR_INDEX)
+        self.assertTrue(os.path.exists(index_path))
+        listed = []
+        listdir = os.listdir
+        def logging_listdir(path):
+            listed.append(path)
+            return listdir(path)
+        self.useFixture(MonkeyPatch('os.listdir', logging_listdir))
+        watcher = server.SetWatcher(fast_start=True)
+        watcher.add(mirror)
+        watcher.start()
+        watcher.wait()
+        # Unchanged directories are not listed again.
+        self.assertFalse(root + '/sub' in listed)
+        self.assertEqual((0, []), watcher.changes[root].index['sub'])
+        # The index is used once.
+        self.assertFalse(os.path.exists(index_path))
+
+    def test_logs(self):
+        ui = UI()
+        basedir = get_transport(self.useFixture(TempDir()).path)
+        mirror = mirrorset.initialise(basedir, 'myname', basedir, ui)
+        mirror.finish_change()
+        log_path = mirror._metadatadir().local_abspath(changes.CHANGE_LOG)
+        watcher = server.SetWatcher(logs=True)
+        watcher.add(mirror)
+        # Not watched yet.
+        self.assertEqual(None, changes.read_log(log_path, 0))
+        watcher.start()
+        watcher.wait()
+        root = basedir.local_abspath('.')
+        watcher.note_changed(root + '/sub/abc')
+        known = changes.read_log(log_path, 0)
+        self.assertEqual(set(['abc']), known.dirs['sub'])
+        self.assertFalse('.lmirror/metadata/myname' in known.dirs)
+        # A second watcher cannot write the same log.
+        other = server.SetWatcher(logs=True)
+        self.assertRaises(ValueError, other.add, mirror)
+        # Once the set is updated past them the changes are discarded.
+        time.sleep(0.05)
+        mirror.start_change()
+        mirror.finish_change()
+        self.useFixture(MonkeyPatch('l_mirror.server.LOG_SLACK', 0))
+        watcher.refresh()
+        self.assertEqual(1, watcher.changes[root].logs[0].records)
+        watcher.close()
+        self.assertFalse(os.path.exists(log_path))
+        self.assertEqual(None, changes.read_log(log_path, 0))